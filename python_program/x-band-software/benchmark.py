@@ -0,0 +1,886 @@
+'''
+This script measures the speed of the data processing on a mock capture (see mock_capture.py).
+------Parameters------
+1. name: the benchmark to run, or no input to run all of them.
+------Output------
+1. The timing of the old and new implementation is printed.
+'''
+
+import collections
+import contextlib
+import glob
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import mock_capture
+import mpdu
+import check_data
+import cmd_gen
+import combine
+import hk
+import pipeline
+import preview
+import request_cost
+import read_bin
+import state
+
+def legacy_DF_raw_data(file_name):
+
+    '''
+    The per-packet loop used before mpdu.DF_raw_data, kept as the reference.
+    '''
+
+    with open(file_name, 'rb') as f:
+        mpduPackets = f.read().split(b'\x1A\xCF\xFC\x1D')[1:]
+
+    headers = [[], [], [], [], []]
+    for k, packet in enumerate(mpduPackets):
+        # classify the packets by the VCDU header
+        if packet[28:30] == b'\x55\x40':
+            headers[0].append('IM')
+            headers[4].append(packet[56:-160])
+        elif packet[28:30] == b'\x40\x3F':
+            headers[0].append('HK')
+            headers[4].append(packet[56:-160])
+        else:
+            continue
+
+        headers[1].append(int.from_bytes(packet[30:33], 'big'))
+        headers[2].append(packet[34])
+        headers[3].append(packet[1])
+
+    dataDF = pd.DataFrame({
+        'VCDU': headers[0],
+        'PSC': pd.Series(headers[1], dtype=int),
+        'IB': headers[2],
+        'DQ': pd.Series(headers[3], dtype=int),
+        'data': pd.Series(headers[4], dtype='object')  # Preserve binary data
+    })
+
+    return dataDF
+
+def best_of(func, repeat=5):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def report(name, t_old, t_new):
+    print(f'{name:<40s} old {t_old*1e3:9.2f} ms   new {t_new*1e3:9.2f} ms   x{t_old/t_new:6.1f}')
+
+def mock_file(folder, missing=0.01, bad=0.01, seed=0):
+
+    '''
+    Write a mock capture in the folder and return its name.
+    '''
+
+    file_name = os.path.join(folder, f'F2025010100{seed:04d}.bin')
+    if not os.path.isfile(file_name):
+        capture, image = mock_capture.make_capture(missing=missing, bad=bad, seed=seed)
+        with open(file_name, 'wb') as f:
+            f.write(capture)
+    return file_name
+
+def peak_rss(statement):
+
+    '''
+    Memory (MB) used by a new python process running the statement, relative to the state after the imports.
+    Output:
+        peak: increase of the peak RSS (VmHWM), including the pages of mapped files
+        private: increase of the private memory (RssAnon) still held after the statement
+    '''
+
+    code = ("import benchmark, mpdu\n"
+            f"mpdu.index_folder = {mpdu.index_folder!r}\n"
+            "status = lambda key: int([l for l in open('/proc/self/status') if l.startswith(key)][0].split()[1])\n"
+            "base = status('VmHWM'), status('RssAnon')\n"
+            f"{statement}\n"
+            "print((status('VmHWM') - base[0])/1024, (status('RssAnon') - base[1])/1024)")
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    peak, private = out.stdout.split()[-2:]
+    return float(peak), float(private)
+
+def bench_parse(folder):
+
+    '''
+    DF_raw_data on a nominal capture (16621 IM + 8000 HK frames).
+    '''
+
+    file_name = mock_file(folder)
+    with open(file_name, 'rb') as f:
+        capture = f.read()
+
+    pd.testing.assert_frame_equal(legacy_DF_raw_data(file_name), mpdu.DF_raw_data(file_name))
+    print(f'Frames: {len(mpdu.find_sync(capture))}')
+    report('DF_raw_data', best_of(lambda: legacy_DF_raw_data(file_name)), best_of(lambda: mpdu.DF_raw_data(file_name)))
+
+    # the header decoding alone, on packets already located in memory
+    packets = capture.split(mpdu.SYNC)[1:]
+    starts, ends = mpdu.packet_bounds(capture)
+    def header_loop():
+        return [(packet[28:30], int.from_bytes(packet[30:33], 'big'), packet[34], packet[1]) for packet in packets]
+    report('header decode', best_of(header_loop), best_of(lambda: mpdu.decode_headers(capture, starts, ends)))
+    report('locate packets', best_of(lambda: capture.split(mpdu.SYNC)), best_of(lambda: mpdu.packet_bounds(capture)))
+
+def bench_memory(folder):
+
+    '''
+    Peak memory of reading a capture and keeping the packet table.
+    '''
+
+    file_name = mock_file(folder)
+    print(f'Capture size: {os.path.getsize(file_name)/2**20:.1f} MB')
+    m_old = peak_rss(f"df = benchmark.legacy_DF_raw_data({file_name!r})")
+    m_new = peak_rss(f"df = mpdu.DF_raw_data({file_name!r})")
+    print(f'{"peak RSS of DF_raw_data":<40s} old {m_old[0]:9.1f} MB   new {m_new[0]:9.1f} MB')
+    print(f'{"private memory held by the table":<40s} old {m_old[1]:9.1f} MB   new {m_new[1]:9.1f} MB')
+
+def bench_scan(folder):
+
+    '''
+    Header-only scan against the full parse, for the completeness check.
+    '''
+
+    file_name = mock_file(folder)
+    full, scan = mpdu.DF_raw_data(file_name), mpdu.scan_headers(file_name)
+    pd.testing.assert_frame_equal(full[['VCDU', 'PSC', 'IB', 'DQ']], scan[['VCDU', 'PSC', 'IB', 'DQ']])
+    report('headers for the completeness check', best_of(lambda: legacy_DF_raw_data(file_name)), best_of(lambda: mpdu.scan_headers(file_name)))
+    report('  (against the mmap DF_raw_data)', best_of(lambda: mpdu.DF_raw_data(file_name)), best_of(lambda: mpdu.scan_headers(file_name)))
+    m_full = peak_rss(f"df = mpdu.DF_raw_data({file_name!r})")
+    m_scan = peak_rss(f"df = mpdu.scan_headers({file_name!r})")
+    print(f'{"private memory held by the table":<40s} full {m_full[1]:8.1f} MB   scan {m_scan[1]:8.1f} MB')
+
+def bench_index(folder):
+
+    '''
+    Reading a capture with and without its sidecar index.
+    '''
+
+    file_name = mock_file(folder)
+    mpdu.index_folder = os.path.join(folder, 'index')
+    mpdu.remove_index(file_name)
+    parsed = mpdu.DF_raw_data(file_name)
+    pd.testing.assert_frame_equal(parsed, mpdu.DF_raw_data(file_name))
+    print(f'Index size: {os.path.getsize(mpdu.index_name(file_name))/2**10:.1f} kB')
+
+    def parse():
+        mpdu.remove_index(file_name)
+        return mpdu.DF_raw_data(file_name)
+    report('DF_raw_data', best_of(parse), best_of(lambda: mpdu.DF_raw_data(file_name)))
+    report('scan_headers', best_of(lambda: (mpdu.remove_index(file_name), mpdu.scan_headers(file_name))),
+           best_of(lambda: mpdu.scan_headers(file_name)))
+    mpdu.index_folder = no_index
+
+def bench_worker(folder, repeat=5):
+
+    '''
+    Latency per file of check_data in a new python3 process (the previous main_control.py) and in the
+    persistent worker, on a nominal capture and on a short one (1000 frames).
+    '''
+
+    file_name = mock_file(folder)
+    short_name = os.path.join(folder, 'F20250101009000.bin')
+    with open(file_name, 'rb') as f:
+        capture = f.read()
+    starts, ends = mpdu.packet_bounds(capture)
+    with open(short_name, 'wb') as f:
+        f.write(capture[:ends[999]])
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_data.py')
+    cwd = os.getcwd()
+    os.chdir(folder)
+    os.makedirs('./tmp/', exist_ok=True)
+    mpdu.index_folder = './index/' # both use the index of the folder, as in main_control.py
+    try:
+        def latency(run):
+            timing = []
+            for _ in range(repeat):
+                t_start = time.perf_counter()
+                run()
+                timing.append(time.perf_counter() - t_start)
+            return min(timing)
+        t_start = time.perf_counter()
+        with pipeline.Pool(1) as pool:
+            pool.executor.submit(pipeline.run_stage, 'check', file_name).result() # the first call includes the start of the worker
+            t_first = time.perf_counter() - t_start
+            for name, label in ((file_name, 'nominal capture'), (short_name, 'short capture')):
+                t_old = latency(lambda: subprocess.run([sys.executable, script, name], check=True, capture_output=True))
+                t_new = latency(lambda: pool.executor.submit(pipeline.run_stage, 'check', name).result())
+                report(f'check_data, {label}', t_old, t_new)
+        print(f'{"first file (worker start included)":<40s} {t_first*1e3:9.2f} ms')
+    finally:
+        os.chdir(cwd)
+        mpdu.index_folder = no_index
+
+def pool_map(pool, stage, args_list):
+
+    '''
+    Run a stage on several files in the workers of a pipeline.Pool, outside of the event loop of main_control.py.
+    Output:
+        results: list of (return value, None) or (None, exception), in the order of args_list
+    '''
+
+    futures = [pool.executor.submit(pipeline.run_stage, stage, *args) for args in args_list]
+    results = []
+    for future in futures:
+        try:
+            results.append((future.result(), None))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+def bench_pool(folder, n_files=8):
+
+    '''
+    Throughput of check_data on several captures with 1, 2, 4 and 8 worker processes,
+    the results are committed in the order of the files as in main_control.py.
+    '''
+
+    import check_data
+    file_names = [mock_file(folder, seed=seed) for seed in range(n_files)]
+    print(f'CPU cores: {os.cpu_count()}, captures: {n_files}')
+    cwd = os.getcwd()
+    outputs = {}
+    try:
+        for n_workers in (1, 2, 4, 8):
+            run_folder = os.path.join(folder, f'pool_{n_workers}')
+            os.makedirs(os.path.join(run_folder, 'tmp'), exist_ok=True)
+            os.chdir(run_folder)
+            mpdu.index_folder = './index/'
+            with pipeline.Pool(n_workers) as pool:
+                t_start = time.perf_counter()
+                results = pool_map(pool, 'check', [(name, 'normal', False) for name in file_names])
+                for checked, error in results:
+                    if error is not None:
+                        raise error
+                    check_data.commit_check(checked)
+                t_total = time.perf_counter() - t_start
+            state.open_store().export()
+            outputs[n_workers] = {name: open(name, 'rb').read() for name in ['./report/un_gen.csv', './report/final_check.csv']}
+            print(f'{n_workers} workers: {t_total:7.2f} s   {n_files/t_total:6.2f} files/s')
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+        mpdu.index_folder = no_index
+    same = all(output == outputs[1] for output in outputs.values())
+    print(f'Same reports with all the numbers of workers: {same}')
+
+def legacy_move_report(file):
+
+    '''
+    The final_check.csv -> report.csv move of main_control.py before the state store, kept as the reference.
+    '''
+
+    with open('./report/final_check.csv', 'r') as f1:
+        lines = f1.readlines()
+    with open('./report/report.csv', 'a') as f2:
+        new_lines = []
+        for line in lines:
+            if line.split(',')[0] == file.split('_')[-1]:
+                f2.write(line)
+            else:
+                new_lines.append(line)
+    with open('./report/final_check.csv', 'w') as f1:
+        f1.writelines(new_lines)
+
+def bench_state(folder, repeat=200):
+
+    '''
+    Cost of one report update (a complete file is rendered) against the number of lines already in the reports.
+    '''
+
+    cwd = os.getcwd()
+    try:
+        for n_lines in (1000, 10000, 100000):
+            run_folder = os.path.join(folder, f'state_{n_lines}')
+            os.makedirs(os.path.join(run_folder, 'report'), exist_ok=True)
+            os.chdir(run_folder)
+            names = [f'F2025{k:010d}.bin' for k in range(n_lines + repeat)]
+            rows = [(name, 'OK', 0, 0, 0) for name in names]
+            with open('./report/final_check.csv', 'w') as f:
+                f.write(state.header)
+                f.writelines(state.csv_line(row) for row in rows)
+            store = state.open_store()
+            with store.transaction() as cur:
+                cur.executemany('INSERT INTO final (capture, type, start, end, rate) VALUES (?, ?, ?, ?, ?)', rows)
+
+            files = iter([f'opt_frame_{k:04d}_{name}' for k, name in enumerate(names[:repeat])])
+            t_old = best_of(lambda: legacy_move_report(next(files)), repeat//2)
+            files = iter([name for name in names[:repeat]])
+            t_new = best_of(lambda: store.report_final(next(files)), repeat//2)
+            report(f'report update, {n_lines} lines', t_old, t_new)
+    finally:
+        os.chdir(cwd)
+
+def legacy_encode_data(filename, VCDU, PSC_DF, data_DF, mode, sync_bytes=mpdu.SYNC):
+
+    '''
+    The encode_data used before mpdu.write_packets (4 writes per packet, one call per packet type),
+    kept as the reference.
+    '''
+
+    PSC_list = PSC_DF.values.tolist()
+    data_list = data_DF.values.tolist()
+    with open(filename, mode) as f:
+        for i in range(0, len(data_DF)):
+            f.write(sync_bytes)
+            f.write(VCDU)
+            f.write(PSC_list[i].to_bytes(3, byteorder='big'))
+            f.write(data_list[i])
+
+def bench_encode(folder):
+
+    '''
+    Writing the opt_frame of a nominal capture (16621 IM + 8000 HK packets).
+    '''
+
+    file_name = mock_file(folder)
+    headerDF = mpdu.scan_headers(file_name)
+    headerDF['data'] = mpdu.load_payloads(file_name, headerDF)
+    IM, HK = headerDF[headerDF['VCDU'] == 'IM'], headerDF[headerDF['VCDU'] == 'HK']
+    old_name, new_name = os.path.join(folder, 'opt_frame_old.bin'), os.path.join(folder, 'opt_frame_new.bin')
+
+    def old():
+        legacy_encode_data(old_name, mpdu.VCDU_image, IM['PSC'], IM['data'], 'wb')
+        legacy_encode_data(old_name, mpdu.VCDU_HK, HK['PSC'], HK['data'], 'ab')
+    def new():
+        mpdu.write_packets(new_name, [(mpdu.VCDU_image, IM['PSC'].to_numpy(), IM['data'].tolist()),
+                                      (mpdu.VCDU_HK, HK['PSC'].to_numpy(), HK['data'].tolist())])
+    old(), new()
+    with open(old_name, 'rb') as f_old, open(new_name, 'rb') as f_new:
+        assert f_old.read() == f_new.read()
+    print(f'Packets: {len(IM) + len(HK)}, file size: {os.path.getsize(new_name)/2**20:.1f} MB')
+    report('encode_data (IM + HK)', best_of(old), best_of(new))
+
+    # the same payload lengths are copied as fixed-size records, other files are joined
+    HK_short = HK['data'].map(lambda data: data[:-1]).tolist()
+    report('  payloads of two lengths', best_of(old), best_of(lambda: mpdu.write_packets(
+        new_name, [(mpdu.VCDU_image, IM['PSC'].to_numpy(), IM['data'].tolist()), (mpdu.VCDU_HK, HK['PSC'].to_numpy(), HK_short)])))
+
+def legacy_image_bytes(data_list):
+
+    '''
+    The concatenation of the image payloads used before read_bin.assemble_image, kept as the reference.
+    '''
+
+    data = bytes()
+    for i in range(len(data_list)):
+        data += data_list[i]
+    return np.frombuffer(data.rstrip(b'\0'), dtype=np.uint16)
+
+def bench_image(folder):
+
+    '''
+    Assembly of the 3003x3008 image of a complete opt_frame in read_bin.
+    The legacy concatenation is quadratic, it is timed on the first packets only and extrapolated.
+    '''
+
+    capture, image = mock_capture.make_capture(missing=0, bad=0, seed=1)
+    raw_name = os.path.join(folder, 'F20250101000001.bin')
+    with open(raw_name, 'wb') as f:
+        f.write(capture)
+    headerDF = mpdu.scan_headers(raw_name)
+    headerDF['data'] = mpdu.load_payloads(raw_name, headerDF)
+    IM, HK = headerDF[headerDF['VCDU'] == 'IM'], headerDF[headerDF['VCDU'] == 'HK']
+    frame_name = os.path.join(folder, 'opt_frame_0000_F20250101000001.bin')
+    mpdu.write_packets(frame_name, [(mpdu.VCDU_image, IM['PSC'].to_numpy(), IM['data'].tolist()),
+                                    (mpdu.VCDU_HK, HK['PSC'].to_numpy(), HK['data'].tolist())])
+
+    buf = mpdu.open_capture(frame_name)
+    index = mpdu.packet_index(frame_name, mpdu.layout_tmp)
+    index = index[index['VCDU'] == mpdu.VCDU_ID_image]
+    assert (read_bin.assemble_image(buf, index) == image).all()
+    t_new = best_of(lambda: read_bin.assemble_image(buf, index))
+
+    frameDF = mpdu.DF_tmp_data(frame_name)
+    data_list = frameDF[frameDF['VCDU'] == 'IM']['data'].tolist()
+    for n in (2000, 4000, 8000):
+        t_old = best_of(lambda: legacy_image_bytes(data_list[:n]), 1)
+        print(f'{"legacy concatenation, " + str(n) + " packets":<40s} {t_old*1e3:9.2f} ms')
+    # t ~ n^2
+    t_old *= (len(data_list)/n)**2
+    report(f'image assembly, {len(data_list)} packets', t_old, t_new)
+    print('(old: extrapolated from 8000 packets)')
+
+def bench_fused(folder, repeat=5):
+
+    '''
+    Complete capture to FITS image: check_data writing the opt_frame then read_bin reading it (both in the
+    persistent workers, without the start of a process), against the fused check_data.
+    '''
+
+    file_name = os.path.abspath(os.path.join(folder, 'F20250101000001.bin'))
+    if not os.path.isfile(file_name):
+        with open(file_name, 'wb') as f:
+            f.write(mock_capture.make_capture(missing=0, bad=0, seed=1)[0])
+    cwd = os.getcwd()
+    os.chdir(folder)
+    for name in ('./tmp/', './img/', './optical/'):
+        os.makedirs(name, exist_ok=True)
+    mpdu.index_folder = './index/' # as in main_control.py, read_bin uses the index written by check_data
+    try:
+        def separate():
+            check_data.fused = False
+            check_data.check_data(file_name)
+            frame = max(os.listdir('./optical/'))
+            read_bin.read_bin(os.path.join('./optical/', frame))
+            os.remove(os.path.join('./optical/', frame))
+        def fused():
+            check_data.fused = True
+            check_data.check_data(file_name)
+        t_old, t_new = best_of(separate, repeat), best_of(fused, repeat)
+        report('check + image of a complete capture', t_old, t_new)
+    finally:
+        check_data.fused = True
+        os.chdir(cwd)
+        mpdu.index_folder = no_index
+
+def image_frame(image, file_name):
+
+    '''
+    Write an opt_frame file carrying the image, as combine.py does for a complete capture (IM packets only).
+    '''
+
+    data = image.tobytes()
+    data += bytes(mock_capture.n_IM*mock_capture.payload_len - len(data))
+    payloads = [data[k*mock_capture.payload_len:(k+1)*mock_capture.payload_len] for k in range(mock_capture.n_IM)]
+    mpdu.write_packets(file_name, [(mpdu.VCDU_image, np.arange(mock_capture.n_IM), payloads)])
+
+def bench_fits(folder, repeat=3):
+
+    '''
+    Write time, size and read-back time of the FITS output modes of read_bin, on the random mock image and on a
+    sky-like image (background with noise and a few stars), which compresses like the real frames.
+    '''
+
+    from astropy.io import fits
+    rng = np.random.default_rng(0)
+    sky = rng.normal(1000, 8, mock_capture.image_shape)
+    for y, x in rng.integers(0, 3000, (200, 2)):
+        sky[y:y+5, x:x+5] += rng.uniform(500, 20000)
+    images = {'mock': mock_capture.mock_image(0), 'sky': np.clip(sky, 1, 65535).astype(np.uint16)}
+    options = [('plain', None, None), ('memmap', None, None),
+               ('compressed', 'RICE_1', (1, 3008)), ('compressed', 'RICE_1', (16, 3008)), ('compressed', 'RICE_1', (256, 256)),
+               ('compressed', 'GZIP_1', (1, 3008)), ('compressed', 'GZIP_2', (1, 3008)), ('compressed', 'GZIP_2', (16, 3008))]
+
+    cwd = os.getcwd()
+    os.chdir(folder)
+    os.makedirs('./img/', exist_ok=True)
+    try:
+        for name, image in images.items():
+            frame_name = f'./opt_frame_0000_F2025010100{name}.bin'
+            image_frame(image, frame_name)
+            buf = mpdu.open_capture(frame_name)
+            index = mpdu.packet_index(frame_name, mpdu.layout_tmp)
+            print(f'{name + " image":<32s} {"write":>9s} {"size":>9s} {"ratio":>6s} {"read":>9s}')
+            for fits_mode, compression_type, tile_shape in options:
+                read_bin.fits_mode, read_bin.compression_type, read_bin.tile_shape = fits_mode, compression_type, tile_shape
+                t_write = best_of(lambda: read_bin.make_image(buf, index, frame_name), repeat)
+                fits_name = read_bin.fits_name(frame_name)
+                t_read = best_of(lambda: fits.getdata(fits_name), repeat)
+                assert (fits.getdata(fits_name) == image).all()
+                size = os.path.getsize(fits_name)
+                label = fits_mode if compression_type is None else f'{compression_type} tiles {tile_shape[0]}x{tile_shape[1]}'
+                print(f'{label:<32s} {t_write*1e3:6.1f} ms {size/2**20:6.2f} MB {image.nbytes/size:6.2f} {t_read*1e3:6.1f} ms')
+
+        # memory allocated to write the image (numpy arrays), besides the mapped files
+        for fits_mode in ('plain', 'memmap'):
+            read_bin.fits_mode = fits_mode
+            tracemalloc.start()
+            read_bin.make_image(buf, index, frame_name)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{"peak allocation, " + fits_mode:<32s} {peak/2**20:6.1f} MB')
+    finally:
+        read_bin.fits_mode, read_bin.compression_type, read_bin.tile_shape = 'plain', 'RICE_1', (16, 3008)
+        os.chdir(cwd)
+
+def legacy_decode_hk(buf, HK):
+
+    '''
+    Per-packet decode of the HK payloads with struct, the reference for hk.decode_hk.
+    '''
+
+    import struct
+    layout = struct.Struct('>' + ''.join({'>u4': 'I', '>u2': 'H', '>i2': 'h', 'u1': 'B'}[fmt] for _, _, fmt, _, _ in hk.hk_fields))
+    rows = []
+    for psc, start in zip(HK['PSC'].tolist(), HK['data_start'].tolist()):
+        rows.append((psc,) + layout.unpack_from(buf, start))
+    return sorted(rows)
+
+def bench_hk(folder):
+
+    '''
+    Decode of the HK packets of a capture to the table of the FITS file, per packet against hk.decode_hk.
+    '''
+
+    file_name = mock_file(folder)
+    buf = mpdu.open_capture(file_name)
+    index = mpdu.packet_index(file_name, mpdu.layout_raw)
+    HK = index[index['VCDU'] == mpdu.VCDU_ID_HK]
+    decode = hk.hk_decode
+    hk.hk_decode = True # the decoder with the provisional layout
+    try:
+        assert [tuple(row) for row in hk.decode_hk(buf, HK).tolist()] == legacy_decode_hk(buf, HK)
+        t_old = best_of(lambda: legacy_decode_hk(buf, HK))
+        t_new = best_of(lambda: hk.decode_hk(buf, HK))
+        report(f'HK decode, {len(HK)} packets', t_old, t_new)
+        table = hk.decode_hk(buf, HK)
+        t_fits = best_of(lambda: (hk.hk_cards(table), hk.hk_hdu(table)))
+        print(f'{"header keywords + HK table":<40s} {t_fits*1e3:9.2f} ms')
+    finally:
+        hk.hk_decode = decode
+
+def bench_preview(folder, repeat=3):
+
+    '''
+    Time added to make_image by the quick-look pyramid and PNG (read_bin.preview), for the plain and memmap
+    FITS modes, and the parts of the preview.
+    '''
+
+    cwd = os.getcwd()
+    os.chdir(folder)
+    os.makedirs('./img/', exist_ok=True)
+    try:
+        frame_name = './opt_frame_0000_F20250101000000.bin'
+        image = mock_capture.mock_image(0)
+        image_frame(image, frame_name)
+        buf = mpdu.open_capture(frame_name)
+        index = mpdu.packet_index(frame_name, mpdu.layout_tmp)
+        for fits_mode in ('plain', 'memmap'):
+            read_bin.fits_mode = fits_mode
+            read_bin.preview = False
+            t_fits = best_of(lambda: read_bin.make_image(buf, index, frame_name), repeat)
+            read_bin.preview = True
+            t_preview = best_of(lambda: read_bin.make_image(buf, index, frame_name), repeat)
+            print(f'{"FITS " + fits_mode:<32s} {t_fits*1e3:6.1f} ms, with the preview {t_preview*1e3:6.1f} ms')
+        binned = preview.pyramid(image)
+        print(f'{"pyramid 1/2, 1/4, 1/8":<32s} {best_of(lambda: preview.pyramid(image))*1e3:6.1f} ms')
+        print(f'{"pyramid + PNG files":<32s} {best_of(lambda: preview.write_preview(None, read_bin.fits_name(frame_name), binned))*1e3:6.1f} ms')
+    finally:
+        read_bin.fits_mode, read_bin.preview = 'plain', False
+        os.chdir(cwd)
+
+def bench_partial(folder, repeat=3):
+
+    '''
+    Quick-look of an incomplete tmp file (read_bin.read_partial) against the image of the complete opt_frame.
+    '''
+
+    cwd = os.getcwd()
+    os.chdir(folder)
+    os.makedirs('./img/', exist_ok=True)
+    try:
+        image = mock_capture.mock_image(0)
+        frame_name = './opt_frame_0000_F20250101000000.bin'
+        image_frame(image, frame_name)
+        # 1% of the image packets missing
+        buf = mpdu.open_capture(frame_name)
+        index = mpdu.packet_index(frame_name, mpdu.layout_tmp)
+        keep = np.random.default_rng(0).random(len(index)) > 0.01
+        tmp_name = './tmp_F20250101000000.bin'
+        mpdu.write_packets(tmp_name, [(mpdu.VCDU_image, index['PSC'][keep],
+                                       [buf[start:end] for start, end in index[['data_start', 'data_end']][keep].tolist()])])
+        t_old = best_of(lambda: read_bin.read_bin(frame_name), repeat)
+        t_new = best_of(lambda: read_bin.read_partial(tmp_name), repeat)
+        print(f'{"read_bin, complete frame":<40s} {t_old*1e3:9.2f} ms')
+        print(f'{f"read_partial, {np.count_nonzero(~keep)} packets missing":<40s} {t_new*1e3:9.2f} ms')
+    finally:
+        os.chdir(cwd)
+
+def legacy_merge(tmp_name, requested):
+
+    '''
+    Merge of the re-downloaded packets before the slot files: read the whole tmp file, concat, sort by PSC
+    and write the whole file again (combine.py).
+    '''
+
+    tmp_data = mpdu.DF_tmp_data(tmp_name)
+    blocks = []
+    for VCDU, name in ((mpdu.VCDU_image, 'IM'), (mpdu.VCDU_HK, 'HK')):
+        combined = pd.concat([tmp_data[tmp_data['VCDU'] == name], requested[requested['VCDU'] == name]]).sort_values(by='PSC')
+        blocks.append((VCDU, combined['PSC'].to_numpy(), combined['data'].tolist()))
+    mpdu.write_packets(tmp_name + '.part', blocks)
+    os.replace(tmp_name + '.part', tmp_name + '.merged')
+
+def bench_slots(folder, repeat=5):
+
+    '''
+    Merge of k re-downloaded packets into the tmp file of a capture: rewrite of the whole tmp file (with its
+    sidecar index) against the in-place write to the slots of the slot file.
+    '''
+
+    file_name = mock_file(folder)
+    headerDF = mpdu.scan_headers(file_name)
+    headerDF['data'] = mpdu.load_payloads(file_name, headerDF)
+    headerDF = headerDF[headerDF['DQ'] == 0].drop_duplicates('PSC')
+    mpdu.index_folder = os.path.join(folder, 'index/')
+    try:
+        for k in (10, 160, 1600):
+            # the first k image packets are re-downloaded
+            IM = headerDF[headerDF['VCDU'] == 'IM']
+            requested, kept = IM.iloc[:k], pd.concat([IM.iloc[k:], headerDF[headerDF['VCDU'] == 'HK']])
+            blocks = [(mpdu.VCDU_image, kept[kept['VCDU'] == 'IM']['PSC'].to_numpy(), kept[kept['VCDU'] == 'IM']['data'].tolist()),
+                      (mpdu.VCDU_HK, kept[kept['VCDU'] == 'HK']['PSC'].to_numpy(), kept[kept['VCDU'] == 'HK']['data'].tolist())]
+            old_name, new_name = os.path.join(folder, 'tmp_old.bin'), os.path.join(folder, 'tmp_new.bin')
+            mpdu.write_packets(old_name, blocks)
+            mpdu.write_slots(new_name + '.ref', {mpdu.VCDU_ID_image: (0, 16620), mpdu.VCDU_ID_HK: (0, 8000)}, blocks)
+            t_old = best_of(lambda: legacy_merge(old_name, requested), repeat)
+            t_new = []
+            for _ in range(repeat):
+                shutil.copyfile(new_name + '.ref', new_name)
+                t_start = time.perf_counter()
+                with mpdu.SlotFile(new_name, write=True) as slots:
+                    n = slots.store(mpdu.VCDU_ID_image, requested['PSC'].to_numpy(), requested['data'].tolist())
+                    slots.completeness(mpdu.VCDU_ID_image)
+                t_new.append(time.perf_counter() - t_start)
+            assert n == k
+            report(f'merge of {k} packets', t_old, min(t_new))
+    finally:
+        mpdu.index_folder = no_index
+
+def bench_route(folder, n_captures=50, n_packets=200, repeat=3):
+
+    '''
+    Routing of a requested data file with the packets of n_captures captures to their tmp files: a glob and a
+    filter of the whole file per capture, against one pass grouped by source (combine.route, TmpIndex).
+    '''
+
+    import datetime
+    tmp_folder = os.path.join(folder, 'tmp/')
+    os.makedirs(tmp_folder, exist_ok=True)
+    frames = []
+    for k in range(n_captures):
+        name = f'F20250102{k // 60:04d}{k % 60:02d}'
+        open(os.path.join(tmp_folder, f'tmp_{name}.bin'), 'wb').close()
+        data_id = int(datetime.datetime.strptime(name, 'F%Y%m%d%H%M%S').timestamp()).to_bytes(4, 'big')
+        for psc in range(n_packets):
+            frame = bytearray(mock_capture.make_frame(mpdu.VCDU_image, psc, bytes(mock_capture.payload_len)))
+            frame[4+2:4+6] = data_id
+            frames.append(bytes(frame))
+    requested_file = os.path.join(folder, 'REQ_mixed.bin')
+    with open(requested_file, 'wb') as f:
+        f.write(b''.join(frames))
+
+    def old():
+        requested_data = mpdu.DF_raw_data(requested_file)
+        requested_data['source'] = combine.route(requested_file)['source'].to_numpy()
+        groups = []
+        for name in sorted(set(requested_data['source'])):
+            file_name = glob.glob(os.path.join(tmp_folder, f'tmp_*{name[:-4]}*.bin'))[0]
+            groups.append((file_name, requested_data[requested_data['source'].isin([name])]))
+        return groups
+    def new():
+        requested_data = combine.route(requested_file)
+        captures = requested_data.groupby('source', sort=True)
+        tmp_files = combine.tmp_index.lookup(list(captures.groups))
+        return [(tmp_files[name], packets) for name, packets in captures]
+
+    combine.data_id_field, combine.tmp_index = (2, 4), combine.TmpIndex(tmp_folder)
+    try:
+        assert [(name, len(packets)) for name, packets in old()] == [(name, len(packets)) for name, packets in new()]
+        # the source decoding is part of both, the old code had no source column
+        report(f'route {n_captures} captures x {n_packets} packets', best_of(old, repeat), best_of(new, repeat))
+    finally:
+        combine.data_id_field, combine.tmp_index = None, combine.TmpIndex()
+
+def legacy_best(headerDF):
+    # pandas: concatenated receptions sorted by DQ, first row of each (VCDU, PSC)
+    return headerDF.sort_values(['VCDU', 'PSC', 'DQ', 'source'], kind='stable').drop_duplicates(['VCDU', 'PSC'])
+
+def bench_diversity(folder, n_receptions=3, repeat=5):
+
+    '''
+    Merge of n_receptions receptions of a capture (2% lost, 1% bad each) to the best packet of each PSC:
+    pandas sort and drop_duplicates against mpdu.select_best on the index, then the requested packets.
+    '''
+
+    file_names = []
+    for k in range(n_receptions):
+        file_names.append(os.path.join(folder, f'reception_{k}.bin'))
+        with open(file_names[-1], 'wb') as f:
+            f.write(mock_capture.make_capture(0.02, 0.01, seed=0, loss_seed=k+1)[0])
+    headers = [mpdu.scan_headers(name).assign(source=k) for k, name in enumerate(file_names)]
+    headerDF = pd.concat(headers, ignore_index=True)
+    indexes = [mpdu.packet_index(name, mpdu.layout_raw, mpdu.strided_bounds) for name in file_names]
+    index = np.concatenate(indexes)
+    reception = np.repeat(np.arange(n_receptions), [len(part) for part in indexes])
+    keep = (index['VCDU'] == mpdu.VCDU_ID_image) | (index['VCDU'] == mpdu.VCDU_ID_HK)
+    index, reception = index[keep], reception[keep]
+
+    old = legacy_best(headerDF)
+    best = mpdu.select_best(index, reception)
+    assert sorted(zip(old['PSC'], old['DQ'], old['source'])) == sorted(zip(index['PSC'][best].tolist(), index['DQ'][best].tolist(), reception[best].tolist()))
+    report(f'best of {n_receptions} receptions', best_of(lambda: legacy_best(headerDF), repeat),
+           best_of(lambda: mpdu.select_best(index, reception), repeat))
+    bad = lambda DF: int((DF['DQ'] != 0).sum()) + (16621 + 8000 - len(DF))
+    print(f'Packets to request: {bad(headers[0])} (first reception), {bad(mpdu.scan_receptions(file_names))} (merged)')
+
+def legacy_list_shorten(lists, N_id):
+    while (len(lists)>N_id):
+        length_lists = np.array([lists[i+1][2]-lists[i][3] for i in range(len(lists)-1)])
+        length_min = np.min(length_lists)
+        i_merge = np.where(length_lists == length_min)[0][0]
+        list_add = [lists[i_merge][0],lists[i_merge][1],lists[i_merge][2],lists[i_merge+1][3],lists[i_merge][4]]
+        lists = lists[:i_merge] + [list_add] + lists[i_merge+2:]
+    return lists
+
+def bench_shorten(folder, N_id=10, repeat=3):
+
+    '''
+    Request shortening to N_id segments per file (cmd_gen.list_shorten), on the files of report/un_gen_test2.csv
+    grouped as in command_order, then on loss patterns made of its HK segments repeated over longer captures.
+    Packets: packets requested after the shortening, segments: segments with start > end (old loop on
+    duplicated or mixed IM/HK lines).
+    '''
+
+    rows = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report', 'un_gen_test2.csv')).values.tolist()
+    rows = [row for row in rows if row[1] not in ('OK', 'Error')]
+    files = [[row for row in rows if row[0] == name] for name in dict.fromkeys(row[0] for row in rows)]
+    packets = lambda lists: sum(max(row[3] - row[2] + 1, 0) for row in lists)
+    inverted = lambda lists: sum(row[2] > row[3] for row in lists)
+    for name, shorten in (('old', legacy_list_shorten), ('new', cmd_gen.list_shorten)):
+        out = [shorten([row[:] for row in lists], N_id) for lists in files]
+        print(f'un_gen_test2.csv {name}: {sum(map(len, out))} segments, {sum(map(packets, out))} packets, {sum(map(inverted, out))} inverted')
+    report('un_gen_test2.csv', best_of(lambda: [legacy_list_shorten([row[:] for row in lists], N_id) for lists in files], repeat),
+           best_of(lambda: [cmd_gen.list_shorten([row[:] for row in lists], N_id) for lists in files], repeat))
+
+    # the HK loss bursts of the csv (length and distance to the next one), repeated in one sequence
+    pattern = [row for row in files[0] if row[1] == 'HK'][:8]
+    for n_segments in (100, 1000, 5000):
+        lists, start = [], 0
+        for k in range(n_segments):
+            row = pattern[k % len(pattern)]
+            lists.append(['F20250101000000.bin', 'HK', start, start + row[3] - row[2], 1.0])
+            start += pattern[(k + 1) % len(pattern)][2] - row[2] if (k + 1) % len(pattern) else 1000
+        old, new = legacy_list_shorten([row[:] for row in lists], N_id), cmd_gen.list_shorten([row[:] for row in lists], N_id)
+        assert old == new
+        report(f'{n_segments} segments ({packets(new)} packets)', best_of(lambda: legacy_list_shorten([row[:] for row in lists], N_id), 1),
+               best_of(lambda: cmd_gen.list_shorten([row[:] for row in lists], N_id), repeat))
+
+def legacy_passes(sorted_list_pac, N_req):
+    # the previous loop of cmd_gen.command_order: the files in age order, a new REQ file when the running count
+    # reaches N_req, the segment that overflows is not added (i = i-1 has no effect)
+    passes, com_list, len_req, dropped = [], [], 0, 0
+    for pac_t in sorted_list_pac:
+        for i in range(len(pac_t)):
+            len_req += pac_t[i][3] - pac_t[i][2] + 1
+            if(len_req < N_req):
+                com_list.append(pac_t[i])
+            else:
+                passes.append(com_list)
+                len_req, com_list = 0, []
+                dropped += 1
+    passes.append(com_list)
+    return passes, dropped
+
+def bench_schedule(folder, n_files=60, N_req=40000, n_passes=3):
+
+    '''
+    Frames completed after each of the first n_passes passes of N_req packets (cmd_gen.schedule) against the previous
+    REQ files of command_order, on a mock backlog of n_files files with the loss rates of un_gen.csv.
+    '''
+
+    rng = np.random.default_rng(0)
+    files = []
+    for k in range(n_files):
+        rate = float(rng.choice([1.9625, 5.6875, 14.38, 41.07]))
+        n = int(rng.integers(1, 10))
+        cuts = np.sort(rng.choice(16620, 2*n, replace=False))
+        length = int(rate*16621/100/n)
+        files.append([[f'F202501{k // 24:02d}{k % 24:02d}0000.bin', 'IM', int(cuts[2*j]), int(min(cuts[2*j] + length, cuts[2*j+1])), rate] for j in range(n)])
+
+    def completed(passes, n_passes):
+        # a file is complete when all its packets are requested in the first passes
+        requested = collections.Counter()
+        for rows in passes[:n_passes]:
+            for row in rows:
+                requested[row[0]] += row[3] - row[2] + 1
+        return sum(requested[rows[0][0]] == cmd_gen.n_packets(rows) for rows in files)
+
+    old, dropped = legacy_passes([[row[:] for row in rows] for rows in files], N_req)
+    print(f'previous REQ files: {len(old)}, segments dropped: {dropped}')
+    for priority in ('oldest', 'nearest', 'smallest'):
+        requests = cmd_gen.order_requests([(rows[0][0], [row[:] for row in rows], False) for rows in files], priority)
+        new = cmd_gen.schedule(requests, N_req)
+        fill = ', '.join(f'{row[3]:.0f}%' for row in cmd_gen.pass_fill(new, N_req)[:n_passes])
+        done = ', '.join(f'{completed(old, n)} -> {completed([p[0] for p in new], n)}' for n in range(1, n_passes+1))
+        print(f'{priority:<9s}: frames completed after 1..{n_passes} passes {done}, passes {len(new)}, fill {fill}')
+
+def bench_cost(folder, N_id=10, rate_for_all=80, total_packet=16621, N_req=16621):
+
+    '''
+    Bytes on air of the command lists made by cmd_gen.command_order from each historical csv of report/ (one
+    run of cmd_gen per file), with the full request above rate_for_all against the choice of the cost model
+    (request_cost.py), for several command overheads (bytes of a response besides its packets).
+    '''
+
+    history = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report', '*.csv')))
+    runs = {}
+    for file_name in history:
+        rows = pd.read_csv(file_name).values.tolist() if os.path.getsize(file_name) > 0 else []
+        rows = [row for row in rows if row[1] != 'OK']
+        if len(rows) > 0:
+            runs[os.path.basename(file_name)] = rows
+
+    def on_air(name, cost, model):
+        # the lists of the run, then the bytes of their commands and packets with the model
+        list_folder = os.path.join(folder, 'cost', name)
+        shutil.rmtree(list_folder, ignore_errors=True)
+        os.makedirs(os.path.join(list_folder, 'run'))
+        cmd_gen.command_order([row[:] for row in runs[name]], os.path.join(list_folder, 'run', ''), N_req, N_id,
+                              rate_for_all, total_packet, None, 'oldest', cost)
+        commands, packets = request_cost.requested(list_folder)
+        return sum(model.cost(commands[capture], packets[capture]) for capture in commands), sum(commands.values()), sum(packets.values())
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = []
+        for overhead in (0, request_cost.frame_bytes, 16*request_cost.frame_bytes, 1024*request_cost.frame_bytes):
+            model = request_cost.RequestCost(overhead)
+            for name in runs:
+                results.append((name, overhead, on_air(name, None, model), on_air(name, model, model)))
+    for name, overhead, (old, old_commands, old_packets), (new, new_commands, new_packets) in results:
+        print(f'{name} overhead {overhead:>8d} B: rate_for_all {old/2**20:8.2f} MiB ({old_commands} commands, {old_packets} packets)'
+              f' -> cost model {new/2**20:8.2f} MiB ({new_commands} commands, {new_packets} packets)')
+
+# the sidecar index is disabled, except in bench_index
+no_index = '/dev/null/index/'
+
+benchmarks = {
+    'parse': bench_parse,
+    'memory': bench_memory,
+    'scan': bench_scan,
+    'index': bench_index,
+    'worker': bench_worker,
+    'pool': bench_pool,
+    'state': bench_state,
+    'encode': bench_encode,
+    'image': bench_image,
+    'fused': bench_fused,
+    'fits': bench_fits,
+    'hk': bench_hk,
+    'preview': bench_preview,
+    'partial': bench_partial,
+    'slots': bench_slots,
+    'route': bench_route,
+    'diversity': bench_diversity,
+    'shorten': bench_shorten,
+    'schedule': bench_schedule,
+    'cost': bench_cost,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(benchmarks)
+    mpdu.index_folder = no_index
+    with tempfile.TemporaryDirectory() as folder:
+        for name in names:
+            print(f'------{name}------')
+            # a scratch folder per benchmark, the mock files of one do not change the results of another
+            os.makedirs(os.path.join(folder, name))
+            benchmarks[name](os.path.join(folder, name))
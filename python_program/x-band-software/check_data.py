@@ -3,292 +3,332 @@ This script reads the raw data, checks completeness of the data, and the data qu
 ------Parameters------
 1. file_name: the name of the raw data file to be checked (full path). 
     If no input, the last file in the raw_data folder will be checked.
-2. mode: "detail" or no input for normal mode
+2. mode: "detail", "scan" or no input for normal mode
+3. receptions: the other receptions of the same capture (antennas or passes), merged packet by packet with the
+    first file, the best DQ of each PSC is kept
 ------Output------
 1. If mode is "detail", the script will output a txt file that contains the header information of the packets.
-2. If mode is "normal", the script will write the report to the last report file (.csv) in the report folder.:
-    - If there is no missing image packets, the script will save the image data to the optical folder.
-    - If there are missing image packets, the script will store the incomplete image data to the tmp folder.
+   If mode is "scan", the script will only read the packet headers and print the gap report and the data quality,
+   nothing is stored.
+2. If mode is "normal", the script will write the report to the state store (state.py), and export
+   ./report/un_gen.csv, final_check.csv and report.csv:
+    - If there is no missing image packets, the script will write the image to the img folder after the report
+      (fused, see below), or save the image data to the optical folder for read_bin.py.
+    - If there are missing image packets, the script will store the incomplete image data to the tmp folder
+      (slot file, see mpdu.SlotFile).
 '''
 
 import glob
 import os
 import sys
 import datetime
+import collections
 import numpy as np
 import pandas as pd
+from completeness import Completeness
+from state import open_store, db_name
+from read_bin import render_raw, ReadBinError
+from mpdu import scan_headers, scan_receptions, load_payloads, write_packets, write_slots, move_index, remove_index, open_capture, packet_bounds, decode_headers, VCDU_ID_image, VCDU_ID_HK
 
-def find_consecutive_ranges(lst):
-    
-    '''
-    Find the consecutive ranges in a list of integers.
-    Input:
-        lst: a list of integers
-    Output:
-        ranges: a list of lists, each sublist contains the start and end of a consecutive range
-    '''
-    
-    if not lst:
-        return []
-    
-    ranges = []
-    start = lst[0]
-    
-    for i in range(1, len(lst)):
-        if lst[i] != lst[i - 1] + 1:
-            ranges.append([start, lst[i - 1]])
-            start = lst[i]
-    
-    ranges.append([start, lst[-1]])  # Append the last range
-    
-    return ranges
-
-def encode_data(filename, VCDU, PSC_DF, data_DF, mode, sync_bytes=b'\x1A\xCF\xFC\x1D'):
+def encode_data(filename, blocks, sync_bytes=b'\x1A\xCF\xFC\x1D'):
     '''
     Used for storing data. Only DQ=0 data will be stored.
+    The packets of all the blocks are written with one open and one write (mpdu.write_packets).
     ------Parameters------
     filename: str
         The name of the file to write to.
-    VCDU: bytes
-        The VCDU header for identifying the data.
-    PSC_DF: DataFrame
-        The DataFrame containing the PSC values.
-    data_DF: DataFrame
-        The DataFrame containing the data values.
-    mode: str
-        The mode to open the file in. 'wb' and 'ab'.
+    blocks: list
+        (VCDU, PSC_DF, data_DF) for each packet type, in the order of the file:
+        the VCDU header for identifying the data, the Series of the PSC values and the Series of the data values.
     sync_bytes: bytes
         The sync bytes to use to separate records.
     '''
     try:
-        PSC_list = PSC_DF.values.tolist()
-        data_list = data_DF.values.tolist()
-        with open(filename, mode) as f: 
-            for i in range(0, len(data_DF)):
-                f.write(sync_bytes)
-                f.write(VCDU)
-                # Pack the sequence count into bytes
-                PSC_bytes = PSC_list[i].to_bytes(3, byteorder='big')
-                f.write(PSC_bytes)
-                f.write(data_list[i])
-            if mode == 'wb':
-                print(f"Data write to {filename}")
-            else:
-                print(f"Data append to {filename}")
+        write_packets(filename, [(VCDU, PSC_DF.to_numpy(), data_DF.tolist()) for VCDU, PSC_DF, data_DF in blocks], sync_bytes)
+        print(f"Data write to {filename}")
     except Exception as e:
          print(f"Error writing to file: {e}")
 
-def DF_raw_data(file_name):
-    
+# result of the normal mode: table of the state store ('segments' for un_gen.csv, 'final' for final_check.csv),
+# rows (file name, type, start, end, rate) for the report, the stored opt_frame (.part) or None, and the raw
+# data file to render (fused) or None
+Checked = collections.namedtuple('Checked', ['table', 'rows', 'frame', 'render'], defaults=(None,))
+
+class CheckError(Exception):
     '''
-    Read the raw data file and return a DataFrame containing the header information.
-    Input:
-        file_name: str
-            The name of the raw data file.
-    Output:
-        dataDF: DataFrame
-            The DataFrame containing the header information.
+    The raw data file is unreadable, it is reported as Error in un_gen.csv (exit code 1 of the script).
+    The Checked result with the Error line is the second argument.
     '''
-    
-    with open(file_name, 'rb') as f:
-        mpduPackets = f.read().split(b'\x1A\xCF\xFC\x1D')[1:]
-
-    headers = [[], [], [], [], []]
-    for k, packet in enumerate(mpduPackets):
-        # classify the packets by the VCDU header
-        if packet[28:30] == b'\x55\x40':
-            headers[0].append('IM')
-            headers[4].append(packet[56:-160])
-            # headers[4].append(0)
-        elif packet[28:30] == b'\x40\x3F':
-            headers[0].append('HK')
-            headers[4].append(packet[56:-160])
-            # headers[4].append(0)
-        else:
-            continue
-        
-        headers[1].append(int.from_bytes(packet[30:33], 'big'))
-        headers[2].append(packet[34])
-        headers[3].append(packet[1])
-        
-    dataDF = pd.DataFrame({
-        'VCDU': headers[0],
-        'PSC': pd.Series(headers[1], dtype=int),
-        'IB': headers[2],
-        'DQ': pd.Series(headers[3], dtype=int),
-        'data': pd.Series(headers[4], dtype='object')  # Preserve binary data
-    })
-    
-    return dataDF
+    def __init__(self, file_name, checked=None):
+        super().__init__(file_name, checked)
+        self.checked = checked
+    def __repr__(self):
+        return f'CheckError({self.args[0]!r})'
 
 output_IM_folder_path = "./optical/"
 report_path = "./report/"
-os.makedirs(output_IM_folder_path,exist_ok=True)
-os.makedirs(report_path,exist_ok=True)
-# get the file name to be checked
-files = glob.glob('./raw_data/*.bin')
-files.sort()
-if len(sys.argv)<2:
-    file_name = files[-1]
-else:
-    file_name = sys.argv[1]
-    
-# reports = glob.glob('./report/*.csv')
-# reports.sort()
+# a complete capture is written to ./img/ as FITS from the payloads of the raw data (fused, read_bin.render_raw),
+# instead of an opt_frame file read again by read_bin.py. The image is made after the commit, as its own job
+# (main_control.py: in the read pool), the check itself does no FITS I/O
+fused = True
+# the opt_frame of the fused captures is only written to this folder, for debugging (e.g. './debug/')
+debug_folder = None
 
 VCDU_image = b'\x55\x40'
 VCDU_HK = b'\x40\x3F'
 
-# read the raw data, split the data into packets using sync bytes
-with open(file_name, 'rb') as f:
-    mpduPackets = f.read().split(b'\x1A\xCF\xFC\x1D')[1:]
+def commit_check(checked, journal=None):
+    '''
+    Move the stored opt_frame to the optical folder with the next number, and add the rows to the state store.
+    Only this step writes to the shared files, so the files can be checked in parallel and committed in order.
+    ------Parameters------
+    checked: Checked
+        The result of check_data.
+    journal: tuple
+        (file path, hash, state) of the raw file, recorded with the rows (main_control.py).
+    '''
+    if checked.frame is not None:
+        nfiles = len(glob.glob(output_IM_folder_path+'*.bin'))
+        nfiles = str(nfiles).zfill(4)
+        outfile = f'./optical/opt_frame_{nfiles}_{checked.frame.split("/")[-1][:-len(".part")]}'  # output file name
+        # the file is renamed when complete, main_control.py reads it as soon as it appears
+        os.replace(checked.frame, outfile)
+        move_index(checked.frame, outfile)
+    open_store().add_rows(checked.table, checked.rows, journal)
 
-# create a output file if needed
-if (len(sys.argv)>2) and (sys.argv[2] == "detail"):
-    # output file that contains the header information of the packets
-    fout_name = f'./{file_name.split("/")[-1]}'
-    fout_name = fout_name.replace('.bin', '_header.txt')
-    print(f'Detail output: {fout_name}')
-    fout = open(fout_name, 'w')
-else:
-    # print(f'Raw data file: {file_name}')
-    # determine normal mode report file
-    if os.path.isfile('./report/un_gen.csv'):
-        fout_name_incpl = './report/un_gen.csv'
-    else:
-        fout_name_incpl = './report/un_gen.csv'
-        with open(fout_name_incpl, 'w') as f:
-            f.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
-    print(f'Report file: {fout_name_incpl}')
-    if os.path.isfile('./report/final_check.csv'):
-        fout_name_cpl = './report/final_check.csv'
+def render_check(checked, file_name=None):
+    '''
+    Write the image of a complete capture checked with fused (read_bin.render_raw), then move its line from final
+    to the report history, or report the Error line if the image can not be made (e.g. duplicated packets).
+    Used when check_data commits the result itself, main_control.py runs render_raw in the read pool instead.
+    ------Parameters------
+    checked: Checked
+        The committed result of check_data, with the raw data file to render.
+    file_name: str
+        The raw data file, if it was moved since the check (e.g. archived).
+    ------Returns------
+    fits_name: str
+        The FITS file, None if the image failed.
+    '''
+    capture = checked.rows[0][0]
+    try:
+        fits_name = render_raw(checked.render if file_name is None else file_name)
+    except ReadBinError as e:
+        print(f'Error in the image of {capture}: {e!r}')
+        open_store().report_final(capture, (capture, 'Error', 65535, 65535, 100))
+        return None
+    open_store().report_final(capture)
+    return fits_name
+
+def check_data(file_name, mode="normal", commit=True, receptions=()):
+    '''
+    Check one raw data file, see the description of the script.
+    ------Parameters------
+    file_name: str
+        The raw data file to be checked (full path).
+    mode: str
+        "detail", "scan" or "normal".
+    commit: bool
+        In normal mode, write the report and the opt_frame at the end (commit_check), and the image of a
+        complete capture (render_check). If False, the caller commits the result and renders the image.
+    receptions: list
+        Other receptions of the same capture (other antennas or passes, full paths). The packets of all the
+        receptions are merged to the best copy of each PSC (mpdu.scan_receptions) before the completeness check,
+        so only the packets lost by every reception are requested again. Not used in "detail" mode.
+    ------Returns------
+    checked: Checked
+        The result in normal mode, None in the other modes.
+    ------Raises------
+    CheckError
+        The file is unreadable (no IM/HK packets), the Error line is written to the report.
+    '''
+    os.makedirs(output_IM_folder_path,exist_ok=True)
+    os.makedirs(report_path,exist_ok=True)
+
+    # create a output file if needed
+    if mode == "detail":
+        # output file that contains the header information of the packets
+        fout_name = f'./{file_name.split("/")[-1]}'
+        fout_name = fout_name.replace('.bin', '_header.txt')
+        print(f'Detail output: {fout_name}')
+        fout = open(fout_name, 'w')
+    elif mode == "scan":
+        # no output file, the report is printed
+        pass
     else:
-        fout_name_cpl = './report/final_check.csv'
-        with open(fout_name_cpl, 'w') as f:
-            f.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
-    print(f'Report file: {fout_name_cpl}')
-    # print(f'Report file: {fout_name}')
-    
-    # if len(reports) == 0:
-    #     dt_now = datetime.datetime.now()
-    #     # https://docs.python.org/3/library/datetime.html#strftime-strptime-behavior
-    #     time_now = dt_now.strftime('%Y%m%d%H%M%S')
-    #     print('No report file found, create a new one.')
-    #     fout_name = f'{report_path}report_0000_{time_now}.csv'
-    #     with open(fout_name, 'w') as f:
-    #         f.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
-    # else:
-    #     fout_name = reports[-1]
-    #     if os.path.getsize(fout_name) > 1e7: # size limit of a report file is ~ 10MB
-    #         print('The last report file is too large, create a new one.')
-    #         dt_now = datetime.datetime.now()
-    #         time_now = dt_now.strftime('%Y%m%d%H%M%S')
-    #         fout_name = f'{report_path}report_{str(len(reports)).zfill(4)}_{time_now}.csv'
-    #         with open(fout_name, 'w') as f:
-    #             f.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
-    #     else:
-    #         print(f'Write to the last report file: {fout_name}')
-            
-headers = [[], [], [], []]
-hk = []
+        # print(f'Raw data file: {file_name}')
+        # the report is written to the state store, un_gen.csv and final_check.csv are exported from it
+        print(f'Report file: {db_name}')
+        # print(f'Report file: {fout_name}')
 
-# loop through all the packets, extract the header information
-if (len(sys.argv)>2) and (sys.argv[2] == "detail"):
-    for k, packet in enumerate(mpduPackets):
-        # classify the packets by the VCDU header
-        if packet[28:30] == b'\x55\x40':
-            headers[0].append('IM')
-        elif packet[28:30] == b'\x40\x3F':
-            headers[0].append('HK')
-            hk.append(packet.hex())
-        else:
-            headers[0].append('UnClassified')
-        
-        headers[1].append(int.from_bytes(packet[30:33], 'big'))
-        headers[2].append(packet[34])
-        headers[3].append(packet[1])
-        fout.write(
-            f'{headers[0][-1]}, {headers[1][-1]}, {headers[2][-1]}, {headers[3][-1]}\n'
-        )
-    fout.write(f'Number of Packets: {len(mpduPackets)}\n')
-    fout.close()
-    headerDF = pd.DataFrame({
-        'VCDU': headers[0],
-        'PSC': pd.Series(headers[1], dtype=int),
-        'IB': headers[2],
-        'DQ': headers[3]
-    })
-else:
-    headerDF = DF_raw_data(file_name)
+        # if len(reports) == 0:
+        #     dt_now = datetime.datetime.now()
+        #     # https://docs.python.org/3/library/datetime.html#strftime-strptime-behavior
+        #     time_now = dt_now.strftime('%Y%m%d%H%M%S')
+        #     print('No report file found, create a new one.')
+        #     fout_name = f'{report_path}report_0000_{time_now}.csv'
+        #     with open(fout_name, 'w') as f:
+        #         f.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
+        # else:
+        #     fout_name = reports[-1]
+        #     if os.path.getsize(fout_name) > 1e7: # size limit of a report file is ~ 10MB
+        #         print('The last report file is too large, create a new one.')
+        #         dt_now = datetime.datetime.now()
+        #         time_now = dt_now.strftime('%Y%m%d%H%M%S')
+        #         fout_name = f'{report_path}report_{str(len(reports)).zfill(4)}_{time_now}.csv'
+        #         with open(fout_name, 'w') as f:
+        #             f.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
+        #     else:
+        #         print(f'Write to the last report file: {fout_name}')
 
-# check the completeness of the data
-try: 
-    im_mask, hk_mask = headerDF['VCDU'] == 'IM', headerDF['VCDU'] == 'HK'
-    IM, HK = headerDF[im_mask]['PSC'].astype(int), headerDF[hk_mask]['PSC'].astype(int)
-    bad_IM, bad_HK = headerDF[(im_mask)&(headerDF['DQ'] != 0)]['PSC'].astype(int), headerDF[(hk_mask)&(headerDF['DQ'] != 0)]['PSC'].astype(int)
-    IM_range = set(range(0, 16620))
-    max_HK = HK[HK <= 8136].max() # observed, not confrimed by the document
-    HK_range = set(range(int(min(HK)), int(max_HK)+1)) # if the number of HK is fixed, please change the range 
-    IM = set(IM) - set(bad_IM)
-    HK = set(HK) - set(bad_HK)
-    missing_IM = IM_range - set(IM)
-    missing_HK = HK_range - set(HK)
-    missing_IM = sorted(list(missing_IM))
-    missing_HK = sorted(list(missing_HK))
-    missing_rate_IM = (len(missing_IM)/16621)*100
-    missing_rate_HK = (len(missing_HK)/8000)*100 # 8k is for testing, not real
-    missing_segment_IM = find_consecutive_ranges(list(missing_IM))
-    missing_segment_HK = find_consecutive_ranges(list(missing_HK))
-    
-    # output the report
-    if (len(sys.argv)>2) and (sys.argv[2] == "detail"):
-        fout = open(fout_name, 'a')
-        fout.write(f'Total Image Packets: {headerDF[headerDF["VCDU"] == "IM"].shape[0]}\n')
-        fout.write(f'UnClassified Packets: {headerDF[headerDF["VCDU"] == "UnClassified"].shape[0]}\n')
-        fout.write(f'Sequence number of Missing Image Packets: {missing_IM}\n')
-        fout.write(f'Number of Missing Image Packets: {len(missing_IM)}\n')
-        fout.write(f'Sequence number of Missing HK Packets: {missing_HK}\n')
-        fout.write(f'Number of bad quality Image Packets: {len(bad_IM)}\n')
-        fout.write(f'Number of Missing HK Packets: {len(missing_HK)}\n')
-        fout.write(f'Number of bad quality HK Packets: {len(bad_HK)}\n')
-        fout.write(f'Total missing packets: {len(missing_IM)+len(missing_HK)}\n')
-        fout.write(f'Segment of request image packets: {missing_segment_IM}\n')
-        fout.write(f'Segment of request HK packets: {missing_segment_HK}\n')
-        fout.write(f'Request image packets rate (missing image/Image packet %): {missing_rate_IM}\n')
+    # loop through all the packets, extract the header information
+    if mode == "detail":
+        # read the raw data (memory-mapped), locate the packets using sync bytes
+        buf = open_capture(file_name)
+        starts, ends = packet_bounds(buf)
+        packet_headers = decode_headers(buf, starts, ends)
+        # classify the packets by the VCDU header
+        VCDU_name = np.where(packet_headers['VCDU'] == VCDU_ID_image, 'IM',
+                             np.where(packet_headers['VCDU'] == VCDU_ID_HK, 'HK', 'UnClassified'))
+        headerDF = pd.DataFrame({
+            'VCDU': VCDU_name,
+            'PSC': packet_headers['PSC'],
+            'IB': packet_headers['IB'],
+            'DQ': packet_headers['DQ']
+        })
+        for VCDU, PSC, IB, DQ in headerDF.itertuples(index=False):
+            fout.write(f'{VCDU}, {PSC}, {IB}, {DQ}\n')
+        fout.write(f'Number of Packets: {len(starts)}\n')
         fout.close()
-
     else:
-        IM_mask = lambda x: (x['VCDU'] == 'IM') & (x['DQ'] == 0)
-        HK_mask = lambda x: (x['VCDU'] == 'HK') & (x['DQ'] == 0) # can be replaced by the packet type that store the fits header information in the future update.    
-        if (missing_rate_IM == 0) and (len(missing_HK) == 0):
-            # no missing packets, save the image data
-            nfiles = len(glob.glob(output_IM_folder_path+'*.bin'))
-            nfiles = str(nfiles).zfill(4)
-            outfile = f'./optical/opt_frame_{nfiles}_{file_name.split("/")[-1]}'  # output file name
-            # write the image data to the optical folder
-            encode_data(outfile, VCDU_image, headerDF[IM_mask(headerDF)]['PSC'], headerDF[IM_mask(headerDF)]['data'], 'wb')
-            # append the HK data to the optical folder
-            encode_data(outfile, VCDU_HK, headerDF[HK_mask(headerDF)]['PSC'], headerDF[HK_mask(headerDF)]['data'], 'ab')
-            # output the report
-            with open(fout_name_cpl, 'a') as f:
-                f.write(f'{file_name.split("/")[-1]},OK,0,0,0\n')
+        # header-only scan, the payloads are loaded only when they are stored
+        headerDF = scan_headers(file_name) if len(receptions) == 0 else scan_receptions([file_name] + list(receptions))
+    # the files of the payloads, load_payloads picks the reception of each packet
+    sources = file_name if (mode == "detail") or (len(receptions) == 0) else [file_name] + list(receptions)
+
+    # check the completeness of the data
+    try: 
+        im_mask, hk_mask = headerDF['VCDU'] == 'IM', headerDF['VCDU'] == 'HK'
+        IM, HK = headerDF[im_mask]['PSC'].astype(int), headerDF[hk_mask]['PSC'].astype(int)
+        bad_IM, bad_HK = headerDF[(im_mask)&(headerDF['DQ'] != 0)]['PSC'].astype(int), headerDF[(hk_mask)&(headerDF['DQ'] != 0)]['PSC'].astype(int)
+        IM_state = Completeness(0, 16620)
+        max_HK = HK[HK <= 8136].max() # observed, not confrimed by the document
+        HK_state = Completeness(int(min(HK)), int(max_HK)+1) # if the number of HK is fixed, please change the range 
+        IM_state.mark(IM, headerDF[im_mask]['DQ'])
+        HK_state.mark(HK, headerDF[hk_mask]['DQ'])
+        missing_IM = IM_state.missing().tolist()
+        missing_HK = HK_state.missing().tolist()
+        missing_rate_IM = IM_state.missing_rate(16621)
+        missing_rate_HK = HK_state.missing_rate(8000) # 8k is for testing, not real
+        missing_segment_IM = IM_state.segments()
+        missing_segment_HK = HK_state.segments()
+
+        # output the report
+        if mode == "detail":
+            fout = open(fout_name, 'a')
+            fout.write(f'Total Image Packets: {headerDF[headerDF["VCDU"] == "IM"].shape[0]}\n')
+            fout.write(f'UnClassified Packets: {headerDF[headerDF["VCDU"] == "UnClassified"].shape[0]}\n')
+            fout.write(f'Sequence number of Missing Image Packets: {missing_IM}\n')
+            fout.write(f'Number of Missing Image Packets: {len(missing_IM)}\n')
+            fout.write(f'Sequence number of Missing HK Packets: {missing_HK}\n')
+            fout.write(f'Number of bad quality Image Packets: {len(bad_IM)}\n')
+            fout.write(f'Number of Missing HK Packets: {len(missing_HK)}\n')
+            fout.write(f'Number of bad quality HK Packets: {len(bad_HK)}\n')
+            fout.write(f'Total missing packets: {len(missing_IM)+len(missing_HK)}\n')
+            fout.write(f'Segment of request image packets: {missing_segment_IM}\n')
+            fout.write(f'Segment of request HK packets: {missing_segment_HK}\n')
+            fout.write(f'Request image packets rate (missing image/Image packet %): {missing_rate_IM}\n')
+            fout.close()
+
+        elif mode == "scan":
+            print(f'Total Image Packets: {int(im_mask.sum())}')
+            print(f'Total HK Packets: {int(hk_mask.sum())}')
+            print(f'Number of bad quality Image Packets: {len(bad_IM)}')
+            print(f'Number of bad quality HK Packets: {len(bad_HK)}')
+            print(f'Number of Missing Image Packets: {len(missing_IM)}')
+            print(f'Number of Missing HK Packets: {len(missing_HK)}')
+            print(f'Segment of request image packets: {missing_segment_IM}')
+            print(f'Segment of request HK packets: {missing_segment_HK}')
+            print(f'Request packets rate (%): {missing_rate_IM+missing_rate_HK}')
+
         else:
-            outfile = f'./tmp/tmp_{file_name.split("/")[-1]}'
-            # store the incomplete image data
-            encode_data(outfile, VCDU_image, headerDF[IM_mask(headerDF)]['PSC'], headerDF[IM_mask(headerDF)]['data'], 'wb')
-            # append the incomplete HK data
-            encode_data(outfile, VCDU_HK, headerDF[HK_mask(headerDF)]['PSC'], headerDF[HK_mask(headerDF)]['data'], 'ab')
-            # output the report for the missing packets
-            with open(fout_name_incpl, 'a') as f:
+            IM_mask = lambda x: (x['VCDU'] == 'IM') & (x['DQ'] == 0)
+            HK_mask = lambda x: (x['VCDU'] == 'HK') & (x['DQ'] == 0) # can be replaced by the packet type that store the fits header information in the future update.    
+            # the image is assembled from one mapped file, a capture merged from several receptions goes through the opt_frame
+            single = ('source' not in headerDF) or not headerDF['source'].any()
+            if fused and single and (missing_rate_IM == 0) and (len(missing_HK) == 0):
+                if debug_folder is not None:
+                    os.makedirs(debug_folder, exist_ok=True)
+                    headerDF['data'] = load_payloads(sources, headerDF)
+                    encode_data(f'{debug_folder}opt_frame_{file_name.split("/")[-1]}',
+                                [(VCDU_image, headerDF[IM_mask(headerDF)]['PSC'], headerDF[IM_mask(headerDF)]['data']),
+                                 (VCDU_HK, headerDF[HK_mask(headerDF)]['PSC'], headerDF[HK_mask(headerDF)]['data'])])
+                # output the report, the image is made from the raw data after the commit (render_check)
+                checked = Checked('final', [(file_name.split("/")[-1], 'OK', 0, 0, 0)], None, file_name)
+            elif (missing_rate_IM == 0) and (len(missing_HK) == 0):
+                headerDF['data'] = load_payloads(sources, headerDF)
+                # no missing packets, save the image data
+                # the opt_frame is numbered when it is committed
+                outfile = f'./optical/{file_name.split("/")[-1]}.part'
+                # write the image data, followed by the HK data, to the optical folder
+                encode_data(outfile, [(VCDU_image, headerDF[IM_mask(headerDF)]['PSC'], headerDF[IM_mask(headerDF)]['data']),
+                                      (VCDU_HK, headerDF[HK_mask(headerDF)]['PSC'], headerDF[HK_mask(headerDF)]['data'])])
+                # output the report
+                checked = Checked('final', [(file_name.split("/")[-1], 'OK', 0, 0, 0)], outfile)
+            else:
+                headerDF['data'] = load_payloads(sources, headerDF)
+                outfile = f'./tmp/tmp_{file_name.split("/")[-1]}'
+                # store the incomplete image data and HK data in the slots of their PSC, combine.py fills the
+                # missing slots in place (mpdu.SlotFile)
+                write_slots(outfile, {VCDU_ID_image: (IM_state.start, IM_state.end), VCDU_ID_HK: (HK_state.start, HK_state.end)},
+                            [(VCDU_image, headerDF[IM_mask(headerDF)]['PSC'].to_numpy(), headerDF[IM_mask(headerDF)]['data'].tolist()),
+                             (VCDU_HK, headerDF[HK_mask(headerDF)]['PSC'].to_numpy(), headerDF[HK_mask(headerDF)]['data'].tolist())])
+                print(f"Data write to {outfile}")
+                # output the report for the missing packets
+                rows = []
                 for segment in missing_segment_IM:
-                    f.write(f'{file_name.split("/")[-1]},IM,{segment[0]},{segment[1]},{missing_rate_IM+missing_rate_HK}\n')
+                    rows.append((file_name.split("/")[-1], 'IM', segment[0], segment[1], missing_rate_IM+missing_rate_HK))
                 for segment in missing_segment_HK:
-                    f.write(f'{file_name.split("/")[-1]},HK,{segment[0]},{segment[1]},{missing_rate_IM+missing_rate_HK}\n')
+                    rows.append((file_name.split("/")[-1], 'HK', segment[0], segment[1], missing_rate_IM+missing_rate_HK))
+                checked = Checked('segments', rows, None)
 
-except Exception as e:
-    # report for unreadable files
-    with open(fout_name_incpl, 'a') as f:
-        f.write(f'{file_name.split("/")[-1]},Error,65535,65535,100\n')
-    # os.system(f'touch ./tmp/tmp_{file_name.split("/")[-1]}')
-    # print(f'Error in {file_name}: {e}')
-    sys.exit(1)
\ No newline at end of file
+    except Exception as e:
+        # report for unreadable files
+        if mode == "scan":
+            print(f'{file_name.split("/")[-1]},Error,65535,65535,100')
+            raise CheckError(file_name) from e
+        checked = Checked('segments', [(file_name.split("/")[-1], 'Error', 65535, 65535, 100)], None)
+        if commit:
+            commit_check(checked)
+        # os.system(f'touch ./tmp/tmp_{file_name.split("/")[-1]}')
+        # print(f'Error in {file_name}: {e}')
+        raise CheckError(file_name, checked) from e
+
+    if mode not in ("detail", "scan"):
+        if commit:
+            commit_check(checked)
+            if checked.render is not None:
+                render_check(checked)
+        return checked
+
+if __name__ == "__main__":
+    # get the file name to be checked
+    files = glob.glob('./raw_data/*.bin')
+    files.sort()
+    if len(sys.argv)<2:
+        file_name = files[-1]
+    else:
+        file_name = sys.argv[1]
+    mode = sys.argv[2] if len(sys.argv)>2 else "normal"
+    # python check_data.py <raw file> normal <other receptions of the capture>
+    receptions = sys.argv[3:]
+    try:
+        check_data(file_name, mode, receptions=receptions)
+    except CheckError:
+        sys.exit(1)
+    finally:
+        if mode not in ("detail", "scan"):
+            open_store().export()
+        # the sidecar indexes are only kept by main_control.py until the files are archived
+        for name in [file_name] + receptions:
+            remove_index(name)
@@ -4,10 +4,17 @@ import glob
 import pandas as pd
 import sys
 import cmd_enc_dec as myenc
+import request_cost
 import numpy as np
 import csv
+from state import open_store
 
 #NOTFIXED: not fixed part
+#######################################################################
+class CommandError(Exception):
+    #a line of un_gen.csv can not be categorized (the script exits)
+    pass
+
 #######################################################################
 def main():
     #NOTFIXED_START
@@ -27,6 +34,16 @@ def main():
     total_packet = 16621    
     #if the fraction of requested packets is larger than this, all data is requested
     rate_for_all = 0.8*100
+    #downlink pass of the requests: duration (s) and link rate (bit/s), None for N_request packets per pass
+    pass_duration = None
+    link_rate = None
+    #bytes of one re-downlinked packet: sync + header + payload + trailer of a frame
+    packet_size = 4 + 56 + 1088 + 160
+    #order of the files in the passes: 'oldest', 'nearest' (smallest missing fraction first) or 'smallest'
+    #(fewest packets first)
+    priority = 'oldest'
+    if (pass_duration is not None) and (link_rate is not None):
+        N_request = int(pass_duration*link_rate/8/packet_size)
 
     #folders
     folder_cmd_list = './cmd/list/' 
@@ -35,16 +52,33 @@ def main():
     folder_cmd_bin_cur = folder_cmd_bin +  f'{now:%Y%m%d_%H%M%S}' + '/'
     #folder_cmd_list_cur += '/'
     #folder_cmd_bin_cur += '/'
+    #partial or full request of each file by the bytes on air (request_cost.py), calibrated from the command
+    #lists and the requested data archived by main_control.py; False: full request when Incompleteness >= rate_for_all
+    cost_model = True
+    folder_req_archive = './archive/requested_data/'
     #NOTFIXED_END
 
-    file_name = folder_decode_out + 'un_gen.csv'
-    try:
-        list_packet_t = pd.read_csv(file_name).values.tolist() #csv /w header
-    except:
+    #segments not requested yet (un_gen.csv is an export of them)
+    store = open_store(folder_decode_out + 'state.db')
+    ids, list_packet_t = store.pending_segments()
+    if len(ids) == 0:
         return 0
+    #the fitted model is kept in the state store, the logs are only read the first time
+    cost = request_cost.load_model(store, folder_cmd_list, folder_req_archive) if cost_model else None
+    #one folder per run, a run in the same second as the previous one gets a suffix
+    n_run = 0
+    while os.path.exists(folder_cmd_list_cur[:-1]) or os.path.exists(folder_cmd_bin_cur[:-1]):
+        n_run += 1
+        folder_cmd_list_cur = folder_cmd_list + f'{now:%Y%m%d_%H%M%S}_{n_run}' + '/'
+        folder_cmd_bin_cur = folder_cmd_bin + f'{now:%Y%m%d_%H%M%S}_{n_run}' + '/'
     os.makedirs(folder_cmd_list_cur[:-1])
     os.makedirs(folder_cmd_bin_cur[:-1])
-    command_order(folder_decode_out,folder_cmd_list_cur,N_request,N_id,rate_for_all,total_packet,now)
+    command_order(list_packet_t,folder_cmd_list_cur,N_request,N_id,rate_for_all,total_packet,now,priority,cost)
+    #the segments are in the command lists, they are moved to the report history (report.csv)
+    store.mark_requested(ids, folder_cmd_list_cur)
+    #the new lists are counted for the cost model
+    for file_name in glob.glob(folder_cmd_list_cur + 'REQ*.csv'):
+        request_cost.record_list(store, file_name)
     command_bin(folder_cmd_list_cur,folder_cmd_bin_cur)
         
    
@@ -84,8 +118,10 @@ def command_bin(folder_list,folder_bin):
                     f.write(out_cmd_b)
 
 #######################################################################
-def command_order(fol_dout,fol_lis,N_req,N_id,rate_for_all,total_packet,now):
-    file_name = fol_dout + 'un_gen.csv'
+def command_order(list_packet_t,fol_lis,N_req,N_id,rate_for_all,total_packet,now,priority='oldest',cost=None):
+    #list_packet_t: lines of un_gen.csv [Filename,Type,Start,End,Incompleteness]
+    #N_req: packets of one downlink pass, priority: see order_requests
+    #cost: request_cost.RequestCost, the full request is chosen by its cost instead of rate_for_all
     #list of request    
     list_packet = []
     #list of all data request    
@@ -93,10 +129,8 @@ def command_order(fol_dout,fol_lis,N_req,N_id,rate_for_all,total_packet,now):
     #list of OK packet    
     list_OK = []       
     #Categorized in each list
-    list_packet_t = pd.read_csv(file_name).values.tolist() #csv /w header
-    add_csv(fol_dout + 'report.csv',list_packet_t)    
     for pac_t in list_packet_t:
-        if (pac_t[4] < rate_for_all and pac_t[1] != 'OK' and pac_t[1] != 'Error'):
+        if ((cost is not None or pac_t[4] < rate_for_all) and pac_t[1] != 'OK' and pac_t[1] != 'Error'):
             list_packet.append(pac_t)
         elif (pac_t[1] == 'OK'):
             list_OK.append(pac_t)
@@ -104,7 +138,7 @@ def command_order(fol_dout,fol_lis,N_req,N_id,rate_for_all,total_packet,now):
             list_for_all.append(pac_t)
         else:
             print("ERROR in command_order: unknown category")
-            sys.exit()
+            raise CommandError(pac_t)
             
     #list of raw file
     file_id = set([row[0] for row in list_packet])
@@ -116,58 +150,147 @@ def command_order(fol_dout,fol_lis,N_req,N_id,rate_for_all,total_packet,now):
     #NOTFIXED_START
     #shorten number of packets > N_id
     for i in range(len(sorted_list_pac)):
-        if ( len(sorted_list_pac[i] ) > N_id ):
+        if cost is not None:
+            #the gaps cheaper than a command are merged too
+            sorted_list_pac[i] = list_shorten(sorted_list_pac[i],N_id,cost.gap_merge())
+        elif ( len(sorted_list_pac[i] ) > N_id ):
             sorted_list_pac[i] = list_shorten(sorted_list_pac[i],N_id)
     #NOTFIXED_END
 
-    #make a list : number of packets < N_req
-    len_req = 0
-    com_list = []
-    n_csv = 0
-    for pac_t in sorted_list_pac:
-        pac_t = add_request_rate(pac_t,total_packet)
-        for i in range(len(pac_t)):
-            len_req += pac_t[i][3] - pac_t[i][2] + 1
-            if(len_req < N_req):
-                com_list.append(pac_t[i])
-            else:
-                save_to_csv(fol_lis + 'REQ',n_csv,com_list)
-                len_req = 0 
-                com_list = []
-                n_csv += 1
-                i = i-1
-    save_to_csv(fol_lis + 'REQ',n_csv,com_list)
-    n_csv += 1
-
-    #make a list : request all packet
+    #full request (one command per type) of the files where it costs less than the segments
+    if cost is not None:
+        full = [pac_t for pac_t in sorted_list_pac if cost.full(pac_t) < cost.partial(pac_t)]
+        for pac_t in full:
+            list_for_all += list({row[1]: row for row in pac_t}.values())
+        sorted_list_pac = [pac_t for pac_t in sorted_list_pac if cost.full(pac_t) >= cost.partial(pac_t)]
+
+    #requests of the files in the order of priority, a full request is one command (not split)
+    requests = [(pac_t[0][0],add_request_rate(pac_t,total_packet),False) for pac_t in sorted_list_pac]
+    full = {}
     for pac_t in list_for_all:
         pac_t[2] = 0 #set packet start & end for all packet
-        pac_t[3] = total_packet
+        pac_t[3] = total_packet #the whole PSC range of the type, the satellite sends the packets it has
         pac_t.append(1) #rate for request
-        save_to_csv(fol_lis + 'REQ',n_csv,[pac_t])
-        n_csv += 1
+        full.setdefault(pac_t[0],{})[pac_t[1]] = pac_t
+    #the full requests of a file (one per type, the repeated lines are requested once) are scheduled together
+    requests += [(name,list(rows.values()),True) for name, rows in full.items()]
+    requests = order_requests(requests,priority)
+
+    #one REQ file per pass, N_req packets per pass
+    passes = schedule(requests,N_req)
+    for n_csv in range(len(passes)):
+        save_to_csv(fol_lis + 'REQ',n_csv,passes[n_csv][0],header_req)
+    plan = pass_fill(passes,N_req)
+    save_to_csv(fol_lis + 'PLAN',0,plan,header_plan)
+    for row in plan:
+        print('Pass {0}: {1} packets, fill {3:.1f}%, {4} files, {5} complete'.format(*row) + (' (over budget)' if row[1] > N_req else ''))
 
     #make a list: complete data
     n_csv = 0
     for pac_t in list_OK:
         pac_t.append(0) #rate for request
-        save_to_csv(fol_lis + 'DEL',n_csv,[pac_t])
+        save_to_csv(fol_lis + 'DEL',n_csv,[pac_t],header_req)
         n_csv += 1
-
-    os.remove(file_name)
     
 
+#######################################################################
+#order of the requests (file name, rows, full) in the passes
+#'oldest': older file first, 'nearest': the file nearest to completion first (smallest missing fraction),
+#'smallest': fewest requested packets first, then older file first
+def order_requests(requests,priority):
+    age = lambda req: req[0][1:-4]
+    if priority == 'oldest':
+        key = lambda req: age(req)
+    elif priority == 'nearest':
+        key = lambda req: (req[1][0][4], age(req))
+    elif priority == 'smallest':
+        key = lambda req: (n_packets(req[1]), age(req))
+    else:
+        raise ValueError(priority)
+    return sorted(requests, key = key)
+
+#number of requested packets of the rows [Filename,Type,Start,End,...] (the ends are included),
+#the whole capture for a full request of an unreadable file (Error)
+def n_packets(rows):
+    return sum(request_cost.request_packets(row) for row in rows)
+
+#pack the requests into passes of N_req packets: each file goes to the first pass with room for its whole
+#request (first fit, the frames are completed in one pass), a file larger than a pass is split over new
+#passes, a full request larger than a pass has its own pass
+#output: list of [rows, packets, files, files completed in the pass]
+def schedule(requests,N_req):
+    passes = []
+    for name, rows, full in requests:
+        cost = n_packets(rows)
+        fit = [p for p in passes if p[1] + cost <= N_req]
+        if len(fit) > 0 or (full and cost > N_req):
+            if len(fit) > 0:
+                p = fit[0]
+            else:
+                p = [[],0,0,0]
+                passes.append(p)
+            p[0] += rows
+            p[1] += cost
+            p[2] += 1
+            p[3] += 1
+            continue
+        #split the segments over new passes, the last part leaves room for the next files
+        p = None
+        for row in rows:
+            row = list(row)
+            while True:
+                if (p is None) or (p[1] >= N_req):
+                    p = [[],0,1,0]
+                    passes.append(p)
+                room = N_req - p[1]
+                if row[3] - row[2] + 1 <= room:
+                    p[0].append(row)
+                    p[1] += row[3] - row[2] + 1
+                    break
+                p[0].append(row[:3] + [row[2] + room - 1] + row[4:])
+                p[1] += room
+                row[2] += room
+        p[3] += 1
+    return passes
+
+#predicted fill of the passes: [Pass, Packets, Budget, Fill(%), Files, Complete], the fill of a full request
+#larger than a pass is above 100%
+def pass_fill(passes,N_req):
+    return [[n, p[1], N_req, 100*p[1]/N_req, p[2], p[3]] for n, p in enumerate(passes)]
+
 #######################################################################
 #reduce the number of command by combining missed packets
+#the segments of each type are sorted, the overlapping or adjacent ones are joined (no extra packet),
+#then the N gaps that cost the fewest packets are filled, N = segments - N_id: merging never changes
+#the other gaps, so this is the least number of requested packets for N_id segments (the previous
+#loop merged the smallest gap one at a time, O(n^2), and also across IM and HK segments)
+#gap_merge: the gaps of at most this number of packets are merged even with N_id segments or less
 #NOTFIXED_START
-def list_shorten(lists,N_id):
-    while (len(lists)>N_id):
-        length_lists = np.array([lists[i+1][2]-lists[i][3] for i in range(len(lists)-1)])
-        length_min = np.min(length_lists)
-        i_merge = np.where(length_lists == length_min)[0][0]
-        list_add = [lists[i_merge][0],lists[i_merge][1],lists[i_merge][2],lists[i_merge+1][3],lists[i_merge][4]]
-        lists = lists[:i_merge] + [list_add] + lists[i_merge+2:]
-    return lists
+def list_shorten(lists,N_id,gap_merge=0):
+    if len(lists) == 0:
+        return lists
+    #types in the order of the input (IM before HK as in un_gen.csv)
+    types = list(dict.fromkeys(row[1] for row in lists))
+    lists = sorted(lists, key = lambda row: (types.index(row[1]), row[2], row[3]))
+    kind = np.array([types.index(row[1]) for row in lists])
+    start = np.array([row[2] for row in lists])
+    end = np.array([row[3] for row in lists])
+    #end of the run so far in each type (overlapping segments), the types are shifted apart
+    shift = kind * (int(end.max()) + 1)
+    end = np.maximum.accumulate(end + shift) - shift
+    #packets added by merging a segment with the next one, no merge across types
+    gap = start[1:] - end[:-1] - 1
+    same = kind[1:] == kind[:-1]
+    merge = same & (gap <= gap_merge)
+    n_extra = len(lists) - np.count_nonzero(merge) - N_id
+    if n_extra > 0:
+        #smallest gaps first, the first one on a tie (same as the previous loop)
+        candidates = np.flatnonzero(same & ~merge)
+        merge[candidates[np.argsort(gap[candidates], kind='stable')[:n_extra]]] = True
+    #a new segment starts after every gap that is kept
+    first = np.concatenate(([0], np.flatnonzero(~merge) + 1))
+    last = np.concatenate((first[1:] - 1, [len(lists) - 1]))
+    return [[lists[i][0],lists[i][1],int(start[i]),int(end[j]),lists[i][4]] for i, j in zip(first.tolist(), last.tolist())]
 #NOTFIXED_END
 
 #######################################################################
@@ -179,24 +302,25 @@ def add_request_rate(lists,total_packet):
         raw.append(sum_packet/total_packet) 
     return lists
 
+#header of the command lists (the rows have the request rate of add_request_rate after the un_gen.csv columns)
+header_req = 'Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621),Request_rate\n'
+#header of the predicted fill of the passes
+header_plan = 'Pass,Packets,Budget,Fill(%),Files,Complete\n'
+
 #save list of request in csv format    
-def save_to_csv(folder_name,n_c,data):
+def save_to_csv(folder_name,n_c,data,header=header_req):
     #filename = folder_name + f'{now_t:%Y%m%d%H%M%S}' + '_{0:05}.csv'.format(n_c)
     filename = folder_name + '_{0:05}.csv'.format(n_c)
     with open(filename, mode='w', newline='') as file:
-        file.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
+        file.write(header)
         writer = csv.writer(file)
         writer.writerows(data)   
-                
-def add_csv(file_name, new_data):
-    try:
-        df = pd.read_csv(file_name).values.tolist()
-        df.append(new_data)
-    except FileNotFoundError:
-        df = new_data
-    with open(file_name, mode = 'a', newline = '') as file:
-        writer = csv.writer(file)
-        writer.writerows(new_data)
+
 #######################################################################
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        main()
+    except CommandError:
+        sys.exit()
+    finally:
+        open_store().export()
@@ -3,158 +3,61 @@ This script is used to read the re-downloaded missing packets (RMP) and merge th
 It reads the RMP files, identifies which ICs they belong to, and merges them with the ICs. (ongoing)
 ------Input------
 1. Read the RMP files and the IC files.
-2. Identify which ICs the RMP files belong to. (ongoing)
+2. Identify which ICs the RMP files belong to: the packets are grouped by source capture in one pass (route),
+   and the tmp files are found in an index of the tmp folder (TmpIndex).
 ------Output------
 1. If there are no missing packets in the re-combined file, the script will save the image data to the optical folder.
-2. If there are missing packets in the re-combined file, the script will save the incomplete image data to the tmp folder, replace the original IC.
-3. The script will output a report file to the report folder.
+2. If there are missing packets in the re-combined file, the re-downloaded packets are written in place to the slots
+   of the tmp file (mpdu.SlotFile), the tmp file is not rewritten.
+3. The script will write the report to the state store (state.py), and export the csv files to the report folder.
 '''
 
+import datetime
 import glob
 import os
+import re
 import sys
-import pandas as pd
+import numpy as np
+from state import open_store, db_name
+from mpdu import DF_raw_data, DF_tmp_data, write_packets, write_slots, is_slot_file, SlotFile, move_index, remove_index, \
+    open_capture, packet_index, packet_table, layout_raw, payload_start, VCDU_ID_image, VCDU_ID_HK
 
-def DF_tmp_data(file_name):
-    
-    '''
-    Read the tmp data file and return a DataFrame containing the header information.
-    Input:
-        file_name: str
-            The name of the tmp data file.
-    Output:
-        dataDF: DataFrame
-            The DataFrame containing the header information.
-    '''
-    
-    with open(file_name, 'rb') as f:
-        mpduPackets = f.read().split(b'\x1A\xCF\xFC\x1D')[1:]
-
-    headers = [[], [], []]
-    for k, packet in enumerate(mpduPackets):
-        # classify the packets by the VCDU header
-        if packet[:2] == b'\x55\x40':
-            headers[0].append('IM')
-            headers[2].append(packet[5:])
-        elif packet[:2] == b'\x40\x3F':
-            headers[0].append('HK')
-            headers[2].append(packet[5:])
-        else:
-            continue
-        
-        headers[1].append(int.from_bytes(packet[2:5], 'big'))
-        
-    headerDF = pd.DataFrame({
-        'VCDU': headers[0],
-        'PSC': pd.Series(headers[1], dtype=int),
-        'data': pd.Series(headers[2], dtype='object')  # Preserve binary data
-    })
-    
-    return headerDF
-
-def DF_raw_data(file_name):
-    
-    '''
-    Read the raw data file and return a DataFrame containing the header information.
-    Input:
-        file_name: str
-            The name of the raw data file.
-    Output:
-        dataDF: DataFrame
-            The DataFrame containing the header information.
-    '''
-    
-    with open(file_name, 'rb') as f:
-        mpduPackets = f.read().split(b'\x1A\xCF\xFC\x1D')[1:]
-
-    headers = [[], [], [], [], []]
-    for k, packet in enumerate(mpduPackets):
-        # classify the packets by the VCDU header
-        if packet[28:30] == b'\x55\x40':
-            headers[0].append('IM')
-            headers[4].append(packet[56:-160])
-            # headers[4].append(0)
-        elif packet[28:30] == b'\x40\x3F':
-            headers[0].append('HK')
-            headers[4].append(packet[56:-160])
-            # headers[4].append(0)
-        else:
-            continue
-        
-        headers[1].append(int.from_bytes(packet[30:33], 'big'))
-        headers[2].append(packet[34])
-        headers[3].append(packet[1])
-        
-    dataDF = pd.DataFrame({
-        'VCDU': headers[0],
-        'PSC': pd.Series(headers[1], dtype=int),
-        'IB': headers[2],
-        'DQ': pd.Series(headers[3], dtype=int),
-        'data': pd.Series(headers[4], dtype='object')  # Preserve binary data
-    })
-    
-    return dataDF
-
-def encode_data(filename, VCDU, PSC_DF, data_DF, mode, sync_bytes=b'\x1A\xCF\xFC\x1D'):
+def encode_data(filename, blocks, sync_bytes=b'\x1A\xCF\xFC\x1D'):
     '''
     Used for store incomplete data.
+    The packets of all the blocks are written with one open and one write (mpdu.write_packets).
     ------Parameters------
     filename: str
         The name of the file to write to.
-    VCDU: bytes
-        The VCDU header for identifying the data.
-    PSC_DF: DataFrame
-        The DataFrame containing the PSC values.
-    data_DF: DataFrame
-        The DataFrame containing the data values.
-    mode: str
-        The mode to open the file in. 'wb' and 'ab'.
+    blocks: list
+        (VCDU, PSC_DF, data_DF) for each packet type, in the order of the file:
+        the VCDU header for identifying the data, the Series of the PSC values and the Series of the data values.
     sync_bytes: bytes
         The sync bytes to use to separate records.
     '''
     try:
-        PSC_list = PSC_DF.values.tolist()
-        data_list = data_DF.values.tolist()
-        with open(filename, mode) as f: 
-            for i in range(0, len(data_DF)):
-                f.write(sync_bytes)
-                f.write(VCDU)
-                # Pack the sequence count into bytes
-                PSC_bytes = PSC_list[i].to_bytes(3, byteorder='big')
-                f.write(PSC_bytes)
-                f.write(data_list[i])
-            if mode == 'wb':
-                print(f"Data write to {filename}")
-            else:
-                print(f"Data append to {filename}")
+        write_packets(filename, [(VCDU, PSC_DF.to_numpy(), data_DF.tolist()) for VCDU, PSC_DF, data_DF in blocks], sync_bytes)
+        print(f"Data write to {filename}")
     except Exception as e:
          print(f"Error writing to file: {e}")
 
-def find_consecutive_ranges(lst):
-    
+class CombineError(Exception):
     '''
-    Find the consecutive ranges in a list of integers.
-    Input:
-        lst: a list of integers
-    Output:
-        ranges: a list of lists, each sublist contains the start and end of a consecutive range
+    The requested data can not be merged with the tmp files (exit code 3 of the script).
     '''
-    
-    if not lst:
-        return []
-    
-    ranges = []
-    start = lst[0]
-    
-    for i in range(1, len(lst)):
-        if lst[i] != lst[i - 1] + 1:
-            ranges.append([start, lst[i - 1]])
-            start = lst[i]
-    
-    ranges.append([start, lst[-1]])  # Append the last range
-    
-    return ranges
 
+class SourceError(CombineError):
+    '''
+    Packets of the requested data have no source capture (no data ID, and not exactly one capture in the file
+    name), nothing is merged and the file is kept for a retry (exit code 3 of the script).
+    '''
+
+# capture name in the requested file names, as request_cost.response_captures
+capture_pattern = r'[A-Z]\d{14}'
+
+# 'test': the last file of ./requested_data/ is merged with every tmp file, as the script was first written.
+# Any other value: the packets are routed to the tmp file of their source capture (route, TmpIndex).
+# This is the default of the script, main_control.py passes 'normal' to combine.
 status = 'test'
 
 IM_mask = lambda x: (x['VCDU'] == 'IM')
@@ -165,97 +68,186 @@ output_IM_folder_path = "./optical/"
 VCDU_image = b'\x55\x40'
 VCDU_HK = b'\x40\x3F'
 
-if status == 'test':
-    tmp_files = glob.glob('./tmp/tmp_*.bin')
-    mock_request = glob.glob('./requested_data/*.bin')
-    requested_data = DF_raw_data(mock_request[-1])
-else:
-    requested_file = sys.argv[1]
-    requested_data = DF_raw_data(requested_file)
-    incomplete_files = list(set(requested_data['ID'])) # assumption
-    tmp_files = []
-    for id in incomplete_files:
-        tmp_files.append(glob.glob(f'./tmp/tmp_*{id}*.bin')[0])
-        if len(tmp_files) == 0:
-            print(f'No tmp file found for {id}')
-            continue
+# data ID of the source capture in the frame header of the re-downloaded packets: (offset after the sync bytes,
+# size), the big-endian UNIX time of the capture as in the request commands (cmd_enc_dec.make_command).
+# It is not in the documented frame layout yet, until then the source is the capture in the requested file name.
+data_id_field = None
 
-try:
-    for file_name in tmp_files:
+class TmpIndex:
+    '''
+    Tmp files by capture name (Fxxx.bin) from one listing of the tmp folder, kept between the calls of combine
+    in the persistent worker (pipeline.py). The folder is listed again only when a capture is not found.
+    '''
+    def __init__(self, folder='./tmp/'):
+        self.folder = folder
+        self.files = {}
 
-        print(f'Processing {file_name}')
-        tmp_data = DF_tmp_data(file_name)
+    def scan(self):
+        self.files = {entry.name[len('tmp_'):]: entry.path for entry in os.scandir(self.folder)
+                      if entry.name.startswith('tmp_') and entry.name.endswith('.bin')}
 
-        IM_range = set(range(0, 16620))
-        try:
-            HK_range = set(range(tmp_data[HK_mask]['PSC'].min(), tmp_data[HK_mask]['PSC'].max()+1)) # if the number of HK is fixed, please change the range 
-        except:
-            HK_range = set(range(800, 8000))
+    def lookup(self, names):
+        '''
+        Tmp file of each capture name, None if there is no tmp file.
+        '''
+        if any(name not in self.files for name in names):
+            self.scan()
+        return {name: self.files.get(name) for name in names}
 
-        # find the missing/bad-quality packets
-        missing_IM = IM_range - set(tmp_data[IM_mask(tmp_data)]['PSC'])
-        missing_HK = HK_range - set(tmp_data[HK_mask(tmp_data)]['PSC'])
-        requested_IM_PSC = requested_data[IM_mask(requested_data)&DQ_mask(requested_data)]['PSC'].isin(missing_IM)
-        requested_HK_PSC = requested_data[HK_mask(requested_data)&DQ_mask(requested_data)]['PSC'].isin(missing_HK)
-        requested_IM = requested_data[IM_mask(requested_data)&DQ_mask(requested_data)][requested_IM_PSC]
-        requested_HK = requested_data[HK_mask(requested_data)&DQ_mask(requested_data)][requested_HK_PSC]
-        # combine the data
-        combined_IM = pd.concat([tmp_data[IM_mask(tmp_data)], requested_IM[['VCDU', 'PSC', 'data']]]).sort_values(by='PSC')
-        combined_HK = pd.concat([tmp_data[HK_mask(tmp_data)], requested_HK[['VCDU', 'PSC', 'data']]]).sort_values(by='PSC')
-        missing_IM = IM_range - set(combined_IM['PSC'])
-        missing_HK = HK_range - set(combined_HK['PSC'])
-        missing_IM = sorted(list(missing_IM))
-        missing_HK = sorted(list(missing_HK))
-        missing_rate_IM = (len(missing_IM)/16621)*100
-        missing_rate_HK = (len(missing_HK)/8000)*100 # 8k is for testing, not real
+    def discard(self, name):
+        self.files.pop(name, None)
 
-        # determine the report file
-        if os.path.isfile('./report/un_gen.csv'):
-            fout_name_incpl = './report/un_gen.csv'
-        else:
-            fout_name_incpl = './report/un_gen.csv'
-            with open(fout_name_incpl, 'w') as f:
-                f.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
-        print(f'Report file: {fout_name_incpl}')
-        if os.path.isfile('./report/final_check.csv'):
-            fout_name_cpl = './report/final_check.csv'
-        else:
-            fout_name_cpl = './report/final_check.csv'
-            with open(fout_name_cpl, 'w') as f:
-                f.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
-        print(f'Report file: {fout_name_cpl}')
+tmp_index = TmpIndex()
 
-        # find the missing segments
-        missing_segment_IM = find_consecutive_ranges(list(missing_IM))
-        missing_segment_HK = find_consecutive_ranges(list(missing_HK))
-        if (len(missing_IM) == 0) and (len(missing_HK) == 0):
-            # no missing packets, save the image data
-            nfiles = len(glob.glob(output_IM_folder_path+'*.bin'))
-            nfiles = str(nfiles).zfill(4)
-            outfile = f'./optical/opt_frame_{nfiles}_{file_name.split("/")[-1][4:]}'  # output file name
-            # write the image data to the optical folder
-            encode_data(outfile, VCDU_image, combined_IM['PSC'], combined_IM['data'], 'wb')
-            # append the HK data to the optical folder
-            encode_data(outfile, VCDU_HK, combined_HK['PSC'], combined_HK['data'], 'ab')
-            # output the report
-            with open(fout_name_cpl, 'a') as f:
-                f.write(f'{file_name.split("/")[-1][4:]},OK,0,0,0\n')
-            os.system(f'rm {file_name}')
-        else:
-            outfile = f'./tmp/{file_name.split("/")[-1]}'
-            # store the incomplete image data. replace the original tmp file
-            encode_data(outfile, VCDU_image, combined_IM['PSC'], combined_IM['data'], 'wb')
-            # append the incomplete HK data
-            encode_data(outfile, VCDU_HK, combined_HK['PSC'], combined_HK['data'], 'ab')
-            # output the report for the missing packets
-            with open(fout_name_incpl, 'a') as f:
+def capture_name(data_id):
+    # same time conversion as cmd_enc_dec.decode_command
+    return f'F{datetime.datetime.fromtimestamp(data_id):%Y%m%d%H%M%S}.bin'
+
+def route(requested_file):
+    '''
+    Parse a requested data file once and give the source capture of each good IM/HK packet.
+    The source is the data ID of the frame header (data_id_field), or the capture in the name of the
+    requested file (capture_pattern, if there is exactly one) for the packets without a data ID.
+    ------Parameters------
+    requested_file: str
+        The requested data file (full path).
+    ------Returns------
+    requested_data: DataFrame
+        VCDU, PSC, DQ, data (as DF_raw_data) and source (Fxxx.bin, None if unknown) of the packets with DQ = 0.
+    '''
+    index = packet_index(requested_file, layout_raw)
+    index = index[((index['VCDU'] == VCDU_ID_image) | (index['VCDU'] == VCDU_ID_HK)) & (index['DQ'] == 0)]
+    names = re.findall(capture_pattern, os.path.basename(requested_file))
+    sources = np.full(len(index), f'{names[0]}.bin' if len(names) == 1 else None, dtype=object)
+    if (data_id_field is not None) and (len(index) > 0):
+        offset, size = data_id_field
+        # header bytes of all the packets at once, the data_start of a raw packet is payload_start after the sync bytes
+        raw = np.frombuffer(open_capture(requested_file), dtype=np.uint8)[(index['data_start'] - payload_start + offset)[:, None] + np.arange(size)]
+        ids = raw.astype(np.int64) @ (256 ** np.arange(size - 1, -1, -1, dtype=np.int64))
+        values, inverse = np.unique(ids, return_inverse=True)
+        names = np.array([capture_name(int(value)) if value > 0 else None for value in values], dtype=object)
+        sources = np.where(ids > 0, names[inverse], sources)
+    requested_data = packet_table(requested_file, index, ['VCDU', 'PSC', 'DQ', 'data'])
+    requested_data['source'] = sources
+    return requested_data
+
+def open_slots(file_name):
+    '''
+    The tmp file as a slot file (mpdu.SlotFile) open for writing. A tmp file of the previous layout (packets
+    in sequence) is converted first, with the ranges used before: IM 0..16619, HK from the first to the
+    last HK packet of the file.
+    '''
+    if not is_slot_file(file_name):
+        tmp_data = DF_tmp_data(file_name)
+        try:
+            HK_range = (tmp_data[HK_mask]['PSC'].min(), tmp_data[HK_mask]['PSC'].max()+1) # if the number of HK is fixed, please change the range
+        except:
+            HK_range = (800, 8000)
+        write_slots(file_name, {VCDU_ID_image: (0, 16620), VCDU_ID_HK: HK_range},
+                    [(VCDU_image, tmp_data[IM_mask(tmp_data)]['PSC'].to_numpy(), tmp_data[IM_mask(tmp_data)]['data'].tolist()),
+                     (VCDU_HK, tmp_data[HK_mask(tmp_data)]['PSC'].to_numpy(), tmp_data[HK_mask(tmp_data)]['data'].tolist())])
+        del tmp_data
+    return SlotFile(file_name, write=True)
+
+def combine(requested_file, mode=None):
+    '''
+    Merge the re-downloaded packets of a requested data file with the tmp files, see the description of the script.
+    ------Parameters------
+    requested_file: str
+        The requested data file (full path). In test mode, the last file of the requested_data folder is used.
+    mode: str
+        'test' or 'normal' (routed to the tmp file of each source capture), default status.
+    ------Raises------
+    CombineError
+        The merge failed, the tmp files that are not processed yet are kept.
+    SourceError
+        Packets without source capture (routed mode), no tmp file is changed.
+    '''
+    if (status if mode is None else mode) == 'test':
+        tmp_files = glob.glob('./tmp/tmp_*.bin')
+        mock_request = glob.glob('./requested_data/*.bin')
+        requested_file = mock_request[-1]
+        requested_data = DF_raw_data(requested_file)
+        remove_index(requested_file) # the file is read once
+        groups = [(file_name, requested_data) for file_name in tmp_files]
+    else:
+        # one pass over the requested file, the packets are grouped by source capture
+        requested_data = route(requested_file)
+        groups = []
+        unknown = requested_data['source'].isna()
+        if unknown.any():
+            raise SourceError(f'No source capture for {int(unknown.sum())} packets of {requested_file}')
+        captures = requested_data[~unknown].groupby('source', sort=True)
+        tmp_files = tmp_index.lookup(list(captures.groups))
+        for name, packets in captures:
+            if tmp_files[name] is None:
+                print(f'No tmp file found for {name}')
+                continue
+            groups.append((tmp_files[name], packets))
+
+    try:
+        for file_name, packets in groups:
+
+            print(f'Processing {file_name}')
+            requested_IM = packets[IM_mask(packets)&DQ_mask(packets)]
+            requested_HK = packets[HK_mask(packets)&DQ_mask(packets)]
+            with open_slots(file_name) as slots:
+                # the re-downloaded packets are written to their empty slots, the rest of the tmp file is not read
+                slots.store(VCDU_ID_image, requested_IM['PSC'].to_numpy(), requested_IM['data'].tolist())
+                slots.store(VCDU_ID_HK, requested_HK['PSC'].to_numpy(), requested_HK['data'].tolist())
+                IM_state = slots.completeness(VCDU_ID_image)
+                HK_state = slots.completeness(VCDU_ID_HK)
+            missing_IM = IM_state.missing().tolist()
+            missing_HK = HK_state.missing().tolist()
+            missing_rate_IM = IM_state.missing_rate(16621)
+            missing_rate_HK = HK_state.missing_rate(8000) # 8k is for testing, not real
+
+            # the report is written to the state store
+            print(f'Report file: {db_name}')
+
+            # find the missing segments
+            missing_segment_IM = IM_state.segments()
+            missing_segment_HK = HK_state.segments()
+            if (len(missing_IM) == 0) and (len(missing_HK) == 0):
+                # no missing packets, save the image data
+                nfiles = len(glob.glob(output_IM_folder_path+'*.bin'))
+                nfiles = str(nfiles).zfill(4)
+                outfile = f'./optical/opt_frame_{nfiles}_{file_name.split("/")[-1][4:]}'  # output file name
+                # write the image data, followed by the HK data, to the optical folder
+                # the file is renamed when complete, main_control.py reads it as soon as it appears
+                tmp_data = DF_tmp_data(file_name)
+                encode_data(outfile + '.part', [(VCDU_image, tmp_data[IM_mask(tmp_data)]['PSC'], tmp_data[IM_mask(tmp_data)]['data']),
+                                                (VCDU_HK, tmp_data[HK_mask(tmp_data)]['PSC'], tmp_data[HK_mask(tmp_data)]['data'])])
+                del tmp_data
+                os.replace(outfile + '.part', outfile)
+                move_index(outfile + '.part', outfile)
+                # output the report
+                open_store().add_rows('final', [(file_name.split("/")[-1][4:], 'OK', 0, 0, 0)])
+                os.system(f'rm {file_name}')
+                remove_index(file_name)
+                tmp_index.discard(file_name.split("/")[-1][4:])
+            else:
+                # output the report for the missing packets, under the capture name as check_data.py (cmd_enc_dec
+                # reads the time of the capture from it)
+                rows = []
                 for segment in missing_segment_IM:
-                    f.write(f'{file_name.split("/")[-1]},IM,{segment[0]},{segment[1]},{missing_rate_IM+missing_rate_HK}\n')
+                    rows.append((file_name.split("/")[-1][4:], 'IM', segment[0], segment[1], missing_rate_IM+missing_rate_HK))
                 for segment in missing_segment_HK:
-                    f.write(f'{file_name.split("/")[-1]},HK,{segment[0]},{segment[1]},{missing_rate_IM+missing_rate_HK}\n')
+                    rows.append((file_name.split("/")[-1][4:], 'HK', segment[0], segment[1], missing_rate_IM+missing_rate_HK))
+                open_store().add_rows('segments', rows)
 
-except Exception as e:
-    # print(f"Error: {e}. Input file unknown.")
-    sys.exit(3)
+    except Exception as e:
+        # print(f"Error: {e}. Input file unknown.")
+        raise CombineError(requested_file) from e
 
-                
\ No newline at end of file
+if __name__ == "__main__":
+    # python combine.py <requested file> [test|normal]
+    requested_file = sys.argv[1] if len(sys.argv)>1 else None
+    try:
+        combine(requested_file, sys.argv[2] if len(sys.argv)>2 else None)
+    except CombineError:
+        sys.exit(3)
+    finally:
+        open_store().export()
+        if requested_file is not None:
+            remove_index(requested_file)
@@ -0,0 +1,125 @@
+'''
+Completeness state of a packet sequence (IM or HK) of one raw data file.
+The state is a boolean array with one slot per expected PSC, instead of python sets of PSC:
+    received: the packet is received
+    bad: a received copy of the packet has DQ != 0
+A packet is present if it is received and has no bad copy (same as set(PSC) - set(bad PSC)
+in the previous check_data.py).
+'''
+
+import numpy as np
+
+class Completeness:
+
+    '''
+    Completeness of the packets with PSC in [start, end), e.g. Completeness(0, 16620) for the
+    image packets, same as set(range(0, 16620)).
+    '''
+
+    def __init__(self, start, end):
+        self.start = int(start)
+        self.end = max(int(end), self.start)
+        self.received = np.zeros(self.end - self.start, dtype=bool)
+        self.bad = np.zeros(self.end - self.start, dtype=bool)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def index(self, PSC):
+
+        '''
+        Slots of the PSC inside the range, the PSC outside the range are dropped.
+        '''
+
+        PSC = np.asarray(PSC, dtype=np.int64)
+        return PSC[(PSC >= self.start) & (PSC < self.end)] - self.start
+
+    def mark(self, PSC, DQ=None):
+
+        '''
+        Mark the packets as received.
+        Input:
+            PSC: array-like of PSC
+            DQ: array-like of DQ of the same packets, the packets with DQ != 0 are marked bad.
+                If not given, all the packets are good.
+        '''
+
+        PSC = np.asarray(PSC, dtype=np.int64)
+        self.received[self.index(PSC)] = True
+        if DQ is not None:
+            self.bad[self.index(PSC[np.asarray(DQ) != 0])] = True
+
+    @property
+    def present(self):
+        return self.received & ~self.bad
+
+    def is_missing(self, PSC):
+
+        '''
+        For each PSC, True if it is in the range and not present.
+        '''
+
+        PSC = np.asarray(PSC, dtype=np.int64)
+        inside = (PSC >= self.start) & (PSC < self.end)
+        missing = np.zeros(len(PSC), dtype=bool)
+        missing[inside] = ~self.present[PSC[inside] - self.start]
+        return missing
+
+    def missing(self):
+
+        '''
+        Sorted array of the missing PSC.
+        '''
+
+        return np.flatnonzero(~self.present) + self.start
+
+    def n_missing(self):
+        return int(len(self) - np.count_nonzero(self.present))
+
+    def missing_rate(self, total):
+
+        '''
+        Missing packets in % of total.
+        '''
+
+        return (self.n_missing()/total)*100
+
+    def segments(self):
+
+        '''
+        Consecutive ranges of missing packets.
+        Output:
+            ranges: a list of lists, each sublist contains the start and end (included) of a missing range
+        '''
+
+        edge = np.diff(np.concatenate(([0], (~self.present).astype(np.int8), [0])))
+        first = np.flatnonzero(edge == 1) + self.start
+        last = np.flatnonzero(edge == -1) - 1 + self.start
+        return np.stack([first, last], axis=1).tolist()
+
+    def crop(self, start, end):
+
+        '''
+        New state for the PSC range [start, end), the slots outside of this range are unknown (not received).
+        '''
+
+        state = Completeness(start, end)
+        lo, hi = max(state.start, self.start), min(state.end, self.end)
+        if lo < hi:
+            state.received[lo - state.start:hi - state.start] = self.received[lo - self.start:hi - self.start]
+            state.bad[lo - state.start:hi - state.start] = self.bad[lo - self.start:hi - self.start]
+        return state
+
+    def merge(self, other):
+
+        '''
+        Combine two states of the same packets (e.g. tmp data and re-downloaded data).
+        A packet is present in the result if it is present in one of them.
+        Output:
+            state: new Completeness over the union of both ranges
+        '''
+
+        state = Completeness(min(self.start, other.start), max(self.end, other.end))
+        for s in (self, other):
+            state.received[s.start - state.start:s.end - state.start] |= s.present
+        return state
@@ -0,0 +1,154 @@
+'''
+Decoder of the housekeeping (HK) packets of a frame.
+The content of a HK payload is declared by hk_fields, the payloads of a frame are decoded at once with a numpy
+structured dtype built from it, instead of a loop over the packets:
+    hk_fields: (name, offset in the payload, numpy format, unit, description) of each field
+    hk_keywords: (FITS keyword, field, reduction over the packets of the frame, comment) for the image header
+The decoded packets are written to the FITS file as a binary table extension (HK), and the keywords to the
+header of the image.
+The HK format of the camera is not known yet: hk_decode is off and the table has the first hk_raw_bytes of
+each payload, not decoded, with only the number of HK packets in the header. hk_fields and hk_keywords below
+are a provisional layout (PROV_* names) for testing the decoder, they are not the camera values; set
+hk_decode when they are replaced by the real format.
+'''
+
+import numpy as np
+from astropy.io import fits
+from mpdu import record_view
+
+hk_decode = False # decode the payloads with hk_fields, off until the HK format is known
+hk_raw_bytes = 24 # bytes of each payload kept in the table when hk_decode is off
+
+# provisional layout, not the camera format
+hk_fields = [
+    ('PROV_OBT', 0, '>u4', '', 'provisional field, bytes 0-3'),
+    ('PROV_OBT_SUB', 4, '>u2', '', 'provisional field, bytes 4-5'),
+    ('PROV_B6', 6, 'u1', '', 'provisional field, byte 6'),
+    ('PROV_B7', 7, 'u1', '', 'provisional field, byte 7'),
+    ('PROV_U8', 8, '>u4', '', 'provisional field, bytes 8-11'),
+    ('PROV_U12', 12, '>u4', '', 'provisional field, bytes 12-15'),
+    ('PROV_I16', 16, '>i2', '', 'provisional field, bytes 16-17'),
+    ('PROV_I18', 18, '>i2', '', 'provisional field, bytes 18-19'),
+    ('PROV_U20', 20, '>u2', '', 'provisional field, bytes 20-21'),
+]
+
+# reductions: 'count' (number of HK packets), 'first' (packet with the lowest PSC), 'min', 'max', 'mean', 'median'
+hk_keywords = [
+    ('HK_N', None, 'count', 'number of HK packets'),
+    ('PRV_OBT0', 'PROV_OBT', 'min', 'provisional, min of bytes 0-3 of the HK packets'),
+    ('PRV_OBT1', 'PROV_OBT', 'max', 'provisional, max of bytes 0-3 of the HK packets'),
+    ('PRV_U12', 'PROV_U12', 'first', 'provisional, bytes 12-15 of the first HK packet'),
+    ('PRV_B6', 'PROV_B6', 'first', 'provisional, byte 6 of the first HK packet'),
+    ('PRV_B7', 'PROV_B7', 'first', 'provisional, byte 7 of the first HK packet'),
+    ('PRV_U8', 'PROV_U8', 'median', 'provisional, median of bytes 8-11'),
+    ('PRV_I16', 'PROV_I16', 'mean', 'provisional, mean of bytes 16-17'),
+    ('PRV_I16X', 'PROV_I16', 'max', 'provisional, max of bytes 16-17'),
+    ('PRV_I18', 'PROV_I18', 'mean', 'provisional, mean of bytes 18-19'),
+    ('PRV_U20', 'PROV_U20', 'median', 'provisional, median of bytes 20-21'),
+]
+
+# hk_decode off: the payloads are kept as bytes, the header has the count only
+raw_fields = [('PAYLOAD', 0, f'({hk_raw_bytes},)u1', '', 'first bytes of the payload, not decoded')]
+raw_keywords = [('HK_N', None, 'count', 'number of HK packets')]
+
+def active_fields():
+    return hk_fields if hk_decode else raw_fields
+
+def active_keywords():
+    return hk_keywords if hk_decode else raw_keywords
+
+reductions = {
+    'first': lambda values: values[0],
+    'min': np.min,
+    'max': np.max,
+    'mean': np.mean,
+    'median': np.median,
+}
+
+def payload_dtype(fields=None):
+
+    '''
+    Structured dtype of the HK payload, the fields at their offsets (default active_fields).
+    '''
+
+    fields = active_fields() if fields is None else fields
+    return np.dtype({
+        'names': [name for name, _, _, _, _ in fields],
+        'formats': [fmt for _, _, fmt, _, _ in fields],
+        'offsets': [offset for _, offset, _, _, _ in fields],
+        'itemsize': max(offset + np.dtype(fmt).itemsize for _, offset, fmt, _, _ in fields),
+    })
+
+def table_dtype(fields=None):
+
+    '''
+    Structured dtype of the decoded table: PSC, then the fields (packed).
+    '''
+
+    fields = active_fields() if fields is None else fields
+    return np.dtype([('PSC', '>i4')] + [(name, fmt) for name, _, fmt, _, _ in fields])
+
+def decode_hk(buf, HK, fields=None):
+
+    '''
+    Decode the HK payloads of a frame.
+    Input:
+        buf: mmap of the raw data or opt_frame file (mpdu.open_capture)
+        HK: index of the HK packets (PSC, data_start, data_end), e.g. from mpdu.packet_index
+        fields: layout of the payload, default active_fields()
+    Output:
+        table: structured array of table_dtype, one row per packet sorted by PSC,
+            the payloads shorter than the layout are dropped
+    '''
+
+    fields = active_fields() if fields is None else fields
+    layout = payload_dtype(fields)
+    starts = HK['data_start']
+    keep = (HK['data_end'] - starts) >= layout.itemsize
+    PSC, starts = HK['PSC'][keep], starts[keep]
+    order = np.argsort(PSC, kind='stable')
+
+    # only the bytes of the layout are copied, from the rows of the fixed-size frames if possible,
+    # else gathered at the offsets of the payloads
+    view, record = record_view(buf, starts, layout.itemsize)
+    if view is not None:
+        raw = view[record[order]]
+    else:
+        raw = np.frombuffer(buf, dtype=np.uint8)[starts[order][:, None] + np.arange(layout.itemsize)]
+    payloads = raw.reshape(-1).view(layout)
+
+    table = np.empty(len(PSC), dtype=table_dtype(fields))
+    table['PSC'] = PSC[order]
+    for name in layout.names:
+        table[name] = payloads[name]
+    return table
+
+def hk_cards(table, keywords=None):
+
+    '''
+    Header keywords of the image from the decoded HK packets (default active_keywords).
+    Output:
+        cards: list of (keyword, value, comment), the reductions of an empty table are skipped except 'count'
+    '''
+
+    keywords = active_keywords() if keywords is None else keywords
+    cards = []
+    for keyword, field, reduction, comment in keywords:
+        if reduction == 'count':
+            cards.append((keyword, len(table), comment))
+        elif len(table) > 0:
+            cards.append((keyword, reductions[reduction](table[field]).item(), comment))
+    return cards
+
+def hk_hdu(table, fields=None):
+
+    '''
+    Binary table extension (EXTNAME = HK) with the decoded HK packets and the units of the fields.
+    '''
+
+    fields = active_fields() if fields is None else fields
+    columns = fits.ColDefs(table)
+    for name, _, _, unit, _ in fields:
+        if unit:
+            columns[name].unit = unit
+    return fits.BinTableHDU.from_columns(columns, name='HK')
@@ -1,8 +1,14 @@
-import time 
+import asyncio
 import datetime
-import os 
-import subprocess
+import os
 import glob
+from pipeline import Pool, Stage
+from check_data import CheckError, commit_check
+from combine import SourceError
+from watcher import watch
+from state import open_store, file_hash
+from request_cost import record_response
+from mpdu import move_index, remove_index
 
 raw_data_folder = "./raw_data/"
 req_data_folder = "./requested_data/"
@@ -10,6 +16,11 @@ img_data_folder = "./optical/"
 log_folder = "./log/"
 archive_raw_folder = "./archive/raw_data/"
 archive_req_folder = "./archive/requested_data/"
+# raw data folders of the other receptions (antennas or passes), a capture has the same file name in each folder,
+# the receptions found are merged with the file of raw_data_folder when it is checked (check_data receptions),
+# a reception that arrives after the check is merged into the slots of the tmp file (reception_file)
+reception_folders = []
+archive_reception_folder = "./archive/receptions/" # one sub-folder per reception folder, by its position
 os.makedirs(log_folder, exist_ok=True)
 os.makedirs(raw_data_folder, exist_ok=True)
 os.makedirs(req_data_folder, exist_ok=True)
@@ -19,140 +30,306 @@ os.makedirs('./img/', exist_ok=True)
 os.makedirs('./tmp/', exist_ok=True)
 os.makedirs(archive_raw_folder, exist_ok=True)
 os.makedirs(archive_req_folder, exist_ok=True)
+for n in range(len(reception_folders)):
+    os.makedirs(os.path.join(archive_reception_folder, str(n)), exist_ok=True)
 
 time_now = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
 nfiles = len(glob.glob(log_folder + "*.log"))
 log_file = log_folder + f"log_{nfiles}_{time_now}.log"
-os.system(f"touch {log_file}")
-
-fout_name_cpl = './report/final_check.csv'
-with open(fout_name_cpl, 'w') as f:
-    f.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
-final_report = './report/report.csv'
-with open(final_report, 'w') as f:
-    f.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
-
-while True:
-    
-    processed_raw_files = set()
-    processed_req_files = set()
-    processed_img_files = set()
-    
-    if os.path.getsize(log_file) > 1e7: # size limit of a report file is ~ 10MB
+
+# the reports are kept in the state store, the csv files in ./report/ are exported from it
+# the journal of the store has the state of every input file, a restart resumes the files where they were
+store = open_store()
+done_states = ('checked', 'tmp-stored', 'combined', 'rendered', 'archived') # the stage is not run again
+
+# the stages run in separate worker processes (the imports are done once), so that a slow image
+# rendering never delays the check of a new pass
+n_check_workers = 1 # raw files checked at the same time
+n_read_workers = 1  # opt_frames read at the same time
+check_pool = Pool(n_check_workers)
+read_pool = Pool(n_read_workers)
+serial_pool = Pool(1) # cmd_gen and combine, one at a time
+queue_size = 4 # files waiting in each stage, the watcher of the folder waits when the queue is full
+# the new files are dispatched as soon as they are complete (closed or moved in), no listdir loop
+watch_timeout = 10 # seconds, cmd_gen.py is called at least this often, and the stage status is logged
+
+def log(message):
+    global log_file
+    if os.path.isfile(log_file) and os.path.getsize(log_file) > 1e7: # size limit of a report file is ~ 10MB
         print('The last log file is too large, create a new one.')
         dt_now = datetime.datetime.now()
         time_now = dt_now.strftime('%Y%m%d%H%M%S')
         nfiles = len(glob.glob(log_folder + "*.log"))
         log_file = log_folder + f"log_{nfiles}_{time_now}.log"
+    with open(log_file, "a") as f:
+        f.write(message + "\n")
+
+# the opt_frames are numbered by the check commits and combine, one at a time
+frames = asyncio.Lock()
+# the checked files are committed in the order they are taken from the queue
+last_commit = None
+# images of the complete captures (check_data.fused) being rendered in read_pool, after their commit
+renders = set()
+
+async def resume(file_path):
+    # state of the file in the journal (None for a new file), a new file is recorded as seen
+    digest = await asyncio.get_running_loop().run_in_executor(None, file_hash, file_path)
+    state = store.last_state(file_path, digest)
+    if state is None:
+        store.record(file_path, digest, 'seen')
+    return digest, state
+
+def delete(file_path, digest):
+    if os.system(f'rm -f {file_path}') == 0:
+        store.record(file_path, digest, 'deleted')
+    remove_index(file_path)
+
+def archive_reception(folder, file, digest):
+    file_path = os.path.join(folder, file)
+    archive = os.path.join(archive_reception_folder, str(reception_folders.index(folder)), file)
+    if os.system(f'mv {file_path} {archive}') == 0:
+        store.record(file_path, digest, 'archived')
+    remove_index(file_path)
+
+async def check_file(file):
+    global last_commit
+    loop = asyncio.get_running_loop()
+    previous, committed = last_commit, loop.create_future()
+    last_commit = committed
+    file_path = os.path.join(raw_data_folder, file)
+    checked = None
+    receptions = {} # the receptions merged by the check: (folder, digest) by path
+    try:
+        digest, state = await resume(file_path)
+        if state == 'error':
+            # the Error line is reported, stopped before deleting the file
+            log(f"Delete {file}, request again.")
+            delete(file_path, digest)
+            return
+        if state in done_states:
+            log(f"{file} is {state} in the journal, not checked again")
+        else:
+            log(f"Checking {file}")
+            try:
+                for folder in reception_folders:
+                    if os.path.isfile(os.path.join(folder, file)):
+                        reception_digest, _ = await resume(os.path.join(folder, file))
+                        receptions[os.path.join(folder, file)] = (folder, reception_digest)
+                checked, error = await check_pool.run("check", file_path, "normal", False, list(receptions)), None
+            except Exception as e:
+                checked, error = None, e
+            if previous is not None:
+                await previous
+            try:
+                async with frames:
+                    if isinstance(error, CheckError) and (error.checked is not None):
+                        # unreadable file, report the Error line
+                        commit_check(error.checked, (file_path, digest, 'error'))
+                    if error is not None:
+                        raise error
+                    commit_check(checked, (file_path, digest, 'checked' if checked.table == 'final' else 'tmp-stored'))
+                for reception_path, (folder, reception_digest) in receptions.items():
+                    store.record(reception_path, reception_digest, 'checked' if checked.table == 'final' else 'tmp-stored')
+                log(f"Finish checking {file}")
+            except Exception as e:
+                log(f"Error for checking {file_path}: {e!r}")
+                log(f"Delete {file}, request again.")
+                delete(file_path, digest)
+                raise
+    finally:
+        committed.set_result(None)
+    # the new lines of un_gen.csv are turned into commands
+    cmd_stage.offer("cmd_gen")
+    # archive right away, the next files are waited for by the watcher
+    log(f"Move {file} to archive")
+    render_path = file_path
+    if os.system(f'mv {raw_data_folder}{file} {archive_raw_folder}{file}') == 0:
+        store.record(file_path, digest, 'archived')
+        render_path = os.path.join(archive_raw_folder, file)
+        move_index(file_path, render_path)
+    if (checked is not None) and (checked.render is not None):
+        # the image of a complete capture is its own job in read_pool, the next check does not wait for it
+        start_render(file, render_path, file_path, digest)
     else:
-        print(f'Write to the log file: {log_file}')
-    
-    # Get new files, not including folders
-    current_raw_files = {f for f in os.listdir(raw_data_folder) if os.path.isfile(os.path.join(raw_data_folder, f))}
-    new_raw_files = current_raw_files - processed_raw_files
-    current_req_files = {f for f in os.listdir(req_data_folder) if os.path.isfile(os.path.join(req_data_folder, f))}
-    new_req_files = current_req_files - processed_req_files
-    current_img_files = {f for f in os.listdir(img_data_folder) if os.path.isfile(os.path.join(img_data_folder, f))}
-    new_img_files = current_img_files - processed_img_files
-
-    for file in sorted(new_raw_files):  # Process in order
-        file_path = os.path.join(raw_data_folder, file)
-        with open(log_file, "a") as f:
-            f.write(f"Checking {file}\n")
+        # the sidecar index is not read again once the file is archived
+        remove_index(file_path)
+    for folder, reception_digest in receptions.values():
+        archive_reception(folder, file, reception_digest)
+    # the receptions that arrived during the check are merged with the tmp file
+    for folder in reception_folders:
+        if os.path.isfile(os.path.join(folder, file)):
+            await reception_stage.put((folder, file))
+
+def start_render(file, render_path, file_path, digest):
+    task = asyncio.create_task(render_file(file, render_path, file_path, digest))
+    renders.add(task)
+    task.add_done_callback(renders.discard)
+
+def resume_renders():
+    # the complete captures committed but not rendered before a stop (check_data.fused) are rendered from the
+    # archive, the ones with an opt_frame are read by read_file
+    for file in store.pending_final():
+        render_path = os.path.join(archive_raw_folder, file)
+        if glob.glob(os.path.join(img_data_folder, f'*_{file}')) or not os.path.isfile(render_path):
+            continue
+        log(f"{file} is not rendered, render it again")
+        start_render(file, render_path, os.path.join(raw_data_folder, file), file_hash(render_path))
+
+async def render_file(file, render_path, file_path, digest):
+    log(f"Rendering {file}")
+    try:
+        await read_pool.run("render", render_path)
+        log(f"Finished compiling image from {file}")
+        # complete file, move the report from final_check.csv to report.csv
+        store.report_final(file, journal=(file_path, digest, 'rendered'))
+    except Exception as e:
+        log(f"Error for rendering {file}: {e!r}")
+        # request the capture again
+        store.report_final(file, (file, 'Error', 65535, 65535, 100), (file_path, digest, 'error'))
+    finally:
+        # the image is made from the index of the check, not needed anymore
+        remove_index(render_path)
+
+async def reception_file(item):
+    # a reception of a capture already checked: its packets fill the empty slots of the tmp file (combine routes
+    # them by the capture in the file name), a complete capture is not changed
+    folder, file = item
+    file_path = os.path.join(folder, file)
+    if (store.capture_status(file) is None) or os.path.isfile(os.path.join(raw_data_folder, file)):
+        # not checked yet, check_file merges it with the capture
+        return
+    digest, state = await resume(file_path)
+    if state in done_states:
+        log(f"{file_path} is {state} in the journal, not merged again")
+    else:
+        log(f"Merge the reception {file_path}")
         try:
-            subprocess.run(["python3", "./check_data.py", file_path], check=True)
-            with open(log_file, "a") as f:
-                f.write(f"Finish checking {file}\n")
-            processed_raw_files.add(file)
+            async with frames:
+                await serial_pool.run("combine", file_path, "normal")
+            store.record(file_path, digest, 'combined')
+            log(f"Finished merging {file_path}")
         except Exception as e:
-            with open(log_file, "a") as f:
-                f.write(f"Error for checking {file_path}: {e}\n")
-                f.write(f"Delete {file}, request again.\n")
-            os.system(f'rm {raw_data_folder}{file}')
-            continue
-            
-    # call cmd_gen.py
-    os.system(
-        f"python3 ./cmd_gen.py"
-    )
-    
-    for file in sorted(new_req_files):  # Process in order
-        file_path = os.path.join(req_data_folder, file)
-        with open(log_file, "a") as f:
-            f.write(f"Extract packets from {file}\n")
+            log(f"Error for merging {file_path}: {e!r}")
+            store.record(file_path, digest, 'error')
+            raise
+    cmd_stage.offer("cmd_gen")
+    log(f"Move {file_path} to archive")
+    archive_reception(folder, file, digest)
+
+async def run_cmd_gen(_):
+    try:
+        await serial_pool.run("cmd_gen")
+    except Exception as e:
+        log(f"Error in cmd_gen: {e!r}")
+        raise
+
+async def combine_file(file):
+    file_path = os.path.join(req_data_folder, file)
+    digest, state = await resume(file_path)
+    if state in done_states:
+        log(f"{file} is {state} in the journal, not extracted again")
+    else:
+        log(f"Extract packets from {file}")
         try:
-            subprocess.run(["python3", "./combine.py", file_path], check=True)
-            with open(log_file, "a") as f:
-                f.write(f"Finished extracting {file}\n")
-            processed_req_files.add(file)
+            async with frames:
+                # routed to the tmp file of each capture of the requested file (not the test mode of combine.py)
+                await serial_pool.run("combine", file_path, "normal")
+            store.record(file_path, digest, 'combined')
+            log(f"Finished extracting {file}")
+        except SourceError as e:
+            # nothing is merged, the file stays in the folder and is extracted again at the next start
+            log(f"Error for extracting {file_path}: {e!r}")
+            log(f"Keep {file} for a retry.")
+            raise
         except Exception as e:
-            with open(log_file, "a") as f:
-                f.write(f"Error for extracting {file_path}: {e}\n")
-                f.write(f"Delete {file}.\n")
-            os.system(f'rm {new_req_files}{file}')
-            continue
-        
-    for file in sorted(new_img_files):  # Process in order, file = opt_frame_n_Fxxx.bin
-        file_path = os.path.join(img_data_folder, file)
-        with open(log_file, "a") as f:
-            f.write(f"Reading {file}\n")
+            log(f"Error for extracting {file_path}: {e!r}")
+            log(f"Delete {file}.")
+            delete(file_path, digest)
+            raise
+    cmd_stage.offer("cmd_gen")
+    log(f"Move {file} to archive")
+    if os.system(f'mv {req_data_folder}{file} {archive_req_folder}{file}') == 0:
+        store.record(file_path, digest, 'archived')
+        remove_index(file_path)
+        # the size of the response calibrates the cost of the requests (cmd_gen)
+        record_response(store, os.path.join(archive_req_folder, file))
+
+async def read_file(file): # file = opt_frame_n_Fxxx.bin
+    # the complete captures are rendered by render_file (check_data.fused), the opt_frames come from combine
+    file_path = os.path.join(img_data_folder, file)
+    digest, state = await resume(file_path)
+    if state in done_states + ('error',):
+        log(f"{file} is {state} in the journal, not read again")
+    else:
+        log(f"Reading {file}")
         try:
-            subprocess.run(["python3", "./read_bin.py", file_path], check=True)
-            with open(log_file, "a") as f:
-                f.write(f"Finished compiling image from {file}\n")
-            processed_img_files.add(file)
-            # complete file, cut the report in final_check.csv to report.csv
-            with open('./report/final_check.csv', 'r') as f1:
-                lines = f1.readlines()
-            # Open report.csv to append the matched line
-            with open('./report/report.csv', 'a') as f2:
-                new_lines = []
-                for line in lines:
-                    if line.split(',')[0] == file.split('_')[-1]:
-                        f2.write(line)  # Append to report.csv
-                    else:
-                        new_lines.append(line)  # Keep other lines
-            # Overwrite final_check.csv with remaining lines
-            with open('./report/final_check.csv', 'w') as f1:
-                f1.writelines(new_lines)
-                
-        except subprocess.CalledProcessError as e:
-            with open(log_file, "a") as f:
-                f.write(f"Error for reading {file_path}: {e}\n")
+            await read_pool.run("read_bin", file_path)
+            log(f"Finished compiling image from {file}")
+            # complete file, move the report from final_check.csv to report.csv
+            store.report_final(file.split('_')[-1], journal=(file_path, digest, 'rendered'))
+        except Exception as e:
+            log(f"Error for reading {file_path}: {e!r}")
             # incomplete file, request again
-            with open('./report/final_check.csv', 'r') as f1:
-                lines = f1.readlines()
-            # Open report.csv to append the matched line
-            with open('./report/report.csv', 'a') as f2:
-                new_lines = []
-                for line in lines:
-                    if line.split(',')[0] == file.split('_')[-1]:
-                        f2.write(f'{file},Error,65535,65535,100\n')  # Append to report.csv
-                    else:
-                        new_lines.append(line)  # Keep other lines
-            # Overwrite final_check.csv with remaining lines
-            with open('./report/final_check.csv', 'w') as f1:
-                f1.writelines(new_lines)
-            
-            with open(log_file, "a") as f:
-                f.write(f"Delete {file}, request again.\n")
-            os.system(f'rm {img_data_folder}{file}')
-                
-            continue
+            store.report_final(file.split('_')[-1], (file, 'Error', 65535, 65535, 100), (file_path, digest, 'error'))
+            log(f"Delete {file}, request again.")
+            delete(file_path, digest)
+            raise
+    log(f"Delete {file}")
+    delete(file_path, digest)
+
+check_stage = Stage("check", check_file, n_check_workers, queue_size)
+cmd_stage = Stage("cmd_gen", run_cmd_gen, 1, 1)
+combine_stage = Stage("combine", combine_file, 1, queue_size)
+read_stage = Stage("read_bin", read_file, n_read_workers, queue_size)
+reception_stage = Stage("reception", reception_file, 1, queue_size)
+stages = [check_stage, cmd_stage, combine_stage, read_stage, reception_stage]
+
+async def watch_folder(folder, stage):
+    # one watcher per folder, a full queue holds back only the files of this folder
+    # the files already in the folder at the start are resumed from their state in the journal
+    loop = asyncio.get_running_loop()
+    watcher = watch([folder])
+    while True:
+        events = await loop.run_in_executor(None, watcher.wait, watch_timeout)
+        for _, file in events:
+            await stage.put(file)
 
-    time.sleep(3)  # Check for new files every x seconds
-    
-    for file in processed_raw_files:
-        with open(log_file, "a") as f:
-            f.write(f"Move {file} to archive\n")
-        os.system(f'mv {raw_data_folder}{file} {archive_raw_folder}{file}')
-    for file in processed_req_files:
-        with open(log_file, "a") as f:
-            f.write(f"Move {file} to archive\n")
-        os.system(f'mv {req_data_folder}{file} {archive_req_folder}{file}')
-    for file in processed_img_files:
-        with open(log_file, "a") as f:
-            f.write(f"Delete {file}\n")
-        os.system(f'rm {img_data_folder}{file}')
-    # print(f'files: {current_files}')
+async def watch_receptions(stage):
+    # the receptions are queued with their folder, a capture has the same file name in each folder
+    loop = asyncio.get_running_loop()
+    watcher = watch(reception_folders)
+    while True:
+        events = await loop.run_in_executor(None, watcher.wait, watch_timeout)
+        for folder, file in events:
+            await stage.put((folder, file))
+
+async def monitor():
+    while True:
+        await asyncio.sleep(watch_timeout)
+        for stage in stages:
+            status = stage.status()
+            line = (f"Stage {status['stage']}: queue {status['depth']}/{status['size']} (max {status['max_depth']}), "
+                    f"done {status['done']}, errors {status['errors']}, mean wait {status['mean_wait']:.2f} s, "
+                    f"mean run {status['mean_run']:.2f} s, max latency {status['max_latency']:.2f} s")
+            print(line)
+            log(line)
+        cmd_stage.offer("cmd_gen")
+        store.export()
+
+async def main():
+    os.system(f"touch {log_file}")
+    print(f'Write to the log file: {log_file}')
+    for stage in stages:
+        stage.start()
+    resume_renders()
+    await asyncio.gather(
+        watch_folder(raw_data_folder, check_stage),
+        watch_folder(req_data_folder, combine_stage),
+        watch_folder(img_data_folder, read_stage),
+        *([watch_receptions(reception_stage)] if reception_folders else []),
+        monitor(),
+    )
 
+if __name__ == "__main__":
+    # the worker processes of the pools import this module again (spawn start method), only the controller runs
+    asyncio.run(main())
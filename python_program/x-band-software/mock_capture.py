@@ -0,0 +1,114 @@
+'''
+This script makes a mock raw data file (MPDU capture) for testing the programs without the receiver.
+------Parameters------
+1. file_name: the name of the mock raw data file (full path).
+    If no input, ./raw_data/F<now>.bin will be created.
+2. missing: fraction of IM/HK packets to drop (default 0)
+3. interval: if given, the file is written in chunks of 64 kB every interval seconds, like the receiver
+------Output------
+1. A raw data file with 16621 IM packets carrying a random 3003x3008 image and 8000 HK packets.
+'''
+
+import datetime
+import os
+import sys
+import time
+import numpy as np
+
+SYNC = b'\x1A\xCF\xFC\x1D'
+VCDU_image = b'\x55\x40'
+VCDU_HK = b'\x40\x3F'
+payload_len = 1088
+n_IM = 16621
+n_HK = 8000
+image_shape = (3003, 3008)
+
+def make_frame(VCDU, PSC, payload, DQ=0, IB=0):
+
+    '''
+    Make one frame (sync bytes + packet) in the raw data layout, see mpdu.py.
+    '''
+
+    head = bytearray(56)
+    head[1] = DQ
+    head[28:30] = VCDU
+    head[30:33] = PSC.to_bytes(3, 'big')
+    head[34] = IB
+    return SYNC + bytes(head) + payload + bytes(160)
+
+def mock_image(seed=0):
+
+    '''
+    Random image with the size of the detector, the last pixel is not 0 so rstrip(b'\\0') keeps it.
+    '''
+
+    rng = np.random.default_rng(seed)
+    image = rng.integers(1, 4096, size=image_shape, dtype=np.uint16)
+    return image
+
+def make_capture(missing=0., bad=0., n_unclassified=6, seed=0, loss_seed=None):
+
+    '''
+    Make the content of a mock raw data file.
+    Input:
+        missing: fraction of IM/HK packets that are dropped
+        bad: fraction of IM/HK packets with DQ != 0
+        n_unclassified: number of frames with an unknown VCDU ID
+        loss_seed: seed of the dropped and bad packets only, for other receptions of the same capture
+    Output:
+        capture: bytes
+        image: the image carried by the IM packets
+    '''
+
+    rng = np.random.default_rng(seed)
+    image = mock_image(seed)
+    data = image.tobytes()
+    data += bytes(n_IM*payload_len - len(data))
+
+    frames = []
+    hk_psc = 0
+    for psc in range(n_IM):
+        frames.append((VCDU_image, psc, data[psc*payload_len:(psc+1)*payload_len]))
+        # HK packets are interleaved with the image packets
+        if (psc % 2 == 1) and (hk_psc < n_HK):
+            frames.append((VCDU_HK, hk_psc, rng.integers(0, 256, payload_len, dtype=np.uint8).tobytes()))
+            hk_psc += 1
+    for k in rng.choice(len(frames), n_unclassified, replace=False):
+        frames.insert(int(k), (b'\x73\x6C', int(rng.integers(0, 2**24)), bytes(payload_len)))
+
+    loss = rng if loss_seed is None else np.random.default_rng(loss_seed)
+    drop = loss.random(len(frames)) < missing
+    DQ = np.where(loss.random(len(frames)) < bad, 31, 0)
+    capture = b''.join(
+        make_frame(VCDU, PSC, payload, int(DQ[k]), 7)
+        for k, (VCDU, PSC, payload) in enumerate(frames) if not drop[k]
+    )
+
+    return capture, image
+
+def write_in_chunks(file_name, capture, chunk=1 << 16, interval=0.01):
+
+    '''
+    Write the capture to a file piece by piece, as the receiver does during a pass.
+    '''
+
+    with open(file_name, 'wb') as f:
+        for k in range(0, len(capture), chunk):
+            f.write(capture[k:k+chunk])
+            f.flush()
+            time.sleep(interval)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        os.makedirs('./raw_data/', exist_ok=True)
+        file_name = f'./raw_data/F{datetime.datetime.now():%Y%m%d%H%M%S}.bin'
+    else:
+        file_name = sys.argv[1]
+    missing = float(sys.argv[2]) if len(sys.argv) > 2 else 0.
+    capture, image = make_capture(missing)
+    if len(sys.argv) > 3:
+        write_in_chunks(file_name, capture, interval=float(sys.argv[3]))
+    else:
+        with open(file_name, 'wb') as f:
+            f.write(capture)
+    print(f'Mock raw data: {file_name}')
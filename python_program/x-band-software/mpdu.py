@@ -0,0 +1,737 @@
+'''
+Shared reader for the MPDU captures (raw data) received from the X-band downlink.
+The raw data is a stream of frames, each one starting with the sync bytes 1ACFFC1D:
+------Frame layout (offsets after the sync bytes)------
+    1      : DQ, data quality flag (0 = good)
+    28-29  : VCDU ID, 5540 for image (IM) and 403F for housekeeping (HK)
+    30-32  : PSC, 24-bit packet sequence count
+    34     : IB
+    56:-160: payload
+The header fields of all frames are decoded at once with a structured dtype instead of
+looping over the packets in python.
+The files are memory-mapped and the payloads are memoryview slices of the mapping, so the
+data is only copied when it is written out.
+The tmp and opt_frame files written by encode_data (write_packets) have a shorter layout:
+    sync bytes + VCDU ID (2) + PSC (3) + payload
+The packet headers and payload offsets of every file read are kept in a binary sidecar index
+(./index/<file name>.idx), so the next stage reading the same file does not parse it again.
+The index is valid as long as the size and modification time of the file are unchanged.
+The tmp file of an incomplete capture is a slot file (SlotFile, write_slots): one fixed-size slot per
+expected PSC and a bitmap of the slots filled, the retransmitted packets are written in place.
+packet_index reads its packets from the bitmap, the file is not parsed.
+'''
+
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import numpy as np
+import pandas as pd
+from completeness import Completeness
+
+SYNC = b'\x1A\xCF\xFC\x1D'
+VCDU_image = b'\x55\x40'
+VCDU_HK = b'\x40\x3F'
+
+# fields of the frame header, offsets are counted after the sync bytes
+header_dtype = np.dtype({
+    'names': ['DQ', 'VCDU', 'PSC', 'IB'],
+    'formats': ['u1', '>u2', ('u1', 3), 'u1'],
+    'offsets': [1, 28, 30, 34],
+    'itemsize': 35,
+})
+payload_start = 56
+payload_trailer = 160
+
+# fields of the tmp/opt_frame packets written by encode_data
+tmp_header_dtype = np.dtype({
+    'names': ['VCDU', 'PSC'],
+    'formats': ['>u2', ('u1', 3)],
+    'offsets': [0, 2],
+    'itemsize': 5,
+})
+
+VCDU_ID_image = int.from_bytes(VCDU_image, 'big')
+VCDU_ID_HK = int.from_bytes(VCDU_HK, 'big')
+
+# packet index: headers and payload position of every packet in a file, one sidecar per file path and bounds
+# function (index_name)
+index_folder = './index/'
+index_dtype = np.dtype([('VCDU', np.uint16), ('PSC', np.int64), ('IB', np.int64), ('DQ', np.int64),
+                        ('data_start', np.int64), ('data_end', np.int64)])
+# on disk: magic, layout, file size, file mtime (ns), number of packets, then the records
+index_head = struct.Struct('<8sBQqQ')
+index_record = np.dtype([('VCDU', '<u2'), ('DQ', 'u1'), ('IB', 'u1'), ('PSC', '<u4'), ('offset', '<u8'), ('length', '<u4')])
+index_magic = b'MPDUIDX1'
+layout_raw, layout_tmp = 0, 1
+
+# slot file: magic, then for the IM and HK packets: payload length, PSC of the first slot, number of slots,
+# expected PSC range (start, end), then the bitmaps and the slots (aligned to the pages)
+slot_magic = b'MPDUSLT1'
+slot_head = struct.Struct('<8s10q')
+slot_align = 4096
+slot_types = (VCDU_ID_image, VCDU_ID_HK)
+SlotRange = collections.namedtuple('SlotRange', ['length', 'first', 'n', 'start', 'end', 'bitmap', 'data'])
+
+def open_capture(file_name):
+
+    '''
+    Map a file read-only into memory.
+    Input:
+        file_name: str
+    Output:
+        buf: memoryview of the mapped file, slicing it does not copy the data.
+            The mapping is released when the last slice is deleted.
+    '''
+
+    with open(file_name, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b'')
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return memoryview(mm)
+
+def find_sync(buf, sync_bytes=SYNC, chunk=1 << 22):
+
+    '''
+    Find the offsets of all the sync bytes in a buffer.
+    The sync bytes can not overlap with themselves, so the result is the same as bytes.split().
+    The buffer is scanned in chunks to keep the temporary arrays small.
+    Input:
+        buf: bytes-like object
+        sync_bytes: the 4 sync bytes
+        chunk: number of bytes scanned at once
+    Output:
+        sync_pos: int64 array, offset of the first byte of every sync marker
+    '''
+
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    n = len(arr) - len(sync_bytes) + 1
+    found = [np.zeros(0, dtype=np.int64)]
+
+    for offset in range(0, max(n, 0), chunk):
+        # candidates from the first byte, then check the other bytes only on the candidates
+        sync_pos = np.flatnonzero(arr[offset:min(offset + chunk, n)] == sync_bytes[0]) + offset
+        for k in range(1, len(sync_bytes)):
+            sync_pos = sync_pos[arr[sync_pos + k] == sync_bytes[k]]
+        found.append(sync_pos.astype(np.int64))
+
+    return np.concatenate(found)
+
+def packet_bounds(buf, sync_bytes=SYNC):
+
+    '''
+    Locate the packets in a buffer, a packet is the data between two sync markers.
+    Input:
+        buf: bytes-like object
+    Output:
+        starts: int64 array, offset of the first byte after each sync marker
+        ends: int64 array, offset of the next sync marker (or the end of the buffer)
+    '''
+
+    sync_pos = find_sync(buf, sync_bytes)
+    starts = sync_pos + len(sync_bytes)
+    ends = np.append(sync_pos[1:], len(buf)).astype(np.int64)
+
+    return starts, ends
+
+def strided_bounds(buf, sync_bytes=SYNC, window=1 << 16):
+
+    '''
+    Locate the packets assuming all the frames have the same length, which is the case for a
+    normal capture. The frame length is taken from the first two sync markers and only the sync
+    bytes at the expected positions are checked, so the payloads are not scanned.
+    A sync pattern inside a payload is not treated as a packet boundary, unlike packet_bounds.
+    If a sync marker is not at its expected position, packet_bounds is used instead.
+    Input:
+        buf: bytes-like object
+    Output:
+        starts, ends: same as packet_bounds
+    '''
+
+    head = find_sync(buf[:window], sync_bytes)
+    if len(head) < 2:
+        return packet_bounds(buf, sync_bytes)
+
+    stride = int(head[1] - head[0])
+    sync_pos = np.arange(head[0], len(buf) - len(sync_bytes) + 1, stride, dtype=np.int64)
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    marker = arr[sync_pos[:, None] + np.arange(len(sync_bytes))]
+    if not (marker == np.frombuffer(sync_bytes, dtype=np.uint8)).all():
+        return packet_bounds(buf, sync_bytes)
+
+    starts = sync_pos + len(sync_bytes)
+    ends = np.append(sync_pos[1:], len(buf)).astype(np.int64)
+
+    return starts, ends
+
+def decode_headers(buf, starts, ends, dtype=header_dtype):
+
+    '''
+    Decode the header of every packet in one pass.
+    If all the packets have the same length (fixed stride), the headers are viewed directly
+    from the buffer, otherwise the header bytes are gathered first.
+    Packets shorter than the header are left zero (unclassified).
+    Input:
+        buf: bytes-like object
+        starts, ends: output of packet_bounds
+        dtype: header_dtype for raw data, tmp_header_dtype for tmp/opt_frame files
+    Output:
+        headers: structured array of index_dtype with the fields VCDU, PSC, IB, DQ filled (PSC is
+            decoded to int, IB and DQ are 0 for tmp/opt_frame files)
+    '''
+
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    n = len(starts)
+    size = dtype.itemsize
+    full = (ends - starts) >= size
+
+    stride = np.diff(starts)
+    if n > 1 and full.all() and (stride == stride[0]).all():
+        # fixed stride: view the headers from the buffer without copying
+        raw = np.ndarray((n,), dtype=dtype, buffer=arr, offset=int(starts[0]), strides=(int(stride[0]),))
+    else:
+        raw = np.zeros(n, dtype=dtype)
+        idx = starts[full][:, None] + np.arange(size)
+        raw[full] = arr[idx].view(dtype)[:, 0]
+
+    psc = raw['PSC'].astype(np.int64)
+    headers = np.zeros(n, dtype=index_dtype)
+    headers['VCDU'] = np.where(full, raw['VCDU'], 0)
+    headers['PSC'] = (psc[:, 0] << 16) | (psc[:, 1] << 8) | psc[:, 2]
+    for name in ('IB', 'DQ'):
+        if name in dtype.names:
+            headers[name] = raw[name]
+
+    return headers
+
+def packet_index(file_name, layout, bounds=packet_bounds):
+
+    '''
+    Headers and payload positions of all the packets of a file, from the sidecar index if it is
+    valid, otherwise the file is parsed and the index is written.
+    Input:
+        file_name: str
+        layout: layout_raw for raw data, layout_tmp for tmp/opt_frame files
+        bounds: packet_bounds, or strided_bounds for a header-only scan of raw data
+    Output:
+        index: structured array of index_dtype
+    '''
+
+    if (layout == layout_tmp) and is_slot_file(file_name):
+        with SlotFile(file_name) as slots:
+            return slots.index()
+    index = load_index(file_name, layout, bounds)
+    if index is not None:
+        return index
+
+    buf = open_capture(file_name)
+    starts, ends = bounds(buf)
+    if layout == layout_raw:
+        index = decode_headers(buf, starts, ends)
+        # same as packet[56:-160]
+        index['data_start'] = starts + payload_start
+        index['data_end'] = np.maximum(ends - payload_trailer, index['data_start'])
+    else:
+        index = decode_headers(buf, starts, ends, tmp_header_dtype)
+        # same as packet[5:]
+        index['data_start'] = starts + tmp_header_dtype.itemsize
+        index['data_end'] = np.maximum(ends, index['data_start'])
+    save_index(file_name, layout, index, bounds)
+
+    return index
+
+def record_view(buf, starts, length):
+
+    '''
+    Payloads at a constant step in the file (the fixed-size frames of the raw data and of the tmp/opt_frame
+    files) as the rows of a strided view of the mapped file, nothing is copied.
+    Input:
+        buf: mmap or bytes of the file
+        starts: offsets of the payloads, increasing
+        length: bytes of each payload
+    Output:
+        view: uint8 array of shape (records, length), the row k starts at starts[0] + k * step
+        record: row of each payload in the view
+        (None, None) if the payloads are not at multiples of one step
+    '''
+
+    steps = np.diff(starts)
+    step = int(steps.min()) if len(steps) > 0 else length
+    if (len(starts) == 0) or (step < length) or ((starts - starts[0]) % step).any():
+        return None, None
+    record = (starts - starts[0]) // step
+    src = np.frombuffer(buf, dtype=np.uint8)
+    view = np.lib.stride_tricks.as_strided(src[starts[0]:], shape=(int(record[-1]) + 1, length), strides=(step, 1))
+    return view, record
+
+def DF_raw_data(file_name):
+
+    '''
+    Read the raw data file and return a DataFrame containing the header information.
+    Only the IM and HK packets are kept.
+    Input:
+        file_name: str
+            The name of the raw data file.
+    Output:
+        dataDF: DataFrame
+            The DataFrame containing the header information.
+            The data column holds memoryviews of the mapped file (no copy).
+    '''
+
+    index = packet_index(file_name, layout_raw)
+    return packet_table(file_name, index, ['VCDU', 'PSC', 'IB', 'DQ', 'data'])
+
+def DF_tmp_data(file_name):
+
+    '''
+    Read the tmp data file (or opt_frame file) and return a DataFrame containing the header information.
+    Input:
+        file_name: str
+            The name of the tmp data file.
+    Output:
+        dataDF: DataFrame
+            The DataFrame containing the header information.
+            The data column holds memoryviews of the mapped file (no copy).
+    '''
+
+    index = packet_index(file_name, layout_tmp)
+    return packet_table(file_name, index, ['VCDU', 'PSC', 'data'])
+
+def scan_headers(file_name):
+
+    '''
+    Header-only scan of a raw data file for the completeness check.
+    Only the header bytes of each frame are read (see strided_bounds), the payloads are not
+    touched until load_payloads is called.
+    Input:
+        file_name: str
+            The name of the raw data file.
+    Output:
+        headerDF: DataFrame
+            Same as DF_raw_data, but the data column is replaced by the offsets of the payloads
+            in the file (data_start, data_end).
+    '''
+
+    index = packet_index(file_name, layout_raw, strided_bounds)
+    return packet_table(file_name, index, ['VCDU', 'PSC', 'IB', 'DQ', 'data_start', 'data_end'])
+
+def load_payloads(file_name, headerDF):
+
+    '''
+    Payloads of the packets listed by scan_headers.
+    Input:
+        file_name: str, or the list of the receptions for the packets of scan_receptions
+        headerDF: DataFrame with the data_start and data_end columns (and source)
+    Output:
+        data: Series of memoryviews of the mapped file, with the index of headerDF
+    '''
+
+    data_start, data_end = headerDF['data_start'].tolist(), headerDF['data_end'].tolist()
+    if 'source' in headerDF:
+        # packets of several receptions (scan_receptions), file_name is the list of the receptions
+        bufs = [open_capture(name) for name in file_name]
+        return pd.Series([bufs[k][s:e] for k, s, e in zip(headerDF['source'].tolist(), data_start, data_end)],
+                         index=headerDF.index, dtype='object')
+    buf = open_capture(file_name)
+
+    return pd.Series([buf[s:e] for s, e in zip(data_start, data_end)], index=headerDF.index, dtype='object')
+
+def select_best(index, reception):
+
+    '''
+    One packet per PSC of each packet type from the packets of several receptions of a capture: the packet
+    with DQ = 0, or the lowest DQ if no copy is clean, from the first reception on a tie.
+    Input:
+        index: structured array of index_dtype, the packets of all the receptions
+        reception: number of the reception of each packet
+    Output:
+        best: positions in index of the packets kept, sorted by VCDU and PSC
+    '''
+
+    order = np.lexsort((reception, index['DQ'], index['PSC'], index['VCDU']))
+    VCDU, PSC = index['VCDU'][order], index['PSC'][order]
+    # the first packet of each (VCDU, PSC) run is the best one
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (VCDU[1:] != VCDU[:-1]) | (PSC[1:] != PSC[:-1])
+    return order[first]
+
+def scan_receptions(file_names):
+
+    '''
+    Header-only scan of several receptions of the same capture (antennas or passes), merged to one packet
+    per PSC (select_best) before the completeness check.
+    Input:
+        file_names: list of str
+            The raw data files of the receptions.
+    Output:
+        headerDF: DataFrame
+            Same as scan_headers, with the column source: the reception of each packet (position in
+            file_names), for load_payloads(file_names, headerDF).
+    '''
+
+    indexes = [packet_index(name, layout_raw, strided_bounds) for name in file_names]
+    index = np.concatenate(indexes)
+    reception = np.repeat(np.arange(len(indexes)), [len(part) for part in indexes])
+    keep = (index['VCDU'] == VCDU_ID_image) | (index['VCDU'] == VCDU_ID_HK)
+    index, reception = index[keep], reception[keep]
+    best = select_best(index, reception)
+    headerDF = packet_table(None, index[best], ['VCDU', 'PSC', 'IB', 'DQ', 'data_start', 'data_end'])
+    headerDF['source'] = reception[best]
+    return headerDF
+
+def packet_table(file_name, index, columns):
+
+    '''
+    Build the DataFrame of the IM and HK packets, the other packets are dropped.
+    The file is only mapped if the data column is requested.
+    '''
+
+    is_im = index['VCDU'] == VCDU_ID_image
+    keep = is_im | (index['VCDU'] == VCDU_ID_HK)
+    index, is_im = index[keep], is_im[keep]
+
+    dataDF = pd.DataFrame({
+        'VCDU': np.where(is_im, 'IM', 'HK'),
+        'PSC': index['PSC'],
+        'IB': index['IB'],
+        'DQ': index['DQ'],
+        'data_start': index['data_start'],
+        'data_end': index['data_end'],
+    })
+    if 'data' in columns:
+        dataDF['data'] = load_payloads(file_name, dataDF)  # Preserve binary data
+
+    return dataDF[columns]
+
+def index_name(file_name, bounds=None):
+
+    '''
+    Sidecar index of a file: the same name in another folder, or the packets found by another bounds function
+    (packet_bounds or strided_bounds, default packet_bounds) have their own index.
+    '''
+
+    path = hashlib.sha1(os.fsencode(os.path.abspath(file_name))).hexdigest()[:16]
+    return os.path.join(index_folder, f'{os.path.basename(file_name)}.{path}.{(bounds or packet_bounds).__name__}.idx')
+
+def save_index(file_name, layout, index, bounds=None):
+
+    '''
+    Write the sidecar index of a file. The index is only a cache, so errors are ignored.
+    Input:
+        file_name: str
+        layout: layout_raw or layout_tmp
+        index: structured array of index_dtype
+        bounds: the bounds function of the index, see index_name
+    '''
+
+    try:
+        st = os.stat(file_name)
+        records = np.zeros(len(index), dtype=index_record)
+        for name in ('VCDU', 'DQ', 'IB', 'PSC'):
+            records[name] = index[name]
+        records['offset'] = index['data_start']
+        records['length'] = index['data_end'] - index['data_start']
+
+        os.makedirs(index_folder, exist_ok=True)
+        out = index_name(file_name, bounds)
+        with open(out + '.part', 'wb') as f:
+            f.write(index_head.pack(index_magic, layout, st.st_size, st.st_mtime_ns, len(records)))
+            f.write(records.tobytes())
+        os.replace(out + '.part', out)
+    except OSError:
+        pass
+
+def load_index(file_name, layout, bounds=None, check=True):
+
+    '''
+    Read the sidecar index of a file.
+    Input:
+        file_name: str
+        layout: layout_raw or layout_tmp
+        bounds: the bounds function of the index, see index_name
+        check: compare the size and modification time of the file with the ones in the index
+    Output:
+        index: structured array of index_dtype, or None if there is no valid index
+    '''
+
+    try:
+        with open(index_name(file_name, bounds), 'rb') as f:
+            magic, idx_layout, size, mtime_ns, n = index_head.unpack(f.read(index_head.size))
+            records = np.frombuffer(f.read(), dtype=index_record)
+        st = os.stat(file_name)
+    except (OSError, struct.error, ValueError):
+        return None
+
+    if (magic != index_magic) or (idx_layout != layout) or (len(records) != n):
+        return None
+    if check and ((st.st_size != size) or (st.st_mtime_ns != mtime_ns)):
+        return None
+
+    index = np.zeros(n, dtype=index_dtype)
+    for name in ('VCDU', 'DQ', 'IB', 'PSC'):
+        index[name] = records[name]
+    index['data_start'] = records['offset']
+    index['data_end'] = records['offset'] + records['length']
+
+    return index
+
+def move_index(src, dst):
+
+    '''
+    Follow a file renamed with os.replace or mv (the size and modification time are kept).
+    '''
+
+    for bounds in (packet_bounds, strided_bounds):
+        try:
+            os.replace(index_name(src, bounds), index_name(dst, bounds))
+        except OSError:
+            pass
+
+def remove_index(file_name):
+    for bounds in (packet_bounds, strided_bounds):
+        try:
+            os.remove(index_name(file_name, bounds))
+        except OSError:
+            pass
+
+def write_packets(file_name, blocks, sync_bytes=SYNC):
+
+    '''
+    Write a tmp/opt_frame file (sync bytes + VCDU ID + PSC + payload for each packet) with one open and
+    one write, and save its index, so the file does not need to be parsed by the next stage.
+    When all the payloads have the same length (the normal case), each payload is copied once, straight into
+    its row of one array of fixed-size records; otherwise the headers and the payloads are joined into one buffer.
+    Input:
+        file_name: str
+        blocks: list of (VCDU, PSC, data) in the order of the file, one per packet type
+            VCDU: bytes, VCDU ID of the packets
+            PSC: array or list of the packet sequence counts
+            data: list of the payloads (bytes or memoryviews)
+        sync_bytes: bytes written before each packet
+    '''
+
+    VCDU = np.concatenate([np.full(len(PSC), int.from_bytes(ID, 'big'), dtype=np.uint16) for ID, PSC, _ in blocks])
+    PSC = np.concatenate([np.asarray(PSC, dtype=np.int64).reshape(-1) for _, PSC, _ in blocks])
+    payloads = [payload for _, _, data in blocks for payload in data]
+    n = len(payloads)
+    lengths = np.fromiter(map(len, payloads), dtype=np.int64, count=n)
+
+    # sync bytes + VCDU ID + 24-bit PSC of all the packets
+    head_size = len(sync_bytes) + tmp_header_dtype.itemsize
+    fields = np.zeros(n, dtype=tmp_header_dtype)
+    fields['VCDU'] = VCDU
+    fields['PSC'] = np.stack([(PSC >> 16) & 0xFF, (PSC >> 8) & 0xFF, PSC & 0xFF], axis=1)
+    heads = np.empty((n, head_size), dtype=np.uint8)
+    heads[:, :len(sync_bytes)] = np.frombuffer(sync_bytes, dtype=np.uint8)
+    heads[:, len(sync_bytes):] = fields.view(np.uint8).reshape(n, tmp_header_dtype.itemsize)
+
+    if (n > 0) and (lengths == lengths[0]).all():
+        size = head_size + int(lengths[0])
+        records = np.empty((n, size), dtype=np.uint8)
+        records[:, :head_size] = heads
+        flat = memoryview(records.reshape(-1))
+        for k, payload in enumerate(payloads):
+            flat[k*size + head_size:(k + 1)*size] = payload
+        out = records
+    else:
+        head_bytes = memoryview(heads.tobytes())
+        out = b''.join(piece for k in range(n) for piece in (head_bytes[k*head_size:(k+1)*head_size], payloads[k]))
+    with open(file_name, 'wb') as f:
+        f.write(out)
+
+    index = np.zeros(n, dtype=index_dtype)
+    index['VCDU'] = VCDU
+    index['PSC'] = PSC
+    index['data_start'] = np.cumsum(head_size + lengths) - lengths
+    index['data_end'] = index['data_start'] + lengths
+    save_index(file_name, layout_tmp, index)
+
+def is_slot_file(file_name):
+    try:
+        with open(file_name, 'rb') as f:
+            return f.read(len(slot_magic)) == slot_magic
+    except OSError:
+        return False
+
+def slot_ranges(ranges, lengths):
+
+    '''
+    Layout of a slot file.
+    Input:
+        ranges: {VCDU ID: (first PSC of the slots, number of slots, expected start, expected end)}
+        lengths: {VCDU ID: payload length}
+    Output:
+        types: {VCDU ID: SlotRange}, in the order of slot_types
+        size: size of the file
+    '''
+
+    offset = slot_head.size
+    bitmaps = {}
+    for ID in slot_types:
+        bitmaps[ID] = offset
+        offset += -(-ranges[ID][1] // 8)
+    data = -(-offset // slot_align) * slot_align
+    types = {}
+    for ID in slot_types:
+        first, n, start, end = ranges[ID]
+        types[ID] = SlotRange(lengths[ID], first, n, start, end, bitmaps[ID], data)
+        data += n * lengths[ID]
+    return types, data
+
+class SlotFile:
+
+    '''
+    Slot file of an incomplete capture, mapped read-only or read/write:
+        header (slot_head), one bitmap per packet type (bit k of byte k//8 is set when the slot k is filled),
+        then the slots of the IM packets and of the HK packets: the slot k holds the payload of the packet
+        with PSC = first + k.
+    Writing a packet costs one slot and one bit, the rest of the file is not read.
+    Only the payloads of the slot length are stored, the others stay missing and are requested again.
+    '''
+
+    def __init__(self, file_name, write=False):
+        self.file_name = file_name
+        with open(file_name, 'r+b' if write else 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if write else mmap.ACCESS_READ)
+        fields = slot_head.unpack_from(self.mm)
+        if fields[0] != slot_magic:
+            self.mm.close()
+            raise ValueError(f'{file_name} is not a slot file')
+        values = dict(zip(slot_types, (fields[1:6], fields[6:11])))
+        self.types, _ = slot_ranges({ID: values[ID][1:] for ID in slot_types}, {ID: values[ID][0] for ID in slot_types})
+
+    def bitmap(self, ID):
+        slot = self.types[ID]
+        return np.frombuffer(self.mm, dtype=np.uint8, count=-(-slot.n // 8), offset=slot.bitmap)
+
+    def slots(self, ID):
+        slot = self.types[ID]
+        return np.frombuffer(self.mm, dtype=np.uint8, count=slot.n*slot.length, offset=slot.data).reshape(slot.n, slot.length)
+
+    def filled(self, ID):
+
+        '''
+        PSC of the filled slots, increasing.
+        '''
+
+        slot = self.types[ID]
+        return np.flatnonzero(np.unpackbits(self.bitmap(ID), count=slot.n, bitorder='little')) + slot.first
+
+    def store(self, ID, PSC, data):
+
+        '''
+        Write packets to their empty slot and set their bits, the filled slots are not changed.
+        Input:
+            ID: VCDU ID of the packets (VCDU_ID_image or VCDU_ID_HK)
+            PSC: array of the PSC
+            data: list of the payloads, the payloads of another length than the slots are not stored
+        Output:
+            n: number of packets stored
+        '''
+
+        slot = self.types[ID]
+        PSC = np.asarray(PSC, dtype=np.int64).reshape(-1)
+        lengths = np.fromiter(map(len, data), dtype=np.int64, count=len(data))
+        pos = PSC - slot.first
+        keep = (pos >= 0) & (pos < slot.n) & (lengths == slot.length)
+        # first copy of each PSC, only in the empty slots
+        first = np.zeros(len(PSC), dtype=bool)
+        first[np.unique(np.where(keep, pos, -1), return_index=True)[1]] = True
+        keep &= first
+        bitmap = self.bitmap(ID)
+        keep[keep] = ((bitmap[pos[keep] >> 3] >> (pos[keep] & 7)) & 1) == 0
+        if not keep.any():
+            return 0
+
+        pos = pos[keep]
+        self.slots(ID)[pos] = np.frombuffer(b''.join(data[k] for k in np.flatnonzero(keep).tolist()),
+                                            dtype=np.uint8).reshape(len(pos), slot.length)
+        # the bits are set once the payloads are written, the pages are written back by the OS as for write()
+        np.bitwise_or.at(bitmap, pos >> 3, (1 << (pos & 7)).astype(np.uint8))
+        return len(pos)
+
+    def completeness(self, ID):
+
+        '''
+        Completeness of the expected PSC range of the packet type, from the bitmap.
+        '''
+
+        slot = self.types[ID]
+        state = Completeness(slot.start, slot.end)
+        state.mark(self.filled(ID))
+        return state
+
+    def index(self):
+
+        '''
+        Packets of the filled slots, IM then HK, as packet_index.
+        '''
+
+        parts = []
+        for ID in slot_types:
+            slot = self.types[ID]
+            PSC = self.filled(ID)
+            part = np.zeros(len(PSC), dtype=index_dtype)
+            part['VCDU'] = ID
+            part['PSC'] = PSC
+            part['data_start'] = slot.data + (PSC - slot.first) * slot.length
+            part['data_end'] = part['data_start'] + slot.length
+            parts.append(part)
+        return np.concatenate(parts)
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def write_slots(file_name, ranges, blocks):
+
+    '''
+    Write the slot file of an incomplete capture, the file is renamed when complete.
+    The slots cover the expected range and the PSC of the packets, the file is sparse: only the filled slots
+    use disk space.
+    Input:
+        file_name: str
+        ranges: {VCDU ID: (start, end)}, expected PSC range [start, end) of each packet type
+        blocks: list of (VCDU, PSC, data) as write_packets, the first copy of each PSC is stored
+    '''
+
+    packets = {ID: (np.zeros(0, dtype=np.int64), []) for ID in slot_types}
+    for VCDU, PSC, data in blocks:
+        ID = int.from_bytes(VCDU, 'big')
+        packets[ID] = (np.concatenate([packets[ID][0], np.asarray(PSC, dtype=np.int64).reshape(-1)]), packets[ID][1] + list(data))
+
+    # the slot length is the most frequent payload length of the type
+    lengths = {}
+    for ID in slot_types:
+        values, counts = np.unique(np.fromiter(map(len, packets[ID][1]), dtype=np.int64), return_counts=True)
+        lengths[ID] = int(values[np.argmax(counts)]) if len(values) > 0 else 0
+    for ID in slot_types:
+        if lengths[ID] == 0:
+            lengths[ID] = max(lengths.values())
+    layout = {}
+    for ID in slot_types:
+        start, end = ranges[ID]
+        PSC = packets[ID][0]
+        first = min(int(start), int(PSC.min())) if len(PSC) > 0 else int(start)
+        last = max(int(end), int(PSC.max()) + 1) if len(PSC) > 0 else int(end)
+        layout[ID] = (first, last - first, int(start), int(end))
+    _, size = slot_ranges(layout, lengths)
+
+    fields = [slot_magic]
+    for ID in slot_types:
+        fields += [lengths[ID]] + list(layout[ID])
+    with open(file_name + '.part', 'wb') as f:
+        f.write(slot_head.pack(*fields))
+        f.truncate(size)
+    with SlotFile(file_name + '.part', write=True) as slots:
+        for ID in slot_types:
+            slots.store(ID, *packets[ID])
+    os.replace(file_name + '.part', file_name)
+    remove_index(file_name)
@@ -0,0 +1,159 @@
+'''
+Persistent workers for the processing stages of main_control.py.
+The stages (check_data, cmd_gen, combine, read_bin and its render_raw) are imported once, in child processes that are
+kept alive between the files, instead of starting a new python3 (and importing pandas/astropy again) per file.
+A stage that fails raises its exception in the controller, like the exit code of the script:
+    check_data.CheckError (exit 1), combine.CombineError (exit 3), read_bin.ReadBinError (exit 4).
+If a child process dies (e.g. killed by the OS), WorkerError is raised and new children are started.
+Pool runs the independent files (check, read_bin) in several worker processes, main_control.py commits the
+results in the order of the files so that the reports are the same as with one worker.
+Stage is one step of the asyncio pipeline of main_control.py: a bounded queue of files and tasks taking
+them, with the queue depth and the latency of the stage.
+'''
+
+import asyncio
+import concurrent.futures
+import time
+import check_data
+import cmd_gen
+import combine
+import read_bin
+
+stages = {
+    'check': check_data.check_data,
+    'cmd_gen': cmd_gen.main,
+    'combine': combine.combine,
+    'read_bin': read_bin.read_bin,
+    'render': read_bin.render_raw,
+}
+
+class WorkerError(Exception):
+    '''
+    The worker process stopped while running a stage.
+    '''
+
+def run_stage(stage, *args):
+    return stages[stage](*args)
+
+class Pool:
+
+    '''
+    Worker processes running the stages on several files at the same time.
+    '''
+
+    def __init__(self, n_workers):
+        self.n_workers = n_workers
+        self.executor = concurrent.futures.ProcessPoolExecutor(n_workers)
+
+    async def run(self, stage, *args):
+
+        '''
+        Run a stage in one of the workers, without blocking the event loop.
+        '''
+
+        executor = self.executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, run_stage, stage, *args)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            self.restart(executor)
+            raise WorkerError(f'worker stopped during {stage}{args}') from e
+
+    def restart(self, executor):
+        # a worker process died, the pool can not be used anymore
+        if executor is self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.n_workers)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Stage:
+
+    '''
+    Step of the asyncio pipeline: files wait in a bounded queue and n_workers tasks run the handler on them.
+    When the queue is full, put waits, so the producer of the files slows down (backpressure).
+    '''
+
+    def __init__(self, name, handler, n_workers=1, maxsize=4):
+        self.name = name
+        self.handler = handler
+        self.n_workers = n_workers
+        self.queue = asyncio.Queue(maxsize)
+        self.pending = set() # queued or running
+        self.tasks = []
+        self.n_done = 0
+        self.n_error = 0
+        self.max_depth = 0
+        self.t_wait = 0.   # total time in the queue
+        self.t_run = 0.    # total time in the handler
+        self.t_max = 0.    # longest time from put to done
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.n_workers)]
+
+    async def put(self, item):
+
+        '''
+        Queue an item, an item already queued or running is not queued again.
+        '''
+
+        if item in self.pending:
+            return
+        self.pending.add(item)
+        await self.queue.put((item, time.monotonic()))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def offer(self, item):
+
+        '''
+        Queue an item if there is room, for the requests that can be merged (e.g. run cmd_gen once more).
+        '''
+
+        try:
+            self.queue.put_nowait((item, time.monotonic()))
+        except asyncio.QueueFull:
+            return
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    async def work(self):
+        while True:
+            item, t_put = await self.queue.get()
+            t_start = time.monotonic()
+            try:
+                await self.handler(item)
+                self.n_done += 1
+            except Exception:
+                # the handler logs its errors
+                self.n_error += 1
+            finally:
+                t_end = time.monotonic()
+                self.t_wait += t_start - t_put
+                self.t_run += t_end - t_start
+                self.t_max = max(self.t_max, t_end - t_put)
+                self.pending.discard(item)
+                self.queue.task_done()
+
+    def status(self):
+
+        '''
+        Queue depth and latency (s) of the stage.
+        '''
+
+        n = max(self.n_done + self.n_error, 1)
+        return {
+            'stage': self.name,
+            'depth': self.queue.qsize(),
+            'max_depth': self.max_depth,
+            'size': self.queue.maxsize,
+            'done': self.n_done,
+            'errors': self.n_error,
+            'mean_wait': self.t_wait/n,
+            'mean_run': self.t_run/n,
+            'max_latency': self.t_max,
+        }
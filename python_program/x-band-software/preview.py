@@ -0,0 +1,166 @@
+'''
+Quick-look preview of the images, next to the FITS file in ./img/:
+    <raw file name>_preview.fits: the pyramid of the image binned by 2, 4, 8 (extensions BIN2, BIN4, BIN8), uint16 means
+    <raw file name>_preview.png: 8-bit grayscale of the level png_level, stretched between the percentiles of stretch
+The pyramid is made by read_bin when read_bin.preview is set, from the image already assembled in memory,
+each level from the previous one by one strided 2x2 reduction, the first level by blocks of rows that stay in
+the cache. The PNG is written with zlib, no imaging library is needed.
+------Parameters------
+1. fits_name: FITS file of an image (./img/Fxxx_test.fits), the preview is made if it is missing or older
+'''
+
+import os
+import struct
+import sys
+import zlib
+import numpy as np
+from astropy.io import fits
+
+levels = (2, 4, 8)   # binning factors of the pyramid
+png_level = 4        # level of the PNG (750x752 pixels)
+stretch = (0.5, 99.5) # percentiles mapped to 0 and 255, computed on the smallest level
+png_compression = 1  # zlib level, the stretched noise does not compress much more at higher levels
+png_strategy = zlib.Z_HUFFMAN_ONLY # no string matching, ~3x faster than the default and as small on the noise
+bin_rows = 32        # output rows binned at a time by bin2
+
+def bin2(image):
+
+    '''
+    Mean of the 2x2 blocks of a uint16 image (rounded), the last row/column of an odd size is dropped.
+    The sums are made bin_rows output rows at a time in small uint32 buffers, instead of full-size temporaries.
+    '''
+
+    h, w = image.shape[0] // 2, image.shape[1] // 2
+    out = np.empty((h, w), dtype=np.uint16)
+    rows = np.empty((bin_rows, 2 * w), dtype=np.uint32)
+    total = np.empty((bin_rows, w), dtype=np.uint32)
+    for k in range(0, h, bin_rows):
+        n = min(bin_rows, h - k)
+        np.add(image[2*k:2*(k+n):2, :2*w], image[2*k+1:2*(k+n):2, :2*w], out=rows[:n], dtype=np.uint32)
+        np.add(rows[:n, 0::2], rows[:n, 1::2], out=total[:n])
+        total[:n] += 2
+        total[:n] >>= 2
+        out[k:k+n] = total[:n]
+    return out
+
+def pyramid(image, factors=levels):
+
+    '''
+    Binned images of the pyramid.
+    Input:
+        image: uint16 image
+        factors: binning factors, powers of 2
+    Output:
+        dict {factor: uint16 image binned by factor}
+    '''
+
+    binned, level, current = {}, 1, image
+    for factor in sorted(factors):
+        while level < factor:
+            current, level = bin2(current), level * 2
+        binned[factor] = current
+    return binned
+
+def to_8bit(image, low, high):
+
+    '''
+    Linear stretch of the image between the values low and high to 0..255.
+    '''
+
+    scale = 255. / max(high - low, 1)
+    return np.clip((image.astype(np.float32) - low) * scale, 0, 255).astype(np.uint8)
+
+def png_bytes(image):
+
+    '''
+    8-bit grayscale PNG of the image (no filter, one zlib stream).
+    '''
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    h, w = image.shape
+    raw = np.empty((h, w + 1), dtype=np.uint8)
+    raw[:, 0] = 0 # filter type of each row
+    raw[:, 1:] = image
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 0, 0, 0, 0))
+            + chunk(b'IDAT', deflate(raw))
+            + chunk(b'IEND', b''))
+
+def deflate(data):
+    compressor = zlib.compressobj(png_compression, zlib.DEFLATED, zlib.MAX_WBITS, 9, png_strategy)
+    return compressor.compress(data) + compressor.flush()
+
+def write_levels(file_name, binned, cards):
+
+    '''
+    Write the pyramid as uint16 image extensions (BZERO = 32768), the same file as astropy writes from
+    fits.ImageHDU, converted with one pass per level.
+    Input:
+        file_name: str
+        binned: pyramid of the image (dict {factor: uint16 image})
+        cards: (keyword, value, comment) of the primary header
+    '''
+
+    primary = fits.PrimaryHDU()
+    for keyword, value, comment in cards:
+        primary.header[keyword] = (value, comment)
+    block = 2880 # the data is padded to FITS blocks
+    with open(file_name, 'wb') as f:
+        f.write(primary.header.tostring().encode('ascii'))
+        for factor in levels:
+            data = binned[factor]
+            # header of a uint16 image of the shape, from a view of one pixel (nothing is allocated)
+            hdu = fits.ImageHDU(np.lib.stride_tricks.as_strided(np.zeros(1, dtype=np.uint16), data.shape, (0, 0)), name=f'BIN{factor}')
+            f.write(hdu.header.tostring().encode('ascii'))
+            # pixel - 32768 as big-endian int16
+            f.write((data ^ 0x8000).astype('>u2').data)
+            f.write(bytes(-data.nbytes % block))
+
+def preview_names(fits_name):
+    # ./img/Fxxx_test.fits -> ./img/Fxxx_preview.fits, ./img/Fxxx_preview.png
+    stem = fits_name[:-len('_test.fits')] if fits_name.endswith('_test.fits') else os.path.splitext(fits_name)[0]
+    return stem + '_preview.fits', stem + '_preview.png'
+
+def write_preview(image, fits_name, binned=None):
+
+    '''
+    Write the pyramid and the PNG of an image next to its FITS file, the files are renamed when complete.
+    Input:
+        image: uint16 image, as assembled by read_bin
+        fits_name: the FITS file of the image
+        binned: the pyramid of the image if already made, then image is not used
+    Output:
+        pyramid_name, png_name: the preview files
+    '''
+
+    if binned is None:
+        binned = pyramid(image)
+    low, high = np.percentile(binned[max(levels)], stretch)
+    pyramid_name, png_name = preview_names(fits_name)
+    write_levels(pyramid_name + '.part', binned, [('STRLOW', float(low), f'{stretch[0]} percentile, black in the PNG'),
+                                                 ('STRHIGH', float(high), f'{stretch[1]} percentile, white in the PNG')])
+    os.replace(pyramid_name + '.part', pyramid_name)
+    with open(png_name + '.part', 'wb') as f:
+        f.write(png_bytes(to_8bit(binned[png_level], low, high)))
+    os.replace(png_name + '.part', png_name)
+    return pyramid_name, png_name
+
+def quick_look(fits_name):
+
+    '''
+    The preview of a FITS image, made from the file if it is not cached or older than the FITS file.
+    Output:
+        pyramid_name, png_name: the preview files
+    '''
+
+    pyramid_name, png_name = preview_names(fits_name)
+    if all(os.path.isfile(name) and (os.path.getmtime(name) >= os.path.getmtime(fits_name)) for name in (pyramid_name, png_name)):
+        return pyramid_name, png_name
+    with fits.open(fits_name) as hdul:
+        image = next(hdu.data for hdu in hdul if hdu.is_image and (hdu.data is not None))
+        return write_preview(image, fits_name)
+
+if __name__ == "__main__":
+    for name in quick_look(sys.argv[1]):
+        print(f'Preview: {name}')
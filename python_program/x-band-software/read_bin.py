@@ -1,85 +1,320 @@
-import sys
-import numpy as np
-from astropy.io import fits
-import pandas as pd
-
-def DF_tmp_data(file_name):
-    
-    with open(file_name, 'rb') as f:
-        mpduPackets = f.read().split(b'\x1A\xCF\xFC\x1D')[1:]
-
-    headers = [[], [], []]
-    for k, packet in enumerate(mpduPackets):
-        # classify the packets by the VCDU header
-        if packet[:2] == b'\x55\x40':
-            headers[0].append('IM')
-            headers[2].append(packet[5:])
-        elif packet[:2] == b'\x40\x3F':
-            headers[0].append('HK')
-            headers[2].append(packet[5:])
-        else:
-            continue
-        
-        headers[1].append(int.from_bytes(packet[2:5], 'big'))
-        
-    headerDF = pd.DataFrame({
-        'VCDU': headers[0],
-        'PSC': pd.Series(headers[1], dtype=int),
-        'data': pd.Series(headers[2], dtype='object')  # Preserve binary data    
-    })
-    
-    return headerDF
-    
-# file_name = './optical/opt_frame_0005_F20250109155612.bin'
-file_name = sys.argv[1]
-DF = DF_tmp_data(file_name)
-
-IM = DF[DF['VCDU']=='IM']
-HK = DF[DF['VCDU']=='HK']
-DATA = IM['data'] #data
-header_X = HK['data'] #header
-
-data = bytes()
-for i in range(len(IM)):
-    data += DATA[i]
-data_rs = data.rstrip(b'\0')
-try:
-    data_array = np.frombuffer(data_rs,dtype=np.uint16)  #create a numpy array from object(such as bytes or bytearrays)
-    image_data = data_array.reshape(3003,3008)
-except Exception as e:
-    sys.exit(4)
-
-#check if the length of data_array is 3003*3008
-# if len(data_array) == 3003*3008: 
-#     image_data = data_array.reshape(3003,3008)
-# else:
-#     data_nan = np.full(3003*3008,np.nan)   
-#     data_nan[:len(data_array)] = data_array
-#     image_data = data_nan   #if not, fill NaN into data_array until the total length is 3003*3008
-
-#write a text file
-a = ['1\n','2\n','3\n']
-f = open('./mock_header.txt','w')
-f.writelines(a)  #write line by line
-f.close()
-
-#read the text
-ff = open('./mock_header.txt','r')
-information = ff.readlines()
-header_S = []
-for info in information:
-    header_S.append(info.strip())  #delete the '\n' after element in a
-
-#write image data and header information in fits file
-hdu = fits.PrimaryHDU(image_data)  #fits.PrimaryHDU(data)
-hdu.header['header1'] = header_S[0]
-hdu.header['header2'] = header_S[1]
-hdu.header['header3'] = header_S[2]
-
-# file_name = input("input file name or enter empty to exit:\n")
-file_name = file_name.split('/')[-1].split('.')[0]
-#add the header information
-
-#if filename isn't a empty string
-if file_name != "":
-    hdu.writeto(f'./img/{file_name.split("_")[-1]}_test.fits', overwrite=True)
\ No newline at end of file
+import os
+import sys
+import numpy as np
+from astropy.io import fits
+from mpdu import open_capture, packet_index, remove_index, strided_bounds, record_view, layout_raw, layout_tmp, VCDU_ID_image, VCDU_ID_HK
+from completeness import Completeness
+from hk import decode_hk, hk_cards, hk_hdu
+from preview import pyramid, write_preview
+
+image_shape = (3003, 3008)
+
+# FITS output of the images:
+#   'plain': uncompressed image in the primary HDU
+#   'compressed': lossless tile compression (CompImageHDU in the first extension), see compression_type and tile_shape
+#   'memmap': uncompressed, the payloads are copied directly into the mapped FITS file, the image is not
+#             kept in memory next to the converted copy written by astropy
+fits_mode = 'plain'
+compression_type = 'RICE_1' # 'RICE_1', 'GZIP_1' or 'GZIP_2' (byte shuffled), all lossless for the uint16 pixels
+tile_shape = (16, image_shape[1]) # pixels of a tile (rows, columns)
+# quick-look pyramid and PNG next to the FITS file (preview.py), from the assembled image
+preview = False
+# value of the pixels of the missing packets in the quick-look of an incomplete tmp file (read_partial)
+partial_fill = 0
+
+class ReadBinError(Exception):
+    '''
+    The image data of the file does not fill the 3003x3008 frame (exit code 4 of the script).
+    '''
+
+def assemble_image(buf, IM, shape=image_shape, out=None, fill=None):
+    '''
+    Copy the image payloads of an opt_frame file to their place in the frame, the payload of the packet PSC
+    starts at the byte PSC * (payload length) of the image. The image array is allocated once.
+    ------Parameters------
+    buf: mmap
+        The opt_frame file (mpdu.open_capture).
+    IM: ndarray
+        Index of the image packets (mpdu.packet_index).
+    shape: tuple
+        Shape of the image (uint16 pixels).
+    out: ndarray
+        uint16 array of the shape to fill (e.g. a memmap), instead of a new array.
+    fill: int
+        For an incomplete file (read_partial): the frame is filled with this value first, the missing packets
+        are allowed and the first copy of a duplicated packet is used. By default the frame must be complete.
+    ------Returns------
+    image_data: ndarray
+        The image, uint16 with the byte order of the machine, as read by np.frombuffer.
+    ------Raises------
+    ReadBinError
+        The payloads have different lengths, a packet of the frame is missing or duplicated, or the
+        payloads after the end of the frame are not zero padding.
+    '''
+    image_data = np.empty(shape, dtype=np.uint16) if out is None else out
+    if fill is not None:
+        image_data[...] = fill
+    frame = image_data.reshape(-1).view(np.uint8)
+    src = np.frombuffer(buf, dtype=np.uint8)
+    PSC, starts = IM['PSC'], IM['data_start']
+    lengths = IM['data_end'] - starts
+    if (len(IM) == 0) or (lengths != lengths[0]).any():
+        raise ReadBinError('payloads of different lengths')
+    length = int(lengths[0])
+    n_full, rest = divmod(frame.size, length)  # packets entirely in the frame, bytes of the last one
+    n_packets = n_full + (rest > 0)
+
+    if fill is not None:
+        # first copy of each packet, in the order of the file
+        first = np.zeros(len(PSC), dtype=bool)
+        first[np.unique(PSC, return_index=True)[1]] = True
+        PSC, starts = PSC[first], starts[first]
+    else:
+        # each packet of the frame is present once
+        inside = PSC < n_packets
+        if (np.count_nonzero(inside) != n_packets) or (len(np.unique(PSC[inside])) != n_packets):
+            raise ReadBinError('missing or duplicated image packets')
+
+    # the packets of the opt_frame and raw data files are fixed-size records, seen as the rows of a strided view
+    payloads, record = record_view(buf, starts, length)
+    rows = frame[:n_full*length].reshape(n_full, length)
+    full = PSC < n_full
+    if payloads is not None:
+        target, record = PSC[full], record[full]
+        # in blocks of rows, the fancy indexing copies the block to a temporary array
+        for k in range(0, len(target), 256):
+            rows[target[k:k+256]] = payloads[record[k:k+256]]
+    else:
+        for psc, start in zip(PSC[full].tolist(), starts[full].tolist()):
+            rows[psc] = src[start:start+length]
+
+    # the last packet of the frame, then the padding after the end of the frame
+    for psc, start in zip(PSC[~full].tolist(), starts[~full].tolist()):
+        if psc == n_full:
+            frame[n_full*length:] = src[start:start+rest]
+            start += rest
+        if src[start:start+length-(rest if psc == n_full else 0)].any():
+            raise ReadBinError('image data after the end of the frame')
+    return image_data
+
+def read_bin(file_name):
+    '''
+    Compile the image of an opt_frame file and write it to ./img/<raw file name>_test.fits.
+    ------Parameters------
+    file_name: str
+        The opt_frame file (full path).
+    ------Raises------
+    ReadBinError
+        The image can not be reshaped to 3003x3008, the file is incomplete.
+    '''
+    buf = open_capture(file_name)
+    index = packet_index(file_name, layout_tmp)
+    IM = index[index['VCDU'] == VCDU_ID_image]
+    HK = index[index['VCDU'] == VCDU_ID_HK]
+    try:
+        make_image(buf, IM, file_name, HK)
+    except ReadBinError as e:
+        raise ReadBinError(file_name) from e
+
+def render_raw(file_name):
+    '''
+    Compile the image of a complete raw data file (check_data.fused) from its good packets and write it to
+    ./img/<raw file name>_test.fits, run as its own job after the check. The packets are read from the sidecar
+    index written by the check, the file is not parsed again.
+    ------Parameters------
+    file_name: str
+        The raw data file (full path).
+    ------Returns------
+    fits_name: str
+        The FITS file.
+    ------Raises------
+    ReadBinError
+        See assemble_image, e.g. duplicated image packets.
+    '''
+    index = packet_index(file_name, layout_raw, strided_bounds)
+    good = index['DQ'] == 0
+    IM = index[good & (index['VCDU'] == VCDU_ID_image)]
+    HK = index[good & (index['VCDU'] == VCDU_ID_HK)]
+    try:
+        return make_image(open_capture(file_name), IM, file_name, HK)
+    except ReadBinError as e:
+        raise ReadBinError(file_name) from e
+
+def read_partial(file_name, fill=None):
+    '''
+    Quick-look of an incomplete tmp file (./tmp/tmp_Fxxx.bin), made on request only: the image packets received
+    so far are assembled, the pixels of the missing packets are set to fill, and the image is written to
+    ./img/<raw file name>_partial.fits with a MASK extension (1 for the pixels received, 0 for the missing ones).
+    The mask comes from the PSC bitmap of the packet index (the file is parsed once), the tmp file is not changed.
+    ------Parameters------
+    file_name: str
+        The tmp file (full path).
+    fill: int
+        Value of the missing pixels, partial_fill by default.
+    ------Returns------
+    fits_name: str
+        The FITS file.
+    ------Raises------
+    ReadBinError
+        The file has no image packets or payloads of different lengths.
+    '''
+    fill = partial_fill if fill is None else fill
+    buf = open_capture(file_name)
+    index = packet_index(file_name, layout_tmp)
+    IM = index[index['VCDU'] == VCDU_ID_image]
+    HK = index[index['VCDU'] == VCDU_ID_HK]
+    try:
+        image_data = assemble_image(buf, IM, fill=fill)
+    except ReadBinError as e:
+        raise ReadBinError(file_name) from e
+
+    # bitmap of the image packets, then the pixels of the present packets
+    length = int(IM['data_end'][0] - IM['data_start'][0])
+    n_bytes = image_data.nbytes
+    state = Completeness(0, -(-n_bytes // length))
+    state.mark(IM['PSC'])
+    valid = np.repeat(state.present, length)[:n_bytes]
+    mask = (valid[0::2] & valid[1::2]).astype(np.uint8).reshape(image_data.shape)
+
+    cards = [('PARTIAL', True, 'incomplete capture, see the MASK extension'),
+             ('FILLVAL', fill, 'value of the pixels of the missing packets'),
+             ('IM_MISS', state.n_missing(), 'number of missing image packets'),
+             ('VALIDFRC', round(float(mask.mean()), 6), 'fraction of the pixels received')]
+    out = write_fits(image_data, file_name, decode_hk(buf, HK), cards=cards, mask=mask)
+    if preview:
+        write_preview(image_data, out)
+    return out
+
+def make_image(buf, IM, file_name, HK=None):
+    '''
+    Assemble the image from the packets and write it to ./img/<raw file name>_test.fits, in fits_mode,
+    with the decoded HK packets (hk.py) in the header and in the HK table extension, and the quick-look
+    preview if preview is set.
+    ------Parameters------
+    buf: mmap
+        The opt_frame or raw data file.
+    IM: ndarray
+        Index of the image packets in buf.
+    file_name: str
+        The opt_frame or raw data file of the image (full path).
+    HK: ndarray
+        Index of the HK packets in buf, None for no HK packets.
+    ------Returns------
+    fits_name: str
+        The FITS file.
+    ------Raises------
+    ReadBinError
+        See assemble_image.
+    '''
+    table = decode_hk(buf, IM[:0] if HK is None else HK)
+    if fits_mode == 'memmap':
+        return write_fits_memmap(buf, IM, file_name, table)
+    image_data = assemble_image(buf, IM)
+    out = write_fits(image_data, file_name, table)
+    if preview:
+        write_preview(image_data, out)
+    return out
+
+def fits_name(file_name, suffix='test'):
+    # ./img/<raw file name>_test.fits, for the opt_frame, the raw data and the tmp file
+    file_name = file_name.split('/')[-1].split('.')[0]
+    return f'./img/{file_name.split("_")[-1]}_{suffix}.fits'
+
+def write_fits(image_data, file_name, table, cards=(), mask=None):
+    '''
+    Write the image and the HK packets to ./img/<raw file name>_test.fits, uncompressed ('plain')
+    or tile compressed ('compressed'). The file is renamed when complete.
+    ------Parameters------
+    image_data: ndarray
+        The 3003x3008 image.
+    file_name: str
+        The opt_frame or raw data file of the image (full path).
+    table: ndarray
+        The decoded HK packets (hk.decode_hk), the keywords go to the image header.
+    cards: list
+        More (keyword, value, comment) of the image header.
+    mask: ndarray
+        uint8 mask of the pixels received (read_partial), written to the MASK extension and to
+        ./img/<raw file name>_partial.fits.
+    ------Returns------
+    fits_name: str
+        The FITS file.
+    '''
+    if fits_mode == 'compressed':
+        hdu = fits.CompImageHDU(image_data, compression_type=compression_type, tile_shape=tile_shape)
+        hdul = fits.HDUList([fits.PrimaryHDU(), hdu])
+    else:
+        #write image data and header information in fits file
+        hdu = fits.PrimaryHDU(image_data)  #fits.PrimaryHDU(data)
+        hdul = fits.HDUList([hdu])
+    hdu.header.extend(list(cards) + hk_cards(table))
+    if mask is not None:
+        if fits_mode == 'compressed':
+            hdul.append(fits.CompImageHDU(mask, name='MASK', compression_type=compression_type, tile_shape=tile_shape))
+        else:
+            hdul.append(fits.ImageHDU(mask, name='MASK'))
+    hdul.append(hk_hdu(table))
+
+    out = fits_name(file_name, 'test' if mask is None else 'partial')
+    hdul.writeto(out + '.part', overwrite=True)
+    os.replace(out + '.part', out)
+    return out
+
+def write_fits_memmap(buf, IM, file_name, table, shape=image_shape):
+    '''
+    Write the FITS header, then assemble the image directly in the mapped data of the file, and append the
+    HK table extension. The pixels are converted in place to the FITS representation of uint16
+    (big-endian int16, BZERO = 32768), the file is the same as with write_fits in 'plain' mode.
+    ------Returns------
+    fits_name: str
+        The FITS file.
+    ------Raises------
+    ReadBinError
+        See assemble_image, the file is not written.
+    '''
+    # header of a uint16 image of the shape, from a view of one pixel (nothing is allocated)
+    hdu = fits.PrimaryHDU(np.lib.stride_tricks.as_strided(np.zeros(1, dtype=np.uint16), shape, (0, 0)))
+    hdu.header.extend(hk_cards(table))
+    header = hdu.header.tostring().encode('ascii')
+    n_data = np.prod(shape) * 2
+    block = 2880 # the data is padded to FITS blocks
+
+    out = fits_name(file_name)
+    try:
+        with open(out + '.part', 'wb+') as f:
+            f.write(header)
+            f.truncate(len(header) + -(-n_data // block) * block)
+            image_data = np.memmap(f, dtype=np.uint16, mode='r+', offset=len(header), shape=shape)
+            assemble_image(buf, IM, shape, out=image_data)
+            # the preview is written after the FITS file, the pyramid is made before the conversion
+            binned = pyramid(image_data) if preview else None
+            # pixel - 32768 as big-endian int16
+            image_data ^= 0x8000
+            if sys.byteorder == 'little':
+                image_data.byteswap(inplace=True)
+            image_data.flush()
+            del image_data
+        hk = hk_hdu(table)
+        fits.append(out + '.part', hk.data, hk.header)
+    except BaseException:
+        if os.path.isfile(out + '.part'):
+            os.remove(out + '.part')
+        raise
+    os.replace(out + '.part', out)
+    if binned is not None:
+        write_preview(None, out, binned)
+    return out
+
+if __name__ == "__main__":
+    # file_name = './optical/opt_frame_0005_F20250109155612.bin'
+    # python read_bin.py --partial ./tmp/tmp_Fxxx.bin for the quick-look of an incomplete file
+    file_name = sys.argv[-1]
+    try:
+        if sys.argv[1] == '--partial':
+            print(f'Quick-look: {read_partial(file_name)}')
+        else:
+            read_bin(file_name)
+    except ReadBinError:
+        sys.exit(4)
+    finally:
+        remove_index(file_name)
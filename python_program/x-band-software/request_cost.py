@@ -0,0 +1,194 @@
+'''
+Cost model of the retransmission requests of cmd_gen.py, in bytes on air (uplink commands and downlinked packets):
+    bytes = commands * (command_bytes + command_overhead) + packets * packet_bytes
+command_bytes is the size of one command (cmd_enc_dec.make_command). command_overhead (bytes on air of a
+response besides its packets) and packet_bytes are calibrated from the logs by least squares over the captures:
+    requests: the command lists written by cmd_gen (./cmd/list/<time>/REQ_*.csv), one command per line
+    responses: the requested data files received (./archive/requested_data/), the capture is in the file name
+The commands, packets and bytes of each capture are counted in the state store (state.py) when a list is
+written (record_list) or a response is archived (record_response), the logs on disk are read only once.
+The fitted model is kept in the store until new counts are added.
+cmd_gen compares per file the partial request (the segments after list_shorten) with the full request
+(all the packets of each type), and merges the gaps that cost less than a command.
+------Parameters------
+1. cmd list folder, requested data folder: print the model of the state store (the folders are read the first time,
+   default ./cmd/list/, ./archive/requested_data/)
+'''
+
+import collections
+import csv
+import glob
+import itertools
+import os
+import re
+import sys
+import numpy as np
+
+command_bytes = 9 # unix time (4) + type (1) + start (2) + end (2)
+frame_bytes = 4 + 56 + 1088 + 160 # sync + header + payload + trailer of a raw frame
+full_packets = {'IM': 16621, 'HK': 8000} # packets of a full request of each type (8000 HK for testing, not real)
+full_end = 16621 # end of the range of a full request commanded by cmd_gen (total_packet), estimated as full_packets
+
+class RequestCost:
+
+    '''
+    Bytes on air of the requests, the defaults are used until a calibration is available:
+    one frame of overhead per command, frame_bytes per packet.
+    '''
+
+    def __init__(self, command_overhead=frame_bytes, packet_bytes=frame_bytes, samples=0):
+        self.command_overhead = float(command_overhead)
+        self.packet_bytes = float(packet_bytes)
+        self.samples = samples # captures of the calibration, 0 for the defaults
+
+    def __repr__(self):
+        return (f'RequestCost(command_overhead={self.command_overhead:.0f}, packet_bytes={self.packet_bytes:.0f}, '
+                f'samples={self.samples})')
+
+    def cost(self, n_commands, n_packets):
+        return n_commands * (command_bytes + self.command_overhead) + n_packets * self.packet_bytes
+
+    def gap_merge(self):
+
+        '''
+        Largest gap (packets) that costs less to request than one more command.
+        '''
+
+        return int((command_bytes + self.command_overhead) // self.packet_bytes)
+
+    def partial(self, rows):
+
+        '''
+        Bytes of the request of the segments rows [Filename, Type, Start, End, ...], one command per segment.
+        '''
+
+        return self.cost(len(rows), sum(row[3] - row[2] + 1 for row in rows))
+
+    def full(self, rows):
+
+        '''
+        Bytes of the full request of the types of the rows, one command per type.
+        '''
+
+        types = set(row[1] for row in rows)
+        return self.cost(len(types), sum(full_packets.get(kind, max(full_packets.values())) for kind in types))
+
+def read_list(file_name):
+
+    '''
+    Commands and packets requested for each capture in one command list (REQ_*.csv), an empty list has none.
+    Output:
+        commands, packets: Counter by capture
+    '''
+
+    commands, packets = collections.Counter(), collections.Counter()
+    with open(file_name, newline='') as f:
+        for row in itertools.islice(csv.reader(f), 1, None):
+            if len(row) < 4:
+                continue
+            commands[row[0]] += 1
+            packets[row[0]] += request_packets([row[0], row[1], int(row[2]), int(row[3])])
+    return commands, packets
+
+def request_packets(row):
+
+    '''
+    Packets answered to the command of a row [Filename, Type, Start, End, ...]: the whole capture for a full
+    request (Error), full_packets of the type for a full request of one type (0..full_end), else the segment.
+    '''
+
+    if row[1] == 'Error':
+        return sum(full_packets.values())
+    if (row[2] == 0) and (row[3] >= full_end):
+        return full_packets.get(row[1], max(full_packets.values()))
+    return row[3] - row[2] + 1
+
+def requested(list_folder='./cmd/list/'):
+
+    '''
+    Commands and packets requested for each capture in the command lists (REQ_*.csv) of the folders of list_folder.
+    Output:
+        commands, packets: Counter by capture
+    '''
+
+    commands, packets = collections.Counter(), collections.Counter()
+    for file_name in glob.glob(os.path.join(list_folder, '*', 'REQ_*.csv')):
+        more_commands, more_packets = read_list(file_name)
+        commands.update(more_commands)
+        packets.update(more_packets)
+    return commands, packets
+
+def response_captures(file_name):
+    # the captures named in a requested data file name
+    return [f'{name}.bin' for name in re.findall(r'[A-Z]\d{14}', os.path.basename(file_name))]
+
+def record_list(store, file_name):
+
+    '''
+    Add the commands of a new command list to the counts of the state store, the model is fitted again when
+    it is next loaded. A list already counted is skipped.
+    '''
+
+    commands, packets = read_list(file_name)
+    store.add_costs(file_name, [(name, commands[name], packets[name], 0) for name in commands])
+
+def record_response(store, file_name):
+
+    '''
+    Add the size of a requested data file (e.g. when it is archived) to the counts of its captures.
+    '''
+
+    size = os.path.getsize(file_name)
+    store.add_costs(file_name, [(name, 0, 0, size) for name in response_captures(file_name)])
+
+def import_logs(store, list_folder='./cmd/list/', response_folder='./archive/requested_data/'):
+
+    '''
+    Count the command lists and the requested data files already on disk, once per state store.
+    '''
+
+    if store.get_meta('cost_imported') is not None:
+        return
+    for file_name in glob.glob(os.path.join(list_folder, '*', 'REQ_*.csv')):
+        record_list(store, file_name)
+    for entry in os.scandir(response_folder) if os.path.isdir(response_folder) else ():
+        record_response(store, entry.path)
+    store.set_meta('cost_imported', 1)
+
+def calibrate(samples):
+
+    '''
+    Least squares fit of the bytes received: commands * command_overhead + packets * packet_bytes.
+    The defaults are kept if the samples do not determine both values or give a negative one.
+    Input:
+        samples: list of (capture, commands, packets, bytes), the captures requested and received
+    '''
+
+    if len(samples) < 2:
+        return RequestCost()
+    A = np.array([sample[1:3] for sample in samples], dtype=float)
+    b = np.array([sample[3] for sample in samples], dtype=float)
+    (overhead, packet), _, rank, _ = np.linalg.lstsq(A, b, rcond=None)
+    if (rank < 2) or (overhead < 0) or (packet <= 0):
+        return RequestCost()
+    return RequestCost(overhead, packet, len(samples))
+
+def load_model(store, list_folder='./cmd/list/', response_folder='./archive/requested_data/'):
+
+    '''
+    The model fitted on the counts of the state store. The fit is kept in the store and done again only after
+    new command lists or responses are recorded; the logs on disk are read the first time only (import_logs).
+    '''
+
+    import_logs(store, list_folder, response_folder)
+    fitted = store.get_meta('cost_model')
+    if fitted is not None:
+        overhead, packet, samples = fitted.split(',')
+        return RequestCost(float(overhead), float(packet), int(samples))
+    model = calibrate(store.cost_samples())
+    store.set_meta('cost_model', f'{model.command_overhead!r},{model.packet_bytes!r},{model.samples}')
+    return model
+
+if __name__ == "__main__":
+    from state import open_store
+    print(load_model(open_store(), *sys.argv[1:3]))
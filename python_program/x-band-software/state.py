@@ -0,0 +1,361 @@
+'''
+State store of the processing, one SQLite database (WAL mode) shared by all the programs, instead of
+appending and rewriting the report csv files:
+    captures: last status of each file (complete, incomplete, error, rendered, render_error)
+    segments: missing packet segments to be requested (the lines of un_gen.csv), until cmd_gen takes them
+    requests: the command lists made by cmd_gen from the segments
+    final: complete files waiting for the image (the lines of final_check.csv)
+    reports: history of the reported lines (report.csv)
+    costs: commands, packets requested and bytes received for each capture (request_cost.py), counted once
+        per command list or requested data file (cost_logs)
+    journal: append-only state transitions of the input files of main_control.py, keyed by the file path and
+        the hash of its content (seen, checked, tmp-stored, error, combined, rendered, archived, deleted)
+Every update is a transaction touching the indexed rows only, several processes can update the store
+at the same time. The csv files are exports, see export().
+------Parameters------
+1. folder: export the csv files to this folder (default ./report/)
+'''
+
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+
+db_name = './report/state.db'
+header = 'Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n'
+
+schema = '''
+CREATE TABLE IF NOT EXISTS captures (
+    name TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    rate,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    capture TEXT NOT NULL,
+    type TEXT NOT NULL,
+    start INTEGER,
+    end INTEGER,
+    rate,
+    request INTEGER
+);
+CREATE INDEX IF NOT EXISTS segments_request ON segments (request);
+CREATE INDEX IF NOT EXISTS segments_capture ON segments (capture);
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    folder TEXT,
+    created REAL,
+    n_segments INTEGER
+);
+CREATE TABLE IF NOT EXISTS final (
+    id INTEGER PRIMARY KEY,
+    capture TEXT NOT NULL,
+    type TEXT NOT NULL,
+    start INTEGER,
+    end INTEGER,
+    rate,
+    reported INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS final_pending ON final (reported, capture);
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    capture TEXT NOT NULL,
+    type TEXT NOT NULL,
+    start INTEGER,
+    end INTEGER,
+    rate
+);
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    state TEXT NOT NULL,
+    time REAL
+);
+CREATE INDEX IF NOT EXISTS journal_file ON journal (name, hash);
+CREATE TABLE IF NOT EXISTS costs (
+    capture TEXT PRIMARY KEY,
+    commands INTEGER NOT NULL DEFAULT 0,
+    packets INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS cost_logs (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+'''
+
+def status_of(table, rows):
+
+    '''
+    Status of the capture for the lines of check_data/combine.
+    '''
+
+    if table == 'final':
+        return 'complete'
+    if table == 'reports':
+        return 'rendered'
+    if any(row[1] == 'Error' for row in rows):
+        return 'error'
+    return 'incomplete'
+
+def csv_line(row):
+    return ','.join(str(value) for value in row) + '\n'
+
+def file_hash(file_name):
+
+    '''
+    Hash of the content of a file (sha256), the key of the file in the journal with its path.
+    '''
+
+    with open(file_name, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+class StateStore:
+
+    '''
+    Connection to the state store, one per process.
+    '''
+
+    def __init__(self, file_name=db_name):
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        self.file_name = file_name
+        self.conn = sqlite3.connect(file_name, timeout=60, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(schema)
+
+    def transaction(self):
+        return Transaction(self.conn)
+
+    def add_rows(self, table, rows, journal=None):
+
+        '''
+        Add the report lines of a capture.
+        Input:
+            table: 'segments' for the missing segments and unreadable files (un_gen.csv),
+                'final' for the complete files (final_check.csv),
+                'reports' for the complete files with the image already written (check_data.fused)
+            rows: list of (file name, type, start, end, rate), the file name is the same in all the rows
+            journal: (file path, hash, state) recorded in the same transaction, see record
+        '''
+
+        if len(rows) == 0:
+            if journal is not None:
+                self.record(*journal)
+            return
+        with self.transaction() as cur:
+            if journal is not None:
+                self.record(*journal, cur=cur)
+            cur.executemany(f'INSERT INTO {table} (capture, type, start, end, rate) VALUES (?, ?, ?, ?, ?)', rows)
+            cur.execute('INSERT INTO captures (name, status, rate, updated) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT (name) DO UPDATE SET status=excluded.status, rate=excluded.rate, updated=excluded.updated',
+                        (rows[0][0], status_of(table, rows), rows[0][4], time.time()))
+
+    def pending_segments(self):
+
+        '''
+        The segments not requested yet, in the order they were added.
+        Output:
+            ids: list of the segment ids
+            rows: list of [file name, type, start, end, rate], as read from un_gen.csv
+        '''
+
+        cur = self.conn.execute('SELECT id, capture, type, start, end, rate FROM segments WHERE request IS NULL ORDER BY id')
+        ids, rows = [], []
+        for id, capture, type, start, end, rate in cur:
+            ids.append(id)
+            rows.append([capture, type, start, end, float(rate)])
+        return ids, rows
+
+    def mark_requested(self, ids, folder):
+
+        '''
+        The segments are in the command list of folder, they are moved to the report history.
+        '''
+
+        with self.transaction() as cur:
+            cur.execute('INSERT INTO requests (folder, created, n_segments) VALUES (?, ?, ?)', (folder, time.time(), len(ids)))
+            request = cur.lastrowid
+            for k in range(0, len(ids), 500):
+                chunk = ids[k:k+500]
+                marks = ','.join('?'*len(chunk))
+                cur.execute(f'UPDATE segments SET request=? WHERE id IN ({marks})', [request] + chunk)
+                # the rate is read as float from un_gen.csv
+                cur.execute('INSERT INTO reports (capture, type, start, end, rate) '
+                            f'SELECT capture, type, start, end, CAST(rate AS REAL) FROM segments WHERE id IN ({marks}) ORDER BY id', chunk)
+
+    def pending_final(self):
+
+        '''
+        The complete files waiting for their image (final lines not reported), in the order they were added.
+        '''
+
+        return [row[0] for row in self.conn.execute('SELECT capture FROM final WHERE reported=0 GROUP BY capture ORDER BY MIN(id)')]
+
+    def report_final(self, capture, row=None, journal=None):
+
+        '''
+        The image of a complete file is made, move its line from final to the report history.
+        Input:
+            capture: raw data file name (Fxxx.bin)
+            row: line reported instead of the final line, e.g. the Error line when the image failed
+            journal: (file path, hash, state) recorded in the same transaction, see record
+        '''
+
+        with self.transaction() as cur:
+            if journal is not None:
+                self.record(*journal, cur=cur)
+            lines = cur.execute('SELECT id, capture, type, start, end, rate FROM final WHERE reported=0 AND capture=? ORDER BY id',
+                                (capture,)).fetchall()
+            for id, *line in lines:
+                cur.execute('UPDATE final SET reported=1 WHERE id=?', (id,))
+                cur.execute('INSERT INTO reports (capture, type, start, end, rate) VALUES (?, ?, ?, ?, ?)', line if row is None else row)
+            if lines:
+                cur.execute('UPDATE captures SET status=?, updated=? WHERE name=?',
+                            ('rendered' if row is None else 'render_error', time.time(), capture))
+
+    def record(self, name, digest, state, cur=None):
+
+        '''
+        Append a state transition of an input file to the journal.
+        Input:
+            name: path of the file in the input folder (e.g. ./raw_data/Fxxx.bin)
+            digest: file_hash of the file
+            state: 'seen', 'checked', 'tmp-stored', 'error', 'combined', 'rendered', 'archived' or 'deleted'
+            cur: cursor of a transaction, to record the state with the rows of the stage
+        '''
+
+        line = (name, digest, state, time.time())
+        query = 'INSERT INTO journal (name, hash, state, time) VALUES (?, ?, ?, ?)'
+        if cur is None:
+            with self.transaction() as cur:
+                cur.execute(query, line)
+        else:
+            cur.execute(query, line)
+
+    def capture_status(self, name):
+
+        '''
+        Last status of a capture (see captures), None if it was never checked.
+        '''
+
+        row = self.conn.execute('SELECT status FROM captures WHERE name=?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def last_state(self, name, digest):
+
+        '''
+        Last state of the file in the journal, None if the file (with this content) was never seen.
+        '''
+
+        row = self.conn.execute('SELECT state FROM journal WHERE name=? AND hash=? ORDER BY id DESC LIMIT 1',
+                                (name, digest)).fetchone()
+        return None if row is None else row[0]
+
+    def add_costs(self, name, rows):
+
+        '''
+        Add the counts of a command list or of a requested data file to the costs of the captures, once per file.
+        The fitted cost model is dropped, it is fitted again with the new counts.
+        Input:
+            name: path of the file counted
+            rows: list of (capture, commands, packets, bytes)
+        '''
+
+        with self.transaction() as cur:
+            if cur.execute('SELECT 1 FROM cost_logs WHERE name=?', (name,)).fetchone() is not None:
+                return
+            cur.execute('INSERT INTO cost_logs (name) VALUES (?)', (name,))
+            cur.executemany('INSERT INTO costs (capture, commands, packets, bytes) VALUES (?, ?, ?, ?) '
+                            'ON CONFLICT (capture) DO UPDATE SET commands=commands+excluded.commands, '
+                            'packets=packets+excluded.packets, bytes=bytes+excluded.bytes', rows)
+            if rows:
+                cur.execute("DELETE FROM meta WHERE key='cost_model'")
+
+    def cost_samples(self):
+
+        '''
+        (capture, commands, packets, bytes) of the captures requested and received.
+        '''
+
+        return self.conn.execute('SELECT capture, commands, packets, bytes FROM costs WHERE commands > 0 AND bytes > 0').fetchall()
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        with self.transaction() as cur:
+            cur.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def export(self, folder='./report/'):
+
+        '''
+        Write un_gen.csv, final_check.csv (pending lines only) and report.csv (history) to the folder.
+        The new lines of the history are appended, report.csv is written again only if it is missing.
+        '''
+
+        os.makedirs(folder, exist_ok=True)
+        for name, query in (('un_gen.csv', 'SELECT capture, type, start, end, rate FROM segments WHERE request IS NULL ORDER BY id'),
+                            ('final_check.csv', 'SELECT capture, type, start, end, rate FROM final WHERE reported=0 ORDER BY id')):
+            file_name = os.path.join(folder, name)
+            with open(file_name + '.part', 'w') as f:
+                f.write(header)
+                f.writelines(csv_line(row) for row in self.conn.execute(query))
+            os.replace(file_name + '.part', file_name)
+
+        file_name = os.path.join(folder, 'report.csv')
+        last = self.conn.execute("SELECT value FROM meta WHERE key='report_exported'").fetchone()
+        last = last[0] if (last is not None) and os.path.isfile(file_name) else None
+        rows = self.conn.execute('SELECT id, capture, type, start, end, rate FROM reports WHERE id > ? ORDER BY id',
+                                 (-1 if last is None else last,)).fetchall()
+        with open(file_name, 'w' if last is None else 'a') as f:
+            if last is None:
+                f.write(header)
+            f.writelines(csv_line(row[1:]) for row in rows)
+        if rows:
+            with self.transaction() as cur:
+                cur.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('report_exported', ?)", (rows[-1][0],))
+
+    def close(self):
+        self.conn.close()
+
+class Transaction:
+
+    '''
+    BEGIN IMMEDIATE ... COMMIT, or ROLLBACK if an exception is raised.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn.cursor()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+stores = {}
+
+def open_store(file_name=db_name):
+
+    '''
+    Store of this process (the connections are not shared with the worker processes).
+    '''
+
+    key = (os.getpid(), os.path.abspath(file_name))
+    if key not in stores:
+        stores[key] = StateStore(file_name)
+    return stores[key]
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else './report/'
+    open_store().export(folder)
+    print(f'Export to {folder}')
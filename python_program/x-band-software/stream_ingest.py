@@ -0,0 +1,188 @@
+'''
+This script follows a raw data file while the receiver is still writing it, and keeps the completeness
+state of the IM/HK packets up to date, so the gap report is ready as soon as the pass ends.
+------Parameters------
+1. file_name: the raw data file being written (full path).
+2. idle: seconds without new data before the pass is considered finished (loss of signal), default 1
+------Output------
+1. The gap report is written to ./report/stream_<file name>.csv in the same format as un_gen.csv.
+    check_data.py is still run on the file once it is moved to the raw_data folder.
+'''
+
+import os
+import sys
+import time
+import mpdu
+from completeness import Completeness
+
+n_IM = 16621
+IM_range = 16620   # same as set(range(0, 16620)) in check_data.py
+max_HK_PSC = 8136  # observed, not confrimed by the document
+
+class StreamIngest:
+
+    '''
+    Incremental parser of a raw data stream.
+    The complete packets (followed by a sync marker) are decoded as they arrive, the partial
+    packet at the end is kept in a buffer until the next sync marker or the end of the stream.
+    '''
+
+    def __init__(self):
+        self.pending = bytearray()
+        self.synced = False
+        self.n_packets = 0
+        self.n_IM = 0
+        self.n_unclassified = 0
+        self.bad_IM = 0
+        self.bad_HK = 0
+        # the HK range is known at the end, cropped from the 0..max_HK_PSC state in gap_report
+        self.IM_state = Completeness(0, IM_range)
+        self.HK_state = Completeness(0, max_HK_PSC + 1)
+        self.min_HK = None
+        self.max_HK = None
+
+    def feed(self, data):
+
+        '''
+        Add new bytes of the stream and decode the packets completed by them.
+        '''
+
+        self.pending += data
+        buf = bytes(self.pending)
+        starts, ends = mpdu.packet_bounds(buf)
+        if len(starts) == 0:
+            # keep the bytes that can be the beginning of a sync marker
+            if not self.synced:
+                del self.pending[:max(len(self.pending) - len(mpdu.SYNC) + 1, 0)]
+            return
+        self.synced = True
+
+        # the last packet is not complete until the next sync marker arrives
+        self.update(buf, starts[:-1], ends[:-1])
+        del self.pending[:starts[-1] - len(mpdu.SYNC)]
+
+    def finish(self):
+
+        '''
+        End of the stream, the buffered packet is decoded as it is.
+        '''
+
+        buf = bytes(self.pending)
+        starts, ends = mpdu.packet_bounds(buf)
+        self.update(buf, starts, ends)
+        self.pending = bytearray()
+
+    def update(self, buf, starts, ends):
+
+        '''
+        Update the completeness state with the headers of the packets.
+        '''
+
+        headers = mpdu.decode_headers(buf, starts, ends)
+        self.n_packets += len(headers)
+        is_im = headers['VCDU'] == mpdu.VCDU_ID_image
+        is_hk = headers['VCDU'] == mpdu.VCDU_ID_HK
+        good = headers['DQ'] == 0
+        self.n_unclassified += int((~is_im & ~is_hk).sum())
+
+        IM_PSC, HK_PSC = headers['PSC'][is_im], headers['PSC'][is_hk]
+        self.n_IM += len(IM_PSC)
+        self.bad_IM += int((~good[is_im]).sum())
+        self.bad_HK += int((~good[is_hk]).sum())
+        self.IM_state.mark(IM_PSC, headers['DQ'][is_im])
+        self.HK_state.mark(HK_PSC, headers['DQ'][is_hk])
+
+        if len(HK_PSC) > 0:
+            self.min_HK = int(HK_PSC.min()) if self.min_HK is None else min(self.min_HK, int(HK_PSC.min()))
+        HK_PSC = HK_PSC[HK_PSC <= max_HK_PSC]
+        if len(HK_PSC) > 0:
+            self.max_HK = int(HK_PSC.max()) if self.max_HK is None else max(self.max_HK, int(HK_PSC.max()))
+
+    def gap_report(self):
+
+        '''
+        The missing packets so far, with the same rules as check_data.py.
+        Output:
+            report: dict with missing_IM, missing_HK (sorted lists), missing_segment_IM, missing_segment_HK
+                and missing_rate_IM, missing_rate_HK (%), or None if no HK packet is received (unreadable file)
+        '''
+
+        if (self.min_HK is None) or (self.max_HK is None):
+            return None
+
+        HK_state = self.HK_state.crop(self.min_HK, self.max_HK + 1)
+
+        return {
+            'missing_IM': self.IM_state.missing().tolist(),
+            'missing_HK': HK_state.missing().tolist(),
+            'missing_segment_IM': self.IM_state.segments(),
+            'missing_segment_HK': HK_state.segments(),
+            'missing_rate_IM': self.IM_state.missing_rate(n_IM),
+            'missing_rate_HK': HK_state.missing_rate(8000), # 8k is for testing, not real
+        }
+
+def report_lines(file_name, report):
+
+    '''
+    The lines of the gap report in the format of un_gen.csv / final_check.csv.
+    '''
+
+    name = file_name.split("/")[-1]
+    if report is None:
+        return [f'{name},Error,65535,65535,100\n']
+    if (report['missing_rate_IM'] == 0) and (len(report['missing_HK']) == 0):
+        return [f'{name},OK,0,0,0\n']
+    rate = report['missing_rate_IM'] + report['missing_rate_HK']
+    lines = [f'{name},IM,{segment[0]},{segment[1]},{rate}\n' for segment in report['missing_segment_IM']]
+    lines += [f'{name},HK,{segment[0]},{segment[1]},{rate}\n' for segment in report['missing_segment_HK']]
+    return lines
+
+def follow(file_name, idle=1., poll=0.05, chunk=1 << 20, wait=60.):
+
+    '''
+    Follow a file that is being written, like tail -f, until it stops growing.
+    Input:
+        file_name: str
+        idle: seconds without new data before the stream is finished (loss of signal)
+        poll: seconds between two checks of the file
+        chunk: maximum number of bytes read at once
+        wait: seconds to wait for the file to appear
+    Output:
+        stream: StreamIngest with the final state
+    '''
+
+    stream = StreamIngest()
+    t_start = time.time()
+    while not os.path.isfile(file_name):
+        if time.time() - t_start > wait:
+            raise FileNotFoundError(file_name)
+        time.sleep(poll)
+
+    with open(file_name, 'rb') as f:
+        t_last = time.time()
+        while True:
+            data = f.read(chunk)
+            if data:
+                stream.feed(data)
+                t_last = time.time()
+                continue
+            if time.time() - t_last > idle:
+                break
+            time.sleep(poll)
+
+    stream.finish()
+    return stream
+
+if __name__ == "__main__":
+    file_name = sys.argv[1]
+    idle = float(sys.argv[2]) if len(sys.argv) > 2 else 1.
+    os.makedirs('./report/', exist_ok=True)
+
+    stream = follow(file_name, idle)
+    t_los = time.time()
+    fout_name = f'./report/stream_{file_name.split("/")[-1].replace(".bin", ".csv")}'
+    with open(fout_name, 'w') as f:
+        f.write('Filename,Type,Start_Packet_number,End_Packet_number,Incompleteness(100*missing/16621)\n')
+        f.writelines(report_lines(file_name, stream.gap_report()))
+    print(f'Packets: {stream.n_packets}, Image packets: {stream.n_IM}, UnClassified packets: {stream.n_unclassified}')
+    print(f'Gap report: {fout_name} ({time.time() - t_los:.3f} s after the end of the pass)')
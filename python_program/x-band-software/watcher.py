@@ -0,0 +1,160 @@
+'''
+Watch the input folders of main_control.py for new files.
+A file is reported once it is complete:
+    - with inotify (Linux), when it is closed after writing (IN_CLOSE_WRITE) or moved into the folder (IN_MOVED_TO)
+    - with the polling fallback, when its size and modification time did not change between two polls
+The files ending with .part are being written by the programs and are not reported, they are renamed when complete.
+The files already in the folders when the watcher starts are reported at the first wait.
+'''
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+event_head = struct.Struct('iIII') # wd, mask, cookie, len
+
+def is_ready(folder, name):
+    return (not name.endswith('.part')) and os.path.isfile(os.path.join(folder, name))
+
+def list_folder(folder):
+    return sorted(name for name in os.listdir(folder) if is_ready(folder, name))
+
+class InotifyWatcher:
+
+    '''
+    Watcher based on the inotify API of the Linux kernel, called through ctypes.
+    '''
+
+    def __init__(self, folders):
+        libc_name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(f'inotify is not available: {e}') from e
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.folders = {}
+        for folder in folders:
+            wd = self.add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, f'inotify_add_watch failed for {folder}')
+            self.folders[wd] = folder
+        self.pending = self.rescan()
+
+    def rescan(self):
+        return [(folder, name) for folder in self.folders.values() for name in list_folder(folder)]
+
+    def read_events(self):
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return events
+            k = 0
+            while k < len(buf):
+                wd, mask, cookie, length = event_head.unpack_from(buf, k)
+                name = buf[k + event_head.size:k + event_head.size + length].rstrip(b'\0')
+                k += event_head.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, look at the folders again
+                    events += self.rescan()
+                elif (wd in self.folders) and not (mask & (IN_IGNORED | IN_ISDIR)):
+                    folder = self.folders[wd]
+                    name = os.fsdecode(name)
+                    if is_ready(folder, name):
+                        events.append((folder, name))
+
+    def wait(self, timeout=None):
+
+        '''
+        Wait for complete files.
+        Input:
+            timeout: maximum seconds to wait, None to wait until a file arrives
+        Output:
+            events: list of (folder, file name) without duplicates, in the order of arrival
+        '''
+
+        events, self.pending = self.pending, []
+        if not events:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if readable:
+                events = self.read_events()
+        return list(dict.fromkeys(events))
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+
+    '''
+    Watcher that lists the folders every poll seconds, for the systems without inotify.
+    '''
+
+    def __init__(self, folders, poll=1.):
+        self.folders = list(folders)
+        self.poll = poll
+        self.state = {}     # (folder, name): (size, mtime) at the last poll
+        self.reported = {}  # (folder, name): (size, mtime) when reported
+
+    def scan(self):
+        events = []
+        state = {}
+        for folder in self.folders:
+            for name in list_folder(folder):
+                try:
+                    stat = os.stat(os.path.join(folder, name))
+                except FileNotFoundError:
+                    continue
+                key, signature = (folder, name), (stat.st_size, stat.st_mtime_ns)
+                state[key] = signature
+                # not growing since the last poll, and not reported in this state
+                if (self.state.get(key) == signature) and (self.reported.get(key) != signature):
+                    self.reported[key] = signature
+                    events.append(key)
+        self.state = state
+        self.reported = {key: signature for key, signature in self.reported.items() if key in state}
+        return events
+
+    def wait(self, timeout=None):
+
+        '''
+        Same as InotifyWatcher.wait, the files are seen at most 2 polls after they are complete.
+        '''
+
+        t_start = time.time()
+        while True:
+            events = self.scan()
+            if events or ((timeout is not None) and (time.time() - t_start >= timeout)):
+                return events
+            time.sleep(self.poll if timeout is None else max(min(self.poll, timeout - (time.time() - t_start)), 0))
+
+    def close(self):
+        pass
+
+def watch(folders, poll=1.):
+
+    '''
+    Watcher for the folders, inotify if possible, else polling every poll seconds.
+    '''
+
+    try:
+        return InotifyWatcher(folders)
+    except OSError as e:
+        print(f'{e}, polling the folders every {poll} s')
+        return PollingWatcher(folders, poll)